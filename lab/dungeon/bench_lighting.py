@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+ Deferred clustered lighting against forward lighting, as torches are
+ added to a level.  For each light count, from a few views in a random
+ level, times
+
+ * binning the lights into clusters on the CPU (numpy)
+ * a whole frame with DeferredLighting: G-buffer, light pass
+ * a whole frame with ForwardLighting adding up every light in view, up
+   to the most the driver takes as uniforms
+ * a whole frame with ForwardLighting's default 8 lights, which is
+   cheap but drops the rest
+
+ Runs headless (EGL) with --headless.
+
+ Usage: bench_lighting.py [--headless] [--size WxH] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, "..", ".."), os.path.join(here, "..", "shaders")]
+import pyglet
+pyglet.options['headless'] = "--headless" in sys.argv
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+import numpy as np
+
+import glstate
+import glresources
+import lighting
+from xash.level import random_level, torches, LevelView, current_matrices, FLOOR
+
+COUNTS = (16, 64, 256, 1024)
+FRAMES = 10
+VIEWS = 4
+
+def frame(view, lights, lt, eye, centre, width, height):
+    glViewport(0, 0, width, height)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluPerspective(60.0, width / float(height), 0.05, 100.0)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    gluLookAt(*(tuple(eye) + tuple(centre) + (0.0, 0.0, 1.0)))
+    proj, model = current_matrices()
+    lt.frame(lights, proj, model)
+    lt.begin()
+    lt.program.use()
+    lt.program.set(colour=(0.8, 0.8, 0.8, 1.0))
+    view.draw(lt.program)
+    glstate.restore()
+    lt.end()
+
+def timed(view, lights, lt, views, width, height):
+    """ mean ms per frame over the views """
+    frame(view, lights, lt, views[0][0], views[0][1], width, height) # warm up
+    glFinish()
+    t0 = time.perf_counter()
+    for eye, centre in views:
+        for i in range(FRAMES):
+            frame(view, lights, lt, eye, centre, width, height)
+    glFinish()
+    return (time.perf_counter() - t0) * 1000.0 / (FRAMES * len(views))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--size", default="320x240")
+    ap.add_argument("--json", metavar="FILE")
+    args = ap.parse_args()
+    width, height = (int(n) for n in args.size.split("x"))
+    win = pyglet.window.Window(width, height, visible=False)
+    glstate.enable(GL_DEPTH_TEST)
+    glstate.enable(GL_CULL_FACE)
+    level = random_level(96, 96, rooms=40, seed=5)
+    view = LevelView(level)
+    rng = np.random.RandomState(1)
+    ys, xs = np.nonzero(level.tiles == FLOOR)
+    views = []
+    for i in rng.randint(len(xs), size=VIEWS):
+        angle = rng.uniform(0.0, 2 * np.pi)
+        eye = (xs[i] + 0.5, ys[i] + 0.5, 0.5)
+        views.append((eye, (eye[0] + np.cos(angle), eye[1] + np.sin(angle), 0.45)))
+    deferred = lighting.DeferredLighting(width, height)
+    few = lighting.ForwardLighting()
+    results = {}
+    print("{:>6} {:>8} {:>10} {:>10} {:>12} {:>10}".format(
+        "lights", "bin ms", "per clstr", "deferred", "forward all", "forward 8"))
+    for n in COUNTS:
+        lights = torches(level, n, seed=n)
+        result = results[n] = {}
+        result["deferred_ms"] = timed(view, lights, deferred, views, width, height)
+        result["bin_ms"] = deferred.stats["bin_ms"]
+        result["max_per_cluster"] = deferred.stats["max_per_cluster"]
+        try:
+            every = lighting.ForwardLighting(n)
+        except RuntimeError: # too many uniforms
+            result["forward_all_ms"] = None
+        else:
+            result["forward_all_ms"] = timed(view, lights, every, views, width, height)
+            every.release()
+        result["forward_8_ms"] = timed(view, lights, few, views, width, height)
+        glresources.collect()
+        print("{:6d} {:8.2f} {:10d} {:10.2f} {:>12} {:10.2f}".format(
+            n, result["bin_ms"], result["max_per_cluster"], result["deferred_ms"],
+            "-" if result["forward_all_ms"] is None else "%.2f" % result["forward_all_ms"],
+            result["forward_8_ms"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(size=[width, height], results=results), f, indent=1)
+    deferred.release()
+    few.release()
+    glresources.collect()
+    win.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+ Levels of detail for props.  A random level gets a barrel (a lathed
+ mesh of a few thousand triangles) on many floor tiles, and from a few
+ views at eye height times a frame of level and barrels
+
+ * at full detail
+ * with an LODSelector choosing simplified levels by distance
+ * the same, with impostors past the last level
+
+ and counts the triangles drawn and saved per frame.  Also times
+ simplifying the barrel.  Runs headless (EGL) with --headless.
+
+ Usage: bench_lod.py [--headless] [--size WxH] [--props N] [--json FILE]
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, "..", ".."), os.path.join(here, "..", "shaders")]
+import pyglet
+pyglet.options['headless'] = "--headless" in sys.argv
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+import numpy as np
+
+import glstate
+import glresources
+import lod
+from tnvmesh import MeshData
+from xash.level import random_level, LevelView, FLOOR
+
+FRAMES = 5
+VIEWS = 4
+EYE_HEIGHT = 0.5
+DISTANCES = (3.0, 6.0)
+IMPOSTOR = 12.0
+
+def lathe_data(profile, segments):
+    """ MeshData ("VN", one GL_QUADS piece "barrel") turning profile,
+      [(radius, z)...], about the z axis """
+    vdata = []
+    rings = len(profile)
+    for r, z in profile:
+        for s in range(segments):
+            angle = 2.0 * math.pi * s / segments
+            c, sn = math.cos(angle), math.sin(angle)
+            vdata.extend((r * c, r * sn, z, c, sn, 0.0))
+    indices = []
+    for i in range(rings - 1):
+        for s in range(segments):
+            a, b = i * segments + s, i * segments + (s + 1) % segments
+            indices.extend((a, b, b + segments, a + segments))
+    return MeshData(np.array(vdata, dtype=np.float32), "VN",
+                    dict(barrel=(np.array(indices), GL_QUADS)))
+
+def barrel_data(segments=48, rings=24):
+    profile = [(0.2 + 0.05 * math.sin(math.pi * i / (rings - 1)), 0.6 * i / (rings - 1))
+               for i in range(rings)]
+    return lathe_data(profile, segments)
+
+def frame(view, mesh, props, eye, centre, width, height, selector=None, impostor=None):
+    glViewport(0, 0, width, height)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluPerspective(60.0, width / float(height), 0.05, 100.0)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    gluLookAt(*(tuple(eye) + tuple(centre) + (0.0, 0.0, 1.0)))
+    view.draw()
+    if selector is None:
+        for position in props:
+            glPushMatrix()
+            glTranslatef(*position)
+            mesh.draw(mesh.lod_pieces(0))
+            glPopMatrix()
+    else:
+        selector.begin_frame()
+        for key, position in enumerate(props):
+            selector.draw(key, mesh, position, eye, impostor=impostor)
+        if impostor is not None:
+            impostor.flush()
+    glstate.restore()
+
+def timed(view, mesh, props, views, width, height, selector=None, impostor=None):
+    """ (mean ms per frame, mean triangles drawn, mean saved) over the views """
+    drawn = saved = 0
+    frame(view, mesh, props, views[0][0], views[0][1], width, height, selector, impostor)
+    glFinish()
+    t0 = time.perf_counter()
+    for eye, centre in views:
+        for i in range(FRAMES):
+            frame(view, mesh, props, eye, centre, width, height, selector, impostor)
+        if selector is not None:
+            drawn += selector.stats["drawn"]
+            saved += selector.stats["saved"]
+        else:
+            drawn += mesh.triangles(mesh.lod_pieces(0)) * len(props)
+    glFinish()
+    ms = (time.perf_counter() - t0) * 1000.0 / (FRAMES * len(views))
+    return ms, drawn // len(views), saved // len(views)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--size", default="320x240")
+    ap.add_argument("--props", type=int, default=300)
+    ap.add_argument("--json", metavar="FILE")
+    args = ap.parse_args()
+    width, height = (int(n) for n in args.size.split("x"))
+    win = pyglet.window.Window(width, height, visible=False)
+    glstate.enable(GL_DEPTH_TEST)
+    glstate.enable(GL_CULL_FACE)
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+    glEnable(GL_COLOR_MATERIAL)
+    level = random_level(96, 96, rooms=40, seed=5)
+    view = LevelView(level)
+    rng = np.random.RandomState(1)
+    ys, xs = np.nonzero(level.tiles == FLOOR)
+    props = [(xs[i] + 0.5, ys[i] + 0.5, 0.0)
+             for i in rng.choice(len(xs), size=min(args.props, len(xs)), replace=False)]
+    views = []
+    for i in rng.randint(len(xs), size=VIEWS):
+        angle = rng.uniform(0.0, 2 * np.pi)
+        eye = (xs[i] + 0.5, ys[i] + 0.5, EYE_HEIGHT)
+        views.append((eye, (eye[0] + np.cos(angle), eye[1] + np.sin(angle), EYE_HEIGHT - 0.05)))
+
+    data = barrel_data()
+    t0 = time.perf_counter()
+    data = lod.lod_data(data)
+    simplify_ms = (time.perf_counter() - t0) * 1000.0
+    mesh = data.make()
+    levels = [mesh.triangles(mesh.lod_pieces(l)) for l in range(len(lod.RATIOS) + 1)]
+    print("barrel triangles per level {}, simplified in {:.0f} ms".format(levels, simplify_ms))
+    impostor = lod.Impostor(mesh, *lod.bounding_sphere(data))
+    results = dict(levels=levels, simplify_ms=simplify_ms, props=len(props))
+    print("{:>14} {:>8} {:>10} {:>10}".format("", "ms", "triangles", "saved"))
+    for name, selector, imp in (
+            ("full detail", None, None),
+            ("lod", lod.LODSelector(DISTANCES), None),
+            ("lod+impostor", lod.LODSelector(DISTANCES, impostor=IMPOSTOR), impostor)):
+        ms, drawn, saved = timed(view, mesh, props, views, width, height, selector, imp)
+        results[name] = dict(ms=ms, triangles=drawn, saved=saved)
+        print("{:>14} {:8.2f} {:10d} {:10d}".format(name, ms, drawn, saved))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(size=[width, height], results=results), f, indent=1)
+    impostor.release()
+    mesh.release()
+    view.release()
+    glresources.collect()
+    win.close()
+
+if __name__ == '__main__':
+    main()
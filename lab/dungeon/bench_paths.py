@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+ Pathfinding for 500 monsters on a 256x256 level, per turn:
+
+ * every monster running its own A* to the player (timed for a sample
+   of them and scaled up)
+ * one flow field to the player, all monsters stepping down it
+ * monsters after treasure through PathService's cached room routes
+ * a door opening: FlowField.repair() against computing it again
+
+ Usage: bench_paths.py [size] [nagents] [nturns]
+"""
+import os
+import sys
+import time
+import heapq
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, "..", ".."), os.path.join(here, "..", "shaders")]
+import pyglet
+pyglet.options['shadow_window'] = False
+import numpy as np
+
+from xash.level import random_level, FLOOR, DOOR, OPEN_DOOR, WALKABLE, DIRECTIONS
+from xash.paths import FlowField, PathService
+
+SAMPLE = 25 # monsters to time A* for
+
+def astar(walkable, start, goal):
+    """ the naive way: a list of tiles from start to goal """
+    gx, gy = goal
+    came = {start: None}
+    cost = {start: 0}
+    heap = [(0, start)]
+    while heap:
+        _, here = heapq.heappop(heap)
+        if here == goal:
+            path = []
+            while here is not None:
+                path.append(here)
+                here = came[here]
+            return path[::-1]
+        x, y = here
+        for dx, dy in DIRECTIONS:
+            n = (x + dx, y + dy)
+            if walkable[n[1]][n[0]] and cost[here] + 1 < cost.get(n, 1 << 30):
+                cost[n] = cost[here] + 1
+                came[n] = here
+                heapq.heappush(heap, (cost[n] + abs(n[0] - gx) + abs(n[1] - gy), n))
+    return None
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - t0) * 1000.0
+
+def main():
+    args = sys.argv[1:]
+    size = int(args[0]) if args else 256
+    nagents = int(args[1]) if len(args) > 1 else 500
+    nturns = int(args[2]) if len(args) > 2 else 20
+    level = random_level(size, size, rooms=60, seed=1)
+    doors = list(zip(*np.nonzero(level.tiles == DOOR)))
+    level.tiles[level.tiles == DOOR] = OPEN_DOOR
+    rng = np.random.RandomState(0)
+    ys, xs = np.nonzero(level.tiles == FLOOR)
+    def pick(n):
+        i = rng.randint(len(xs), size=n)
+        return np.stack((xs[i], ys[i]), axis=1)
+    agents = pick(nagents)
+    player = tuple(pick(1)[0].tolist())
+    print("{}x{} level, {} monsters, {} doors".format(size, size, nagents, len(doors)))
+
+    walkable = np.isin(level.tiles, WALKABLE).tolist()
+    total = 0.0
+    for start in agents[:SAMPLE].tolist():
+        _, ms = timed(astar, walkable, tuple(start), player)
+        total += ms
+    print("{:>28}: {:8.2f} ms/turn".format("A* per monster", total * nagents / SAMPLE))
+
+    total = 0.0
+    positions = agents
+    for turn in range(nturns):
+        field, ms = timed(FlowField, level, [player])
+        positions, ms2 = timed(field.step, positions)
+        total += ms + ms2
+    print("{:>28}: {:8.2f} ms/turn".format("shared flow field", total / nturns))
+
+    service = PathService(level)
+    treasure = pick(8)
+    goals = treasure[rng.randint(len(treasure), size=nagents)]
+    positions = agents
+    times = []
+    for turn in range(nturns):
+        positions, ms = timed(service.step, positions, goals)
+        times.append(ms)
+    print("{:>28}: {:8.2f} ms first turn, {:.2f} ms/turn after ({} fields, {} routes)".format(
+        "treasure via room routes", times[0], sum(times[1:]) / max(nturns - 1, 1),
+        service.stats["fields"], service.stats["routes"]))
+
+    field = FlowField(level, [player])
+    repair = full = 0.0
+    for y, x in doors[:nturns]:
+        level[x, y] = DOOR
+        _, ms = timed(field.update)
+        repair += ms
+        _, ms = timed(FlowField, level, [player])
+        full += ms
+        assert (field.dist == FlowField(level, [player]).dist).all()
+    n = max(min(len(doors), nturns), 1)
+    print("{:>28}: {:8.2f} ms repair, {:.2f} ms from scratch".format(
+        "door closing", repair / n, full / n))
+
+if __name__ == '__main__':
+    main()
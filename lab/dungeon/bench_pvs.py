@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+ How much does the PVS save?  For random levels, stand at random floor
+ tiles looking in random directions at eye height, and count the
+ triangles in the chunks drawn with frustum culling alone and with the
+ PVS as well.  No GL needed.
+
+ Usage: bench_pvs.py [size] [nlevels] [nviews]
+"""
+import os
+import sys
+import time
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, "..", ".."), os.path.join(here, "..", "shaders")]
+import pyglet
+pyglet.options['shadow_window'] = False
+import numpy as np
+
+from xash.level import (random_level, frustum_planes, boxes_visible,
+                        perspective, look_at, FLOOR)
+from xash.visibility import PVS
+from tnvmesh import attribute_offsets
+
+EYE_HEIGHT = 0.5
+
+def chunk_triangles(level):
+    """ {chunk key: triangles} as LevelView would draw them """
+    floats = attribute_offsets('VNTU')[0] // 4
+    found = {}
+    for cx in range(level.nchunks[0]):
+        for cy in range(level.nchunks[1]):
+            data = level.chunk_meshdata(cx, cy)
+            if data is not None:
+                found[(cx, cy)] = len(data.vertexdata) // floats // 2
+    return found
+
+def main():
+    args = sys.argv[1:]
+    size = int(args[0]) if args else 128
+    nlevels = int(args[1]) if len(args) > 1 else 4
+    nviews = int(args[2]) if len(args) > 2 else 200
+    proj = perspective(60.0, 4.0 / 3.0, 0.1, 100.0)
+    rng = np.random.RandomState(1)
+    totals = np.zeros(2)
+    for seed in range(nlevels):
+        level = random_level(size, size, seed=seed)
+        tris = chunk_triangles(level)
+        keys = list(tris)
+        lo = np.array([level.chunk_bounds(*k)[0] for k in keys])
+        hi = np.array([level.chunk_bounds(*k)[1] for k in keys])
+        t0 = time.perf_counter()
+        pvs = PVS.compute(level)
+        elapsed = time.perf_counter() - t0
+        ys, xs = np.nonzero(level.tiles == FLOOR)
+        counts = np.zeros(2)
+        for i in rng.randint(len(xs), size=nviews):
+            eye = (xs[i] + 0.5, ys[i] + 0.5, EYE_HEIGHT)
+            angle = rng.uniform(0.0, 2 * np.pi)
+            centre = (eye[0] + np.cos(angle), eye[1] + np.sin(angle), EYE_HEIGHT)
+            inside = boxes_visible(frustum_planes(proj @ look_at(eye, centre)), lo, hi)
+            seen = pvs.chunks_from(eye)
+            for key, v in zip(keys, inside):
+                if v:
+                    counts[0] += tris[key]
+                    counts[1] += tris[key] if key in seen else 0
+        print("level {}: {} cells, PVS in {:.2f}s, triangles/view {:.0f} -> {:.0f} ({:.0%})"
+              .format(seed, len(pvs.visible), elapsed, counts[0] / nviews,
+                      counts[1] / nviews, counts[1] / max(counts[0], 1)))
+        totals += counts
+    print("overall: {:.0%} of the frustum-culled triangles drawn"
+          .format(totals[1] / max(totals[0], 1)))
+
+if __name__ == '__main__':
+    main()
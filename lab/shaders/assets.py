@@ -0,0 +1,183 @@
+"""
+ Loading assets without freezing the window
+
+ Making a mesh or shader is two kinds of work: CPU work that needs no GL
+ (generating geometry, converting it to flat typed arrays, decoding
+ images, reading and preprocessing shader source) and the GL calls that
+ turn the result into buffers, textures and programs, which have to be
+ made on the thread whose context is current.
+
+ An AssetLoader does the first kind in a pool of worker threads (or
+ processes) and queues the results.  The main thread calls pump() once a
+ frame, which makes GL objects from the queue until its time budget (a
+ few ms) is used up, so a frame is never held up by more than that plus
+ one upload.  load() returns a concurrent.futures.Future for the
+ finished object; its callbacks run in pump(), on the main thread, so
+ they can use GL too.  progress() is for loading screens.
+
+   loader = AssetLoader()
+   future = loader.mesh(tnvmesh.cuboid_data, 1, 1, 1)
+   ...each frame: loader.pump()
+   if future.done(): mesh = future.result()
+
+ Threads suit numpy work, which releases the GIL.  Work for processes
+ must be picklable, so module-level functions and their arguments.
+
+"""
+import os
+import re
+import time
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from pyglet.gl import *
+
+from tnvmesh import MeshData, index_typecode, index_array
+from shaders import Shader, ShaderProgram
+from textures import load_image
+
+BUDGET_MS = 4.0 # main thread time per frame for making GL objects
+
+INCLUDE = re.compile(rb'^[ \t]*#include[ \t]+"([^"]+)"[ \t]*$', re.M)
+
+def prepared_meshdata(data):
+    """ MeshData with its vertices as a float32 array and the indices of
+      all its pieces in the one index type, so that make() has nothing
+      left to do but upload them """
+    vertices = np.ascontiguousarray(np.asarray(data.vertexdata, dtype=np.float32).ravel())
+    pieces = dict((name, (np.asarray(indices), prim))
+                  for name, (indices, prim) in data.pieces.items())
+    codes = [index_typecode(indices) for indices, prim in pieces.values()]
+    typecode = max(codes, key="BHI".index) if codes else "B"
+    pieces = dict((name, (np.ascontiguousarray(index_array(indices, typecode)), prim))
+                  for name, (indices, prim) in pieces.items())
+    return MeshData(vertices, data.order, pieces)
+
+def build_meshdata(fn, *args):
+    """ call fn(*args) for MeshData (or None) and prepare it """
+    data = fn(*args)
+    return None if data is None else prepared_meshdata(data)
+
+def make_mesh(data):
+    return None if data is None else data.make()
+
+def preprocess_shader(path, seen=()):
+    """ the source of a shader file as bytes, with #include "file" lines
+      replaced by that file (relative to the one including it) """
+    path = os.path.abspath(path)
+    if path in seen:
+        raise ValueError("%s includes itself" % path)
+    with open(path, "rb") as f:
+        source = f.read()
+    here = os.path.dirname(path)
+    return INCLUDE.sub(lambda m: preprocess_shader(
+        os.path.join(here, m.group(1).decode()), seen + (path,)), source)
+
+def read_shaders(*paths):
+    return [preprocess_shader(path) for path in paths]
+
+def shader_type(path):
+    """ the shader type for a file name ending .vert, .geom or .frag """
+    return {".vert": GL_VERTEX_SHADER, ".vs": GL_VERTEX_SHADER,
+            ".geom": GL_GEOMETRY_SHADER, ".gs": GL_GEOMETRY_SHADER
+            }.get(os.path.splitext(path)[1], GL_FRAGMENT_SHADER)
+
+class AssetLoader:
+    def __init__(self, workers=None, processes=False, budget_ms=BUDGET_MS):
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.pool = pool(workers or max((os.cpu_count() or 2) - 1, 1))
+        self.budget_ms = budget_ms
+        self.ready = queue.Queue() # (future, finish, prepared future), from the workers
+        self.submitted = 0
+        self.finished = 0
+        self.stats = dict(made=0, pump_ms=0.0, queued=0)
+
+    def load(self, prepare, *args, finish=None):
+        """ a Future for finish(prepare(*args)): prepare runs on a worker,
+          finish (if any) on the main thread in pump() """
+        result = Future()
+        result.set_running_or_notify_cancel()
+        self.submitted += 1
+        work = self.pool.submit(prepare, *args)
+        work.add_done_callback(lambda work: self.ready.put((result, finish, work)))
+        return result
+
+    def mesh(self, fn, *args):
+        """ a Future for the TNVMesh of the MeshData fn(*args) makes
+          (None if it makes None) """
+        return self.load(build_meshdata, fn, *args, finish=make_mesh)
+
+    def program(self, *paths, attributes=None, cache=None):
+        """ a Future for a ShaderProgram from shader files, the type of
+          each from its extension (see shader_type()).  The files are read
+          and #includes expanded on a worker; with a ShaderCache the
+          program may come from its saved binaries """
+        types = [shader_type(path) for path in paths]
+        def link(sources):
+            if cache is not None:
+                return cache.program(*zip(sources, types), attributes=attributes)
+            return ShaderProgram(*(Shader(source, t) for source, t in zip(sources, types)),
+                                 attributes=attributes)
+        return self.load(read_shaders, *paths, finish=link)
+
+    def texture(self, path, textures, name=None):
+        """ a Future for the layer of an image file in a
+          textures.TextureArray (or region in an Atlas).  The file is
+          decoded on a worker; build() the textures once they are all in """
+        return self.load(load_image, path,
+                         finish=lambda image: textures.add(name or path, image))
+
+    def pump(self, budget_ms=None):
+        """ make GL objects from finished work for up to budget_ms (at
+          least one if there are any); return how many were finished """
+        if budget_ms is None:
+            budget_ms = self.budget_ms
+        clock = time.perf_counter
+        start = clock()
+        end = start + budget_ms / 1000.0
+        done = 0
+        while True:
+            try:
+                result, finish, work = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                value = work.result()
+                if finish is not None:
+                    value = finish(value)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                result.set_result(value)
+            self.finished += 1
+            done += 1
+            if clock() >= end:
+                break
+        self.stats["made"] += done
+        self.stats["pump_ms"] = (clock() - start) * 1000.0
+        self.stats["queued"] = self.ready.qsize()
+        return done
+
+    @property
+    def busy(self):
+        return self.finished < self.submitted
+
+    def progress(self, futures=None):
+        """ the fraction (0-1) of futures, by default of everything
+          loaded, that are done """
+        if futures is None:
+            done, total = self.finished, self.submitted
+        else:
+            done, total = sum(1 for f in futures if f.done()), len(futures)
+        return done / float(total) if total else 1.0
+
+    def wait(self, futures, budget_ms=50.0):
+        """ pump until futures are all done, e.g. before the first frame """
+        while not all(f.done() for f in futures):
+            if not self.pump(budget_ms):
+                time.sleep(0.001)
+
+    def shutdown(self):
+        """ stop the workers; work not yet started is dropped """
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+ Stress test for per-frame geometry: change 100k vertices every frame
+ and draw them, comparing
+
+ * making a new TNVMesh every frame (the old way)
+ * DynamicTNVMesh orphaning the buffer (frames=1)
+ * DynamicTNVMesh ring buffer with fences (frames=3)
+ * the ring buffer with only a tenth of the vertices changed per frame
+
+ Usage: bench_stream.py [nvertices] [nframes] [--headless]
+"""
+import sys
+import time
+import pyglet
+pyglet.options['headless'] = "--headless" in sys.argv
+from pyglet.gl import *
+import numpy as np
+
+import tnvmesh
+import glresources
+
+def run(label, nframes, update):
+    glFinish()
+    t0 = time.perf_counter()
+    updating = 0.0
+    mesh = None
+    for frame in range(nframes):
+        t1 = time.perf_counter()
+        mesh = update(mesh, frame)
+        updating += time.perf_counter() - t1
+        glClear(GL_COLOR_BUFFER_BIT)
+        mesh.draw()
+        glFlush()
+        glresources.collect() # as a window does each frame
+    glFinish()
+    elapsed = time.perf_counter() - t0
+    print("{:>20}: {:7.2f} ms/frame, {:6.2f} ms in updates".format(
+        label, elapsed * 1000.0 / nframes, updating * 1000.0 / nframes))
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    nvertices = int(args[0]) if args else 100000
+    nframes = int(args[1]) if len(args) > 1 else 100
+    win = pyglet.window.Window(256, 256, visible=False)
+    base = np.random.uniform(-1.0, 1.0, (nvertices, 3)).astype(np.float32)
+    indices = np.arange(nvertices, dtype=np.uint32)
+    tenth = nvertices // 10
+
+    def wobble(frame, rows=slice(None)):
+        return base[rows] + np.float32(0.01 * np.sin(frame * 0.1))
+
+    def points():
+        return dict(points=tnvmesh.TNVPiece(indices, GL_POINTS))
+
+    def remake(mesh, frame):
+        return tnvmesh.TNVMesh(wobble(frame), 'V', points())
+
+    def dynamic(frames):
+        def update(mesh, frame):
+            if mesh is None:
+                return tnvmesh.DynamicTNVMesh(wobble(frame), 'V', points(), frames)
+            mesh.update(wobble(frame))
+            return mesh
+        return update
+
+    def partial(mesh, frame):
+        if mesh is None:
+            return tnvmesh.DynamicTNVMesh(wobble(frame), 'V', points(), 3)
+        first = (frame * tenth) % (nvertices - tenth + 1)
+        mesh.update(wobble(frame, slice(first, first + tenth)), first)
+        return mesh
+
+    print("{} vertices, {} frames".format(nvertices, nframes))
+    run("new mesh per frame", nframes, remake)
+    run("orphaning", nframes, dynamic(1))
+    run("ring of 3", nframes, dynamic(3))
+    run("ring of 3, 10%", nframes, partial)
+    win.close()
+
+if __name__ == '__main__':
+    main()
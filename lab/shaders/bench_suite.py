@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+ Benchmarks for the mesh and shader code, to compare between commits.
+
+ Runs in a hidden window, or with --headless in an offscreen EGL
+ context, which under Mesa's llvmpipe needs no GPU or display, so it
+ works on CI machines.  For scenes of increasing size it times
+
+ * building cuboid TNVMeshes one by one, and merged by MeshBatch
+ * drawing them separately and batched: ms/frame, draws/s, triangles/s
+ * ShaderProgram.set() uploading changing uniforms
+ * compiling and linking a shader program (without ShaderCache)
+
+ and writes the results as JSON.  --compare prints how a previous
+ run's times compare with this one's.
+
+ Usage: bench_suite.py [--headless] [--quick] [--json FILE] [--compare FILE]
+"""
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+from ctypes import cast, c_char_p
+import pyglet
+pyglet.options['headless'] = "--headless" in sys.argv
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+import numpy as np
+
+import tnvmesh
+import glstate
+import glresources
+from meshbatch import MeshBatch, translation
+from shaders import Shader, ShaderProgram
+
+SCALES = (100, 1000, 5000)
+QUICK_SCALES = (100, 1000)
+FRAMES = 20
+UNIFORM_SETS = 20000
+PROGRAMS = 10
+
+VSHADER = b"""
+#version 130
+uniform mat4 transform = mat4(1.0);
+smooth out float brightness;
+void main()
+{
+  brightness = 0.3 + 0.7 * max(0.0, dot(gl_Normal, normalize(vec3(3.0, 1.0, 7.0))));
+  gl_Position = gl_ModelViewProjectionMatrix * transform * gl_Vertex;
+}
+"""
+
+FSHADER = b"""
+#version 130
+uniform vec4 colour = vec4(1.0);
+smooth in float brightness;
+void main()
+{
+  gl_FragColor = colour * brightness;
+}
+"""
+
+def timed(fn, *args):
+    """ (result, ms) with the GL pipeline drained either side """
+    glFinish()
+    t0 = time.perf_counter()
+    result = fn(*args)
+    glFinish()
+    return result, (time.perf_counter() - t0) * 1000.0
+
+def triangles(meshdata):
+    count = 0
+    for indices, prim in meshdata.pieces.values():
+        n = len(indices)
+        count += n // 4 * 2 if prim == GL_QUADS else n // 3
+    return count
+
+def positions(n):
+    """ n places spread over the view """
+    side = int(np.ceil(np.sqrt(n)))
+    i = np.arange(n)
+    return np.stack(((i % side) / side * 2.0 - 1.0, (i // side) / side * 2.0 - 1.0,
+                     np.zeros(n)), axis=1)
+
+def bench_meshes(n, program, results):
+    data = tnvmesh.cuboid_data(0.01, 0.01, 0.01)
+    places = positions(n)
+    meshes, ms = timed(lambda: [data.make() for _ in range(n)])
+    results["build_separate/%d" % n] = dict(ms=ms, per_s=n * 1000.0 / ms)
+    def batch():
+        b = MeshBatch()
+        for x, y, z in places:
+            b.add(data, translation(x, y, z))
+        b.build()
+        return b
+    batched, ms = timed(batch)
+    results["build_batched/%d" % n] = dict(ms=ms, per_s=n * 1000.0 / ms)
+
+    tris = triangles(data) * n
+    program.use()
+    def separate():
+        for frame in range(FRAMES):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            for mesh, (x, y, z) in zip(meshes, places):
+                glPushMatrix()
+                glTranslatef(x, y, z)
+                mesh.draw(None, program)
+                glPopMatrix()
+    def together():
+        for frame in range(FRAMES):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            batched.draw(None, program)
+    for name, fn, draws in (("draw_separate", separate, n),
+                            ("draw_batched", together, len(batched.meshes))):
+        fn() # warm up
+        _, ms = timed(fn)
+        frame = ms / FRAMES
+        results["%s/%d" % (name, n)] = dict(ms=frame, draws_per_s=draws * 1000.0 / frame,
+                                            triangles_per_s=tris * 1000.0 / frame)
+    # free this scale's buffers before the next is measured
+    for mesh in meshes:
+        mesh.release()
+    batched.release()
+    glresources.collect()
+
+def bench_uniforms(program, results):
+    program.use()
+    values = [(i % 7 / 7.0, i % 5 / 5.0, i % 3 / 3.0, 1.0) for i in range(16)]
+    matrices = [translation(i * 0.01, 0.0, 0.0) for i in range(16)]
+    def run():
+        for i in range(UNIFORM_SETS):
+            program.set(colour=values[i & 15], transform=matrices[i & 15])
+    _, ms = timed(run)
+    results["uniform_set"] = dict(ms=ms / UNIFORM_SETS * 1000.0, unit="us",
+                                  per_s=UNIFORM_SETS * 2000.0 / ms)
+
+def bench_compile(results):
+    compile_ms = link_ms = 0.0
+    for i in range(PROGRAMS):
+        # a different comment each time, so the driver can't reuse a cached build
+        tag = ("\n// %d %f\n" % (i, time.time())).encode("ascii")
+        (vs, fs), ms = timed(lambda: (Shader(VSHADER + tag, GL_VERTEX_SHADER),
+                                      Shader(FSHADER + tag, GL_FRAGMENT_SHADER)))
+        compile_ms += ms
+        program, ms = timed(ShaderProgram, vs, fs)
+        link_ms += ms
+        for obj in (program, vs, fs):
+            obj.release()
+        glresources.collect()
+    results["compile"] = dict(ms=compile_ms / PROGRAMS)
+    results["link"] = dict(ms=link_ms / PROGRAMS)
+
+def describe():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                python=platform.python_version(), pyglet=pyglet.version,
+                renderer=cast(glGetString(GL_RENDERER), c_char_p).value.decode(),
+                version=cast(glGetString(GL_VERSION), c_char_p).value.decode())
+
+def compare(old, new):
+    """ print the ratio of new to old times for the benchmarks in both """
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before:
+            ratio = result["ms"] / before["ms"]
+            flag = "  slower" if ratio > 1.1 else ("  faster" if ratio < 0.9 else "")
+            print("{:>24}: {:9.3f} -> {:9.3f}  x{:.2f}{}".format(
+                name, before["ms"], result["ms"], ratio, flag))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--quick", action="store_true", help="smaller scenes only")
+    ap.add_argument("--json", metavar="FILE", help="write the results here")
+    ap.add_argument("--compare", metavar="FILE", help="a previous --json to compare with")
+    args = ap.parse_args()
+    win = pyglet.window.Window(256, 256, visible=False)
+    glstate.enable(GL_DEPTH_TEST)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    glOrtho(-1.1, 1.1, -1.1, 1.1, -1.0, 1.0)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    program = ShaderProgram(Shader(VSHADER, GL_VERTEX_SHADER), Shader(FSHADER))
+    results = {}
+    for n in (QUICK_SCALES if args.quick else SCALES):
+        bench_meshes(n, program, results)
+    bench_uniforms(program, results)
+    bench_compile(results)
+    glstate.restore()
+    report = dict(meta=describe(), results=results)
+    for name, result in results.items():
+        extra = "  ".join("{} {:.4g}".format(k, v) for k, v in result.items()
+                          if k not in ("ms", "unit"))
+        print("{:>24}: {:9.3f} {}  {}".format(name, result["ms"], result.get("unit", "ms"), extra))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    win.close()
+
+if __name__ == '__main__':
+    main()
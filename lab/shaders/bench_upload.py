@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+ Time building a large TNVMesh from a Python list compared with
+ building it from buffer-protocol objects (array.array, numpy).
+
+ Usage: bench_upload.py [nvertices] [--headless]
+"""
+import sys
+import time
+import array
+import pyglet
+pyglet.options['headless'] = "--headless" in sys.argv
+from pyglet.gl import *
+
+import tnvmesh
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def timed(label, fn, *args):
+    glFinish()
+    t0 = time.perf_counter()
+    result = fn(*args)
+    glFinish()
+    print("{:>16}: {:8.1f} ms".format(label, (time.perf_counter() - t0) * 1000.0))
+    return result
+
+def build(vdata, idata):
+    piece = tnvmesh.TNVPiece(idata, GL_POINTS)
+    return tnvmesh.TNVMesh(vdata, 'VNTU', dict(points=piece))
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    nvertices = int(args[0]) if args else 300000
+    win = pyglet.window.Window(visible=False)
+    nfloats = nvertices * 10 # VNTU
+    nindices = min(nvertices, 65536)
+    print("{} vertices, {} floats".format(nvertices, nfloats))
+    vlist = [float(i % 97) for i in range(nfloats)]
+    ilist = list(range(nindices))
+    timed("list", build, vlist, ilist)
+    timed("array.array", build, array.array('f', vlist), array.array('H', ilist))
+    if np is not None:
+        timed("numpy", build, np.array(vlist, dtype=np.float32),
+              np.arange(nindices, dtype=np.uint16))
+    win.close()
+
+if __name__ == '__main__':
+    main()
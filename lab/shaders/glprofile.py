@@ -0,0 +1,213 @@
+"""
+ Count and time GL calls, and time render passes on the GPU
+
+ Profiler.install() swaps the GL functions that the modules in MODULES
+ (shaders, tnvmesh, glstate, renderqueue, lighting, textures...) got
+ from "from pyglet.gl import *" for wrappers that count and time them by
+ kind (draw, bind, uniform, upload, other), likewise Uniform.upload,
+ which keeps its glUniform function; uninstall() puts them back.
+ Nothing is wrapped until then, so a game that doesn't profile pays
+ nothing.
+
+ Render passes go inside "with profiler.gpu_pass(name):", which brackets
+ them with GL_TIME_ELAPSED queries.  Their results are collected a frame
+ or two later, when they are ready, so reading them never stalls.
+
+ Each frame between frame_begin() and frame_end() becomes a record of
+ wall time, Python time outside GL calls, GL call counts and times, and
+ GPU pass times.  The last few hundred are kept for summary() (which the
+ overlay in xash/window.py shows) and write_csv().
+
+"""
+import csv
+import sys
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from ctypes import byref
+
+from pyglet.gl import *
+
+KINDS = ("draw", "bind", "uniform", "upload", "other")
+MODULES = ("shaders", "tnvmesh", "glstate", "glresources", "renderqueue", "meshbatch",
+           "lighting", "lod", "textures")
+# methods that make GL calls through functions saved at import time, so
+# they are counted as a whole: (module, class, method, kind).  They return
+# whether they made the call
+METHODS = (("shaders", "Uniform", "upload", "uniform"),)
+HISTORY = 300 # frames kept
+
+def kind_of(name):
+    if name.startswith(("glDraw", "glMultiDraw")):
+        return "draw"
+    if name.startswith(("glBind", "glUseProgram", "glActiveTexture")):
+        return "bind"
+    if name.startswith(("glUniform", "glProgramUniform")):
+        return "uniform"
+    if name.startswith(("glBufferData", "glBufferSubData", "glMapBuffer",
+                        "glCopyBufferSubData", "glTexImage", "glTexSubImage")):
+        return "upload"
+    return "other"
+
+def have_timer_query():
+    return gl_info.have_version(3, 3) or gl_info.have_extension("GL_ARB_timer_query")
+
+class Profiler:
+    def __init__(self, history=HISTORY):
+        self.records = deque(maxlen=history)
+        self.installed = {} # (module, name) -> original function
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.frame = 0
+        self.current = None
+        self.free_queries = []
+        self.pending = [] # (record, pass name, query)
+        self.timer_queries = None
+
+    def install(self, modules=MODULES):
+        """ wrap the GL functions in the named modules (those already imported) """
+        calls, seconds, clock = self.calls, self.seconds, time.perf_counter
+        def wrap(fn, kind):
+            def counted(*args):
+                t0 = clock()
+                try:
+                    return fn(*args)
+                finally:
+                    seconds[kind] += clock() - t0
+                    calls[kind] += 1
+            counted.__name__ = getattr(fn, "__name__", "gl")
+            return counted
+        def wrap_method(fn, kind):
+            def counted(*args):
+                t0 = clock()
+                called = fn(*args)
+                if called:
+                    seconds[kind] += clock() - t0
+                    calls[kind] += 1
+                return called
+            return counted
+        for modname in modules:
+            module = sys.modules.get(modname)
+            if module is None:
+                continue
+            for name, value in list(vars(module).items()):
+                if (name.startswith("gl") and name[2:3].isupper() and callable(value)
+                        and (modname, name) not in self.installed):
+                    self.installed[(modname, name)] = value
+                    setattr(module, name, wrap(value, kind_of(name)))
+        for modname, classname, name, kind in METHODS:
+            cls = getattr(sys.modules.get(modname), classname, None)
+            if cls is not None and (cls, name) not in self.installed:
+                self.installed[(cls, name)] = vars(cls)[name]
+                setattr(cls, name, wrap_method(vars(cls)[name], kind))
+
+    def uninstall(self):
+        for (owner, name), value in self.installed.items():
+            setattr(sys.modules[owner] if isinstance(owner, str) else owner, name, value)
+        self.installed.clear()
+
+    def frame_begin(self):
+        self.calls.clear()
+        self.seconds.clear()
+        self.frame += 1
+        self.current = dict(frame=self.frame, start=time.perf_counter(), passes={})
+
+    def frame_end(self):
+        record, self.current = self.current, None
+        if record is None:
+            return
+        wall = time.perf_counter() - record.pop("start")
+        gl = sum(self.seconds.values())
+        record["wall_ms"] = wall * 1000.0
+        record["python_ms"] = (wall - gl) * 1000.0
+        for kind in KINDS:
+            record[kind + "_calls"] = self.calls[kind]
+            record[kind + "_ms"] = self.seconds[kind] * 1000.0
+        self.records.append(record)
+        self.collect()
+
+    @contextmanager
+    def gpu_pass(self, name):
+        """ time what is drawn inside on the GPU, if timer queries work """
+        if self.timer_queries is None:
+            self.timer_queries = have_timer_query()
+        if not self.timer_queries or self.current is None:
+            yield
+            return
+        if self.free_queries:
+            query = self.free_queries.pop()
+        else:
+            query = GLuint(0)
+            glGenQueries(1, byref(query))
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        try:
+            yield
+        finally:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.pending.append((self.current, name, query))
+
+    def collect(self):
+        """ gather the results of timer queries that have finished """
+        ready, result = GLint(0), GLuint64(0)
+        waiting = []
+        for record, name, query in self.pending:
+            glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, byref(ready))
+            if ready.value:
+                glGetQueryObjectui64v(query, GL_QUERY_RESULT, byref(result))
+                # llvmpipe times a pass begun before anything has been
+                # drawn in the context from its clock's zero, millions of
+                # ms that would swamp summary()'s averages; in a game only
+                # the first profiled frame can be that pass
+                if record["frame"] > 1:
+                    record["passes"][name] = record["passes"].get(name, 0.0) + result.value / 1e6
+                self.free_queries.append(query)
+            else:
+                waiting.append((record, name, query))
+        self.pending = waiting
+
+    def delete(self):
+        """ free the query objects; call with the context current """
+        queries = self.free_queries + [q for r, n, q in self.pending]
+        for query in queries:
+            glDeleteQueries(1, byref(query))
+        self.free_queries, self.pending = [], []
+
+    def summary(self, frames=60):
+        """ averages over the last frames: {column: value} """
+        recent = list(self.records)[-frames:]
+        if not recent:
+            return {}
+        totals = defaultdict(float)
+        for record in recent:
+            for key, value in record.items():
+                if key == "passes":
+                    for name, ms in value.items():
+                        totals["gpu_" + name + "_ms"] += ms
+                elif key != "frame":
+                    totals[key] += value
+        return dict((key, value / len(recent)) for key, value in totals.items())
+
+    def text(self, frames=60):
+        """ summary() as a few lines for an overlay """
+        s = self.summary(frames)
+        if not s:
+            return ""
+        lines = ["frame {:.2f}ms  python {:.2f}ms".format(s["wall_ms"], s["python_ms"])]
+        for kind in KINDS:
+            lines.append("{:8} {:6.0f} calls {:6.2f}ms".format(
+                kind, s[kind + "_calls"], s[kind + "_ms"]))
+        for key in sorted(k for k in s if k.startswith("gpu_")):
+            lines.append("{} {:.2f}ms".format(key[4:-3] + " gpu", s[key]))
+        return "\n".join(lines)
+
+    def write_csv(self, path):
+        """ write the frames kept, one row each """
+        passes = sorted(set(name for r in self.records for name in r["passes"]))
+        columns = (["frame", "wall_ms", "python_ms"]
+                   + [kind + suffix for kind in KINDS for suffix in ("_calls", "_ms")])
+        with open(path, "w", newline="") as f:
+            out = csv.writer(f)
+            out.writerow(columns + ["gpu_" + name + "_ms" for name in passes])
+            for r in self.records:
+                out.writerow([r[c] for c in columns] + [r["passes"].get(name, "")
+                                                        for name in passes])
@@ -0,0 +1,230 @@
+"""
+ Own the GL objects: buffers, vertex arrays, shaders, programs, textures,
+ framebuffers
+
+ Deleting GL objects from __del__ calls GL whenever the garbage collector
+ runs: mid-frame, from another thread, or after the context has gone.
+ Instead, objects are released, which only queues them, and collect()
+ deletes everything queued at a safe point, the end of a frame.  The
+ classes that make GL objects (TNVMesh, TNVPiece, Shader, ShaderProgram,
+ TextureArray...) are Resources: release() them, use them in a with
+ statement, or let __del__ release them as a last resort.  Everything
+ made inside "with scope():" is released when it ends, e.g. a level's
+ meshes on leaving it.
+
+ Static buffers made by buffer() get a capacity rounded up to a size
+ class and go back to a pool when released, to be refilled with
+ glBufferSubData by the next buffer() of that class instead of generated
+ and deleted.  A pooled buffer isn't reused until POOL_DELAY frames after
+ its release, so the GPU has finished drawing from it, and the pool
+ keeps at most POOL_LIMIT bytes.
+
+ stats() and report() give the count and bytes of live objects of each
+ kind, and what is pooled and waiting to be deleted.
+
+"""
+import weakref
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+from pyglet.gl import *
+from ctypes import byref, sizeof
+
+import glstate
+
+POOL_DELAY = 3           # frames before a pooled buffer is reused
+POOL_LIMIT = 64 << 20    # bytes of buffers kept in the pool
+MIN_CAPACITY = 256       # smallest pooled buffer
+
+objects = {}     # (kind, id) -> bytes, for everything live
+pending = deque() # (kind, id, bytes) released and waiting for collect()
+pool = defaultdict(deque) # capacity -> (frame released, id)
+pooled_bytes = 0
+frame = 0
+counts = defaultdict(int) # made, reused, deleted
+scopes = []      # WeakSets of Resources made in each scope()
+
+def _delete_buffer(n):
+    glDeleteBuffers(1, byref(GLuint(n)))
+    glstate.deleted_buffer(n)
+
+def _delete_vertex_array(n):
+    glDeleteVertexArrays(1, byref(GLuint(n)))
+    glstate.deleted_vertex_array(n)
+
+def _delete_program(n):
+    glDeleteProgram(n)
+    glstate.deleted_program(n)
+
+def _delete_texture(n):
+    glDeleteTextures(1, byref(GLuint(n)))
+    glstate.deleted_texture(n)
+
+def _delete_framebuffer(n):
+    glDeleteFramebuffers(1, byref(GLuint(n)))
+
+DELETERS = {"buffer": _delete_buffer,
+            "pooled buffer": None, # goes back in the pool
+            "vertex array": _delete_vertex_array,
+            "shader": glDeleteShader,
+            "program": _delete_program,
+            "texture": _delete_texture,
+            "framebuffer": _delete_framebuffer,
+            "sync": glDeleteSync}
+
+def _id(obj):
+    return getattr(obj, "value", obj)
+
+def track(kind, obj, nbytes=0):
+    """ obj (a GL name) is a live object of kind, using nbytes """
+    objects[(kind, _id(obj))] = nbytes
+    counts["made"] += 1
+
+def resize(kind, obj, nbytes):
+    """ obj's storage is now nbytes """
+    key = (kind, _id(obj))
+    if key in objects:
+        objects[key] = nbytes
+
+def release(kind, obj):
+    """ delete obj at the next collect().  Safe to call from any thread,
+      or more than once """
+    if obj is None:
+        return
+    key = (kind, _id(obj))
+    nbytes = objects.pop(key, None)
+    if nbytes is not None:
+        pending.append((kind, key[1], nbytes))
+
+def defer(kind, obj):
+    """ delete an untracked obj (e.g. a sync) at the next collect() """
+    if obj:
+        pending.append((kind, obj, 0))
+
+def gen(kind="buffer", nbytes=0):
+    """ a new tracked buffer, vertex array, texture or framebuffer name """
+    n = GLuint(0)
+    if kind == "buffer":
+        glGenBuffers(1, byref(n))
+    elif kind == "vertex array":
+        glGenVertexArrays(1, byref(n))
+    elif kind == "texture":
+        glGenTextures(1, byref(n))
+    elif kind == "framebuffer":
+        glGenFramebuffers(1, byref(n))
+    else:
+        raise ValueError(kind)
+    track(kind, n, nbytes)
+    return n
+
+def capacity(nbytes):
+    """ the size class for nbytes: quarter steps between powers of two """
+    if nbytes <= MIN_CAPACITY:
+        return MIN_CAPACITY
+    step = 1 << (nbytes.bit_length() - 3)
+    return -(-nbytes // step) * step
+
+def buffer(target, data, usage=GL_STATIC_DRAW):
+    """ a buffer holding data (a ctypes array, see tnvmesh.gl_array()),
+      from the pool if one of its size class is free """
+    global pooled_bytes
+    nbytes = sizeof(data)
+    size = capacity(nbytes)
+    free = pool.get(size)
+    if free and free[0][0] <= frame - POOL_DELAY:
+        n = GLuint(free.popleft()[1])
+        pooled_bytes -= size
+        counts["reused"] += 1
+        glstate.bind_buffer(target, n)
+    else:
+        n = GLuint(0)
+        glGenBuffers(1, byref(n))
+        glstate.bind_buffer(target, n)
+        glBufferData(target, size, None, usage)
+    objects[("pooled buffer", n.value)] = size
+    counts["made"] += 1
+    if nbytes:
+        glBufferSubData(target, 0, nbytes, byref(data))
+    return n
+
+def collect():
+    """ delete what has been released; call once a frame with the
+      context current, e.g. after drawing """
+    global frame, pooled_bytes
+    while pending:
+        kind, n, nbytes = pending.popleft()
+        if kind == "pooled buffer":
+            pool[nbytes].append((frame, n))
+            pooled_bytes += nbytes
+        else:
+            DELETERS[kind](n)
+            counts["deleted"] += 1
+    # trim the pool, oldest first
+    while pooled_bytes > POOL_LIMIT:
+        size, free = min(((size, free) for size, free in pool.items() if free),
+                         key=lambda item: item[1][0][0])
+        _delete_buffer(free.popleft()[1])
+        pooled_bytes -= size
+        counts["deleted"] += 1
+    frame += 1
+
+def clear_pool():
+    """ delete every pooled buffer, e.g. between levels """
+    global pooled_bytes
+    for size, free in pool.items():
+        while free:
+            _delete_buffer(free.popleft()[1])
+            counts["deleted"] += 1
+    pooled_bytes = 0
+
+def stats():
+    """ {kind: {"count": n, "bytes": b}} of live objects, with "pooled"
+      and "pending" """
+    result = defaultdict(lambda: dict(count=0, bytes=0))
+    for (kind, n), nbytes in list(objects.items()):
+        kind = "buffer" if kind == "pooled buffer" else kind
+        result[kind]["count"] += 1
+        result[kind]["bytes"] += nbytes
+    result["pooled"] = dict(count=sum(len(free) for free in pool.values()),
+                            bytes=pooled_bytes)
+    result["pending"] = dict(count=len(pending), bytes=sum(p[2] for p in list(pending)))
+    return dict(result)
+
+def report():
+    """ stats() as lines of text """
+    return "\n".join("{:>14}: {:6d} {:10.1f} KiB".format(kind, s["count"], s["bytes"] / 1024.0)
+                     for kind, s in sorted(stats().items()))
+
+@contextmanager
+def scope():
+    """ release the Resources made inside, that are still alive, at the end """
+    made = weakref.WeakSet()
+    scopes.append(made)
+    try:
+        yield made
+    finally:
+        scopes.remove(made)
+        for resource in list(made):
+            resource.release()
+
+class Resource:
+    """ something owning GL objects, which release() gives up """
+    def owned(self):
+        """ call from __init__ so that scope() knows about it """
+        if scopes:
+            scopes[-1].add(self)
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass # at exit, modules may already be gone
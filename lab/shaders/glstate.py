@@ -0,0 +1,161 @@
+"""
+ Remember the GL state we have set, and skip calls that change nothing
+
+ ShaderProgram, TNVMesh and friends bind programs, buffers, textures and
+ vertex array objects through here, and windows enable capabilities through
+ here, so rebinding what is already bound costs a dictionary lookup
+ instead of a ctypes call.  issued and elided count the calls made and
+ skipped, by GL function name.
+
+ Only one context is tracked.  Anything that changes this state behind
+ our back (pyglet's own drawing, glPopClientAttrib...) must be followed
+ by reset(), and restore() puts the defaults back before handing over to
+ such code.
+
+"""
+from collections import Counter
+
+from pyglet.gl import *
+
+issued = Counter()
+elided = Counter()
+
+# current state; None or a missing key means we don't know
+program = None
+vao = None
+buffers = {}  # target -> buffer, except element arrays
+elements = {} # vao -> element array buffer, which belongs to the VAO
+caps = {}     # capability -> enabled
+unit = None   # active texture unit
+textures = {} # (unit, target) -> texture
+
+def _id(obj):
+    return getattr(obj, "value", obj)
+
+def use_program(program_id):
+    global program
+    if program_id == program:
+        elided["glUseProgram"] += 1
+        return
+    glUseProgram(program_id)
+    issued["glUseProgram"] += 1
+    program = program_id
+
+def bind_vertex_array(vao_id):
+    global vao
+    vao_id = _id(vao_id)
+    if vao_id == vao:
+        elided["glBindVertexArray"] += 1
+        return
+    glBindVertexArray(vao_id)
+    issued["glBindVertexArray"] += 1
+    vao = vao_id
+
+def bind_buffer(target, buf):
+    buf = _id(buf)
+    if target == GL_ELEMENT_ARRAY_BUFFER:
+        bound, key = elements, vao
+    else:
+        bound, key = buffers, target
+    if key is not None and bound.get(key) == buf:
+        elided["glBindBuffer"] += 1
+        return
+    glBindBuffer(target, buf)
+    issued["glBindBuffer"] += 1
+    if key is not None:
+        bound[key] = buf
+
+def bind_texture(target, texture, texunit=GL_TEXTURE0):
+    global unit
+    texture = _id(texture)
+    if textures.get((texunit, target)) == texture:
+        elided["glBindTexture"] += 1
+        return
+    if texunit != unit:
+        glActiveTexture(texunit)
+        issued["glActiveTexture"] += 1
+        unit = texunit
+    glBindTexture(target, texture)
+    issued["glBindTexture"] += 1
+    textures[(texunit, target)] = texture
+
+def enable(cap):
+    if caps.get(cap) is True:
+        elided["glEnable"] += 1
+        return
+    glEnable(cap)
+    issued["glEnable"] += 1
+    caps[cap] = True
+
+def disable(cap):
+    if caps.get(cap) is False:
+        elided["glDisable"] += 1
+        return
+    glDisable(cap)
+    issued["glDisable"] += 1
+    caps[cap] = False
+
+def deleted_buffer(buf):
+    """ call after glDeleteBuffers, which unbinds the buffer """
+    buf = _id(buf)
+    for target, value in list(buffers.items()):
+        if value == buf:
+            buffers[target] = 0
+    for key, value in list(elements.items()):
+        if value == buf:
+            if key == vao:
+                elements[key] = 0
+            else: # other VAOs still refer to it; rebind next time
+                del elements[key]
+
+def deleted_vertex_array(vao_id):
+    """ call after glDeleteVertexArrays """
+    global vao
+    vao_id = _id(vao_id)
+    elements.pop(vao_id, None)
+    if vao == vao_id:
+        vao = 0
+
+def deleted_program(program_id):
+    """ call after glDeleteProgram """
+    global program
+    if program == program_id:
+        program = None
+
+def forget_buffers():
+    """ the buffer bindings have been changed by someone else """
+    buffers.clear()
+    elements.clear()
+
+def deleted_texture(texture):
+    """ call after glDeleteTextures """
+    texture = _id(texture)
+    for key, value in list(textures.items()):
+        if value == texture:
+            textures[key] = 0
+
+def reset():
+    """ forget everything, after GL code that doesn't use this module """
+    global program, vao, unit
+    program = vao = unit = None
+    buffers.clear()
+    elements.clear()
+    caps.clear()
+    textures.clear()
+
+def restore():
+    """ unbind our program, vertex array and buffers, ready for GL code
+    that doesn't use this module """
+    use_program(0)
+    bind_vertex_array(0)
+    bind_buffer(GL_ARRAY_BUFFER, 0)
+    bind_buffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+def stats():
+    """ {GL function name: (issued, elided)} """
+    return dict((name, (issued[name], elided[name]))
+                for name in sorted(set(issued) | set(elided)))
+
+def reset_counters():
+    issued.clear()
+    elided.clear()
@@ -0,0 +1,452 @@
+"""
+ Lighting by many point lights (torches)
+
+ DeferredLighting draws the scene once into a G-buffer (a framebuffer
+ with albedo, normal and depth textures), then lights every pixel in a
+ full-screen pass.  Lights aren't all tested at every pixel: the view
+ is cut into clusters, TILE x TILE pixel tiles times SLICES depth slices
+ spaced exponentially from near to far, and cluster_lights() lists the
+ lights whose spheres reach each cluster, with numpy, on the CPU.  The
+ lists go to the GPU as integer textures:
+
+   clusters       RG32I, tiles_x wide, tiles_y * SLICES high:
+                  (first, count) in light_indices
+   light_indices  R32I, INDEX_WIDTH wide: light numbers, cluster by cluster
+   lights         RGBA32F, 2 wide, a row per light: view-space position
+                  and radius, then colour
+
+ ForwardLighting is the fallback where there are no framebuffers or
+ integer textures: ordinary #version 130 shaders that add up to
+ max_lights lights per fragment, the brightest near the camera, from
+ uniform arrays.
+
+ Both are used the same way each frame:
+
+   lighting.frame(lights, projection, modelview) # numpy, row-major
+   lighting.begin()
+   ...draw the scene with lighting.program, setting "colour" and
+      "texturing" (see SURFACE_GLSL)...
+   lighting.end()
+
+ make_lighting() picks whichever the context can do.
+
+"""
+import math
+import time
+from ctypes import byref, POINTER
+
+import numpy as np
+from pyglet.gl import *
+
+import glstate
+import glresources
+from glresources import Resource
+from shaders import Shader, ShaderProgram
+
+TILE = 32          # pixels square
+SLICES = 16        # depth slices
+INDEX_WIDTH = 1024 # texels in each row of light_indices
+MAX_FORWARD_LIGHTS = 8
+LAYERS_UNIT = 1    # texture unit for a TextureArray, with texturing=2
+
+# what both kinds of lighting draw: colour, times (texturing 1) the
+# texture on unit 0 or (texturing 2) the layer of the TextureArray on
+# unit LAYERS_UNIT given by the mesh's L attribute, at texture coordinate T
+SURFACE_GLSL = b"""
+uniform vec4 colour = vec4(1.0);
+uniform int texturing = 0;
+uniform sampler2D image;
+uniform sampler2DArray textures;
+smooth in float surface_layer;
+
+vec4 surface()
+{
+  if (texturing == 1)
+    return colour * texture(image, gl_TexCoord[0].st);
+  if (texturing == 2)
+    return colour * texture(textures, vec3(gl_TexCoord[0].st, surface_layer));
+  return colour;
+}
+"""
+
+GBUFFER_VSHADER = b"""
+#version 130
+in float layer;
+smooth out vec3 normal;
+smooth out float surface_layer;
+
+void main()
+{
+  normal = gl_NormalMatrix * gl_Normal;
+  gl_TexCoord[0] = gl_MultiTexCoord0;
+  surface_layer = layer;
+  gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+}
+"""
+
+GBUFFER_FSHADER = b"#version 130\n" + SURFACE_GLSL + b"""
+smooth in vec3 normal;
+
+void main()
+{
+  gl_FragData[0] = surface();
+  gl_FragData[1] = vec4(normalize(normal) * 0.5 + 0.5, 1.0);
+}
+"""
+
+QUAD_VSHADER = b"""
+#version 130
+void main()
+{
+  gl_Position = gl_Vertex;
+}
+"""
+
+LIGHT_FSHADER = b"""
+#version 130
+uniform sampler2D albedo_texture;
+uniform sampler2D normal_texture;
+uniform sampler2D depth_texture;
+uniform sampler2D lights;
+uniform isampler2D clusters;
+uniform isampler2D light_indices;
+uniform mat4 inverse_projection;
+uniform vec2 viewport;
+uniform vec3 ambient = vec3(0.05);
+uniform float near;
+uniform float far;
+uniform int tile;
+uniform int tiles_y;
+uniform int slices;
+uniform int index_width;
+
+void main()
+{
+  ivec2 pixel = ivec2(gl_FragCoord.xy);
+  vec4 albedo = texelFetch(albedo_texture, pixel, 0);
+  float depth = texelFetch(depth_texture, pixel, 0).r;
+  gl_FragDepth = depth;
+  if (depth == 1.0) { // background
+    gl_FragColor = albedo;
+    return;
+  }
+  vec3 n = normalize(texelFetch(normal_texture, pixel, 0).xyz * 2.0 - 1.0);
+  vec4 v = inverse_projection * vec4(gl_FragCoord.xy / viewport * 2.0 - 1.0,
+                                     depth * 2.0 - 1.0, 1.0);
+  vec3 p = v.xyz / v.w;
+  int slice = int(clamp(log(-p.z / near) / log(far / near) * float(slices),
+                        0.0, float(slices - 1)));
+  ivec2 cluster = texelFetch(clusters, ivec2(pixel.x / tile,
+                                             pixel.y / tile + slice * tiles_y), 0).xy;
+  vec3 light = ambient;
+  for (int i = cluster.x; i < cluster.x + cluster.y; i++) {
+    int index = texelFetch(light_indices, ivec2(i % index_width, i / index_width), 0).r;
+    vec4 sphere = texelFetch(lights, ivec2(0, index), 0);
+    vec3 to_light = sphere.xyz - p;
+    float d = length(to_light);
+    float falloff = clamp(1.0 - d * d / (sphere.w * sphere.w), 0.0, 1.0);
+    light += texelFetch(lights, ivec2(1, index), 0).rgb * falloff * falloff
+             * max(dot(n, to_light / d), 0.0);
+  }
+  gl_FragColor = vec4(albedo.rgb * light, albedo.a);
+}
+"""
+
+FORWARD_VSHADER = b"""
+#version 130
+in float layer;
+smooth out vec3 position;
+smooth out vec3 normal;
+smooth out float surface_layer;
+
+void main()
+{
+  position = (gl_ModelViewMatrix * gl_Vertex).xyz;
+  normal = gl_NormalMatrix * gl_Normal;
+  gl_TexCoord[0] = gl_MultiTexCoord0;
+  surface_layer = layer;
+  gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+}
+"""
+
+FORWARD_FSHADER = b"#version 130\n" + SURFACE_GLSL + b"""
+uniform vec3 ambient = vec3(0.05);
+uniform int nlights = 0;
+uniform vec4 light_sphere[MAX_LIGHTS]; // view-space position, radius
+uniform vec3 light_colour[MAX_LIGHTS];
+smooth in vec3 position;
+smooth in vec3 normal;
+
+void main()
+{
+  vec3 n = normalize(normal);
+  vec3 light = ambient;
+  for (int i = 0; i < nlights; i++) {
+    vec3 to_light = light_sphere[i].xyz - position;
+    float d = length(to_light);
+    float r = light_sphere[i].w;
+    float falloff = clamp(1.0 - d * d / (r * r), 0.0, 1.0);
+    light += light_colour[i] * falloff * falloff * max(dot(n, to_light / d), 0.0);
+  }
+  vec4 albedo = surface();
+  gl_FragColor = vec4(albedo.rgb * light, albedo.a);
+}
+"""
+
+class Lights:
+    """ point lights: world positions, radii (where they fade to
+      nothing) and colours, as numpy arrays to change freely """
+    def __init__(self, positions=(), radii=(), colours=()):
+        self.positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+        self.radii = np.array(radii, dtype=np.float32).reshape(-1)
+        self.colours = np.array(colours, dtype=np.float32).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.radii)
+
+    def add(self, position, radius, colour=(1.0, 0.8, 0.5)):
+        self.positions = np.vstack((self.positions, np.float32(position)))
+        self.radii = np.append(self.radii, np.float32(radius))
+        self.colours = np.vstack((self.colours, np.float32(colour)))
+        return len(self) - 1
+
+    def view_positions(self, modelview):
+        return self.positions @ modelview[:3, :3].T + modelview[:3, 3]
+
+def depth_range(projection):
+    """ (near, far) distances of a perspective projection """
+    a, b = projection[2, 2], projection[2, 3]
+    return b / (a - 1.0), b / (a + 1.0)
+
+def slice_of(depth, near, far, slices=SLICES):
+    """ the depth slice of view distances (like LIGHT_FSHADER's) """
+    s = np.log(np.maximum(depth, near) / near) / math.log(far / near) * slices
+    return np.clip(np.floor(s), 0, slices - 1).astype(np.int64)
+
+# corners of a cube round the origin, for a sphere's bounding box
+CORNERS = np.array([(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)],
+                   dtype=np.float64)
+
+def light_bounds(centres, radii, projection, width, height, tile=TILE, slices=SLICES):
+    """ for view-space light spheres, which can be seen, and the inclusive
+      tile and slice ranges they reach: (visible, x0, x1, y0, y1, s0, s1) """
+    near, far = depth_range(projection)
+    tiles_x, tiles_y = -(-width // tile), -(-height // tile)
+    depth = -centres[:, 2]
+    visible = (depth + radii > near) & (depth - radii < far)
+    # the bounding box corners on the screen; a box reaching behind the
+    # eye could be anywhere
+    corners = centres[:, None, :] + radii[:, None, None] * CORNERS
+    clip = corners @ projection[:, :3].T + projection[:, 3]
+    w = clip[:, :, 3]
+    behind = (w <= 1e-6).any(axis=1)
+    ndc = clip[:, :, :2] / np.where(w > 1e-6, w, 1.0)[:, :, None]
+    lo = np.where(behind[:, None], -1.0, ndc.min(axis=1))
+    hi = np.where(behind[:, None], 1.0, ndc.max(axis=1))
+    visible &= (hi > -1.0).all(axis=1) & (lo < 1.0).all(axis=1)
+    size = np.array((width, height), dtype=np.float64)
+    first = np.floor((np.clip(lo, -1.0, 1.0) * 0.5 + 0.5) * size / tile).astype(np.int64)
+    last = np.floor((np.clip(hi, -1.0, 1.0) * 0.5 + 0.5) * size / tile).astype(np.int64)
+    first = np.minimum(first, (tiles_x - 1, tiles_y - 1))
+    last = np.minimum(last, (tiles_x - 1, tiles_y - 1))
+    s0 = slice_of(depth - radii, near, far, slices)
+    s1 = slice_of(depth + radii, near, far, slices)
+    return visible, first[:, 0], last[:, 0], first[:, 1], last[:, 1], s0, s1
+
+def cluster_lights(centres, radii, projection, width, height, tile=TILE, slices=SLICES):
+    """ bin view-space light spheres into clusters: (grid, indices) where
+      grid is (slices * tiles_y, tiles_x, 2) int32 of (first, count) in
+      indices, which are light numbers grouped by cluster """
+    tiles_x, tiles_y = -(-width // tile), -(-height // tile)
+    nclusters = tiles_x * tiles_y * slices
+    visible, x0, x1, y0, y1, s0, s1 = light_bounds(
+        np.asarray(centres, dtype=np.float64), np.asarray(radii, dtype=np.float64),
+        projection, width, height, tile, slices)
+    which = np.nonzero(visible)[0]
+    x0, y0, s0 = x0[which], y0[which], s0[which]
+    wx, wy = x1[which] - x0 + 1, y1[which] - y0 + 1
+    sizes = wx * wy * (s1[which] - s0 + 1)
+    total = int(sizes.sum())
+    # one entry for each (light, cluster) pair
+    owner = np.repeat(np.arange(len(which)), sizes)
+    local = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    wx, wy = wx[owner], wy[owner]
+    cluster = (((s0[owner] + local // (wx * wy)) * tiles_y
+                + y0[owner] + local // wx % wy) * tiles_x
+               + x0[owner] + local % wx)
+    order = np.argsort(cluster, kind="stable")
+    indices = which[owner[order]].astype(np.int32)
+    counts = np.bincount(cluster, minlength=nclusters)
+    grid = np.empty((nclusters, 2), dtype=np.int32)
+    grid[:, 0] = np.cumsum(counts) - counts
+    grid[:, 1] = counts
+    return grid.reshape(slices * tiles_y, tiles_x, 2), indices
+
+def _texture(kind="texture"):
+    texture = glresources.gen(kind)
+    glstate.bind_texture(GL_TEXTURE_2D, texture)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    return texture
+
+def _upload(texture, internal, width, height, fmt, gltype, data):
+    glstate.bind_texture(GL_TEXTURE_2D, texture)
+    pointer = None if data is None else data.ctypes.data_as(POINTER(GLubyte))
+    glTexImage2D(GL_TEXTURE_2D, 0, internal, width, height, 0, fmt, gltype, pointer)
+
+def have_deferred():
+    """ can the context do DeferredLighting? """
+    return gl_info.have_version(3, 0)
+
+class DeferredLighting(Resource):
+    def __init__(self, width, height, tile=TILE, slices=SLICES):
+        self.tile, self.slices = tile, slices
+        self.program = ShaderProgram(Shader(GBUFFER_VSHADER, GL_VERTEX_SHADER),
+                                     Shader(GBUFFER_FSHADER))
+        self.program.set(image=0, textures=LAYERS_UNIT)
+        self.light_program = ShaderProgram(Shader(QUAD_VSHADER, GL_VERTEX_SHADER),
+                                           Shader(LIGHT_FSHADER))
+        self.fbo = glresources.gen("framebuffer")
+        self.albedo, self.normal, self.depth = _texture(), _texture(), _texture()
+        self.lights, self.clusters, self.indices = _texture(), _texture(), _texture()
+        self.width = self.height = None
+        self.resize(width, height)
+        self.stats = dict(lights=0, visible=0, pairs=0, max_per_cluster=0, bin_ms=0.0)
+        self.owned()
+
+    def resize(self, width, height):
+        """ size the G-buffer to match the window """
+        if (width, height) == (self.width, self.height):
+            return
+        self.width, self.height = width, height
+        for texture, internal, fmt, gltype, nbytes in (
+                (self.albedo, GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE, 4),
+                (self.normal, GL_RGB10_A2, GL_RGBA, GL_UNSIGNED_BYTE, 4),
+                (self.depth, GL_DEPTH_COMPONENT24, GL_DEPTH_COMPONENT, GL_FLOAT, 4)):
+            _upload(texture, internal, width, height, fmt, gltype, None)
+            glresources.resize("texture", texture, width * height * nbytes)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.albedo, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT1, GL_TEXTURE_2D, self.normal, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, self.depth, 0)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("G-buffer incomplete: 0x%x" % status)
+
+    def frame(self, lights, projection, modelview):
+        """ bin the lights into clusters and upload them for this frame """
+        t0 = time.perf_counter()
+        centres = lights.view_positions(modelview)
+        grid, indices = cluster_lights(centres, lights.radii, projection,
+                                       self.width, self.height, self.tile, self.slices)
+        self.stats.update(lights=len(lights), pairs=len(indices),
+                          visible=len(np.unique(indices)),
+                          max_per_cluster=int(grid[:, :, 1].max()) if grid.size else 0,
+                          bin_ms=(time.perf_counter() - t0) * 1000.0)
+        table = np.zeros((max(len(lights), 1), 2, 4), dtype=np.float32)
+        table[:len(lights), 0, :3] = centres
+        table[:len(lights), 0, 3] = lights.radii
+        table[:len(lights), 1, :3] = lights.colours
+        _upload(self.lights, GL_RGBA32F, 2, len(table), GL_RGBA, GL_FLOAT, table)
+        _upload(self.clusters, GL_RG32I, grid.shape[1], grid.shape[0],
+                GL_RG_INTEGER, GL_INT, np.ascontiguousarray(grid))
+        rows = max(-(-len(indices) // INDEX_WIDTH), 1)
+        padded = np.zeros(rows * INDEX_WIDTH, dtype=np.int32)
+        padded[:len(indices)] = indices
+        _upload(self.indices, GL_R32I, INDEX_WIDTH, rows, GL_RED_INTEGER, GL_INT, padded)
+        for texture, nbytes in ((self.lights, table.nbytes), (self.clusters, grid.nbytes),
+                                (self.indices, padded.nbytes)):
+            glresources.resize("texture", texture, nbytes)
+        near, far = depth_range(projection)
+        self.light_program.set(
+            albedo_texture=0, normal_texture=1, depth_texture=2, lights=3,
+            clusters=4, light_indices=5, near=near, far=far, tile=self.tile,
+            tiles_y=-(-self.height // self.tile), slices=self.slices,
+            index_width=INDEX_WIDTH, viewport=(self.width, self.height),
+            inverse_projection=np.linalg.inv(projection))
+
+    def begin(self):
+        """ draw into the G-buffer until end() """
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glDrawBuffers(2, (GLenum * 2)(GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1))
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+    def end(self, target=0):
+        """ light the G-buffer into framebuffer target, depth included """
+        glBindFramebuffer(GL_FRAMEBUFFER, target)
+        glstate.restore()
+        # units last to first, so unit 0 is left active for others
+        for unit, texture in reversed(list(enumerate(
+                (self.albedo, self.normal, self.depth, self.lights,
+                 self.clusters, self.indices)))):
+            glstate.bind_texture(GL_TEXTURE_2D, texture, GL_TEXTURE0 + unit)
+        self.light_program.use()
+        depth_func = GLint()
+        glGetIntegerv(GL_DEPTH_FUNC, byref(depth_func))
+        glDepthFunc(GL_ALWAYS)
+        glRectf(-1.0, -1.0, 1.0, 1.0)
+        glDepthFunc(depth_func.value)
+        glstate.restore()
+
+    def release(self):
+        for name in ("albedo", "normal", "depth", "lights", "clusters", "indices"):
+            glresources.release("texture", getattr(self, name, None))
+            setattr(self, name, None)
+        glresources.release("framebuffer", getattr(self, "fbo", None))
+        self.fbo = None
+        for name in ("program", "light_program"):
+            program = getattr(self, name, None)
+            if program is not None:
+                program.release()
+
+class ForwardLighting(Resource):
+    def __init__(self, max_lights=MAX_FORWARD_LIGHTS):
+        self.max_lights = max_lights
+        source = FORWARD_FSHADER.replace(b"#version 130\n", b"#version 130\n#define MAX_LIGHTS %d\n"
+                                         % max_lights)
+        self.program = ShaderProgram(Shader(FORWARD_VSHADER, GL_VERTEX_SHADER), Shader(source))
+        self.program.set(image=0, textures=LAYERS_UNIT)
+        self.stats = dict(lights=0, visible=0, bin_ms=0.0)
+        self.owned()
+
+    def resize(self, width, height):
+        pass
+
+    def frame(self, lights, projection, modelview):
+        """ choose the lights that matter most here and set them """
+        t0 = time.perf_counter()
+        centres = lights.view_positions(modelview)
+        # roughly, how bright each is at the eye, for those in view
+        visible = light_bounds(centres.astype(np.float64), lights.radii.astype(np.float64),
+                               projection, 1, 1, 1, 1)[0]
+        distance = np.maximum(np.linalg.norm(centres, axis=1) - lights.radii, 0.1)
+        strength = np.where(visible, lights.colours.sum(axis=1) / distance ** 2, -1.0)
+        chosen = np.argsort(-strength)[:min(self.max_lights, int(visible.sum()))]
+        spheres = np.zeros((self.max_lights, 4), dtype=np.float32)
+        colours = np.zeros((self.max_lights, 3), dtype=np.float32)
+        spheres[:len(chosen), :3] = centres[chosen]
+        spheres[:len(chosen), 3] = lights.radii[chosen]
+        colours[:len(chosen)] = lights.colours[chosen]
+        self.program.set(nlights=len(chosen), light_sphere=spheres, light_colour=colours)
+        self.stats.update(lights=len(lights), visible=len(chosen),
+                          bin_ms=(time.perf_counter() - t0) * 1000.0)
+
+    def begin(self):
+        pass
+
+    def end(self, target=0):
+        pass
+
+    def release(self):
+        program = getattr(self, "program", None)
+        if program is not None:
+            program.release()
+
+def make_lighting(width, height, forward=False):
+    """ DeferredLighting if the context can do it, else ForwardLighting """
+    if not forward and have_deferred():
+        return DeferredLighting(width, height)
+    return ForwardLighting()
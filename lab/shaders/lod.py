@@ -0,0 +1,244 @@
+"""
+ Levels of detail for props, by distance from the camera
+
+ lod_data() adds lower detail copies of a mesh's pieces, made offline by
+ meshopt.simplify(), as more pieces named "piece@1", "piece@2"... (see
+ tnvmesh.lod_name()) in the same index buffer, using the same vertices.
+ The result can go through a MeshCache like any other MeshData.
+
+ An LODSelector picks each object's level every frame from its distance:
+ level i+1 starts at distances[i].  To stop objects near a boundary
+ flickering between levels as the camera bobs, an object only moves to a
+ coarser level once it is hysteresis (a fraction) beyond the boundary,
+ and back once it is that far inside.  Past the last distance, objects
+ can be drawn as an Impostor: pictures of the mesh taken from a ring of
+ directions, shown on a quad turned towards the camera.
+
+   selector = LODSelector((6.0, 14.0), impostor=30.0)
+   ...each frame:
+   selector.begin_frame()
+   for prop in props:
+       selector.draw(prop, mesh, prop.position, eye, impostor=impostor)
+   impostor.flush()
+   log(selector.report())
+
+ stats counts, for the frame, the triangles the objects would have cost
+ at full detail, those drawn, and so those saved.
+
+"""
+import math
+from ctypes import POINTER
+
+import numpy as np
+from pyglet.gl import *
+
+import glstate
+import glresources
+from glresources import Resource
+from tnvmesh import MeshData, attribute_offsets, lod_name
+from meshopt import simplify, position_columns
+
+RATIOS = (0.5, 0.2)      # triangles kept at each lower level
+DISTANCES = (8.0, 16.0)  # where each lower level starts
+HYSTERESIS = 0.1
+IMPOSTOR_SIZE = 64       # pixels square of each view
+IMPOSTOR_VIEWS = 8       # directions around the z axis
+
+def lod_data(meshdata, ratios=RATIOS):
+    """ meshdata with a copy of each triangle or quad piece for each of
+      ratios, simplified to that fraction of the full detail triangles """
+    pieces = dict(meshdata.pieces)
+    for level, ratio in enumerate(ratios, 1):
+        simpler = simplify(meshdata, ratio)
+        for name, piece in simpler.pieces.items():
+            if piece[1] == GL_TRIANGLES:
+                pieces[lod_name(name, level)] = piece
+    return MeshData(meshdata.vertexdata, meshdata.order, pieces)
+
+def bounding_sphere(meshdata):
+    """ (centre, radius) around the vertices: centre of the box """
+    floats = attribute_offsets(meshdata.order)[0] // 4
+    points = np.asarray(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+    points = points[:, position_columns(meshdata.order)]
+    if not len(points):
+        return np.zeros(3), 0.0
+    centre = (points.min(0) + points.max(0)) / 2.0
+    return centre, float(np.sqrt(((points - centre) ** 2).sum(1).max()))
+
+class LODSelector:
+    def __init__(self, distances=DISTANCES, hysteresis=HYSTERESIS, impostor=None):
+        """ level i+1 from distances[i] on; with an impostor distance,
+          the level after the last is drawn by an Impostor """
+        self.distances = tuple(distances) + ((impostor,) if impostor else ())
+        self.impostor_level = len(self.distances) if impostor else None
+        self.hysteresis = hysteresis
+        self.levels = {} # object -> level last frame
+        self.begin_frame()
+
+    def level(self, key, distance):
+        """ the detail level for object key at distance """
+        bounds = self.distances
+        level = self.levels.get(key)
+        if level is None:
+            level = sum(1 for d in bounds if distance >= d)
+        else:
+            while level < len(bounds) and distance > bounds[level] * (1.0 + self.hysteresis):
+                level += 1
+            while level > 0 and distance < bounds[level - 1] * (1.0 - self.hysteresis):
+                level -= 1
+        self.levels[key] = level
+        return level
+
+    def forget(self, key):
+        """ key is gone (e.g. a prop destroyed) """
+        self.levels.pop(key, None)
+
+    def begin_frame(self):
+        self.stats = dict(objects=0, full=0, drawn=0, saved=0, impostors=0,
+                          levels=[0] * (len(self.distances) + 1))
+
+    def draw(self, key, mesh, position, eye, pieces=None, program=None, impostor=None):
+        """ draw object key: mesh (with pieces at full detail), translated
+          to position, at the level for its distance from eye.  Returns
+          the level """
+        distance = math.sqrt(sum((p - e) ** 2 for p, e in zip(position, eye)))
+        level = self.level(key, distance)
+        full = mesh.triangles(mesh.lod_pieces(0, pieces))
+        if level == self.impostor_level and impostor is not None:
+            impostor.draw(position, eye)
+            drawn = 2
+            self.stats["impostors"] += 1
+        else:
+            names = mesh.lod_pieces(level, pieces)
+            glPushMatrix()
+            glTranslatef(*position)
+            mesh.draw(names, program)
+            glPopMatrix()
+            drawn = mesh.triangles(names)
+        stats = self.stats
+        stats["objects"] += 1
+        stats["full"] += full
+        stats["drawn"] += drawn
+        stats["saved"] += full - drawn
+        stats["levels"][level] += 1
+        return level
+
+    def report(self):
+        """ this frame's stats as a line of text """
+        s = self.stats
+        return "LOD: {} objects {} levels, {} of {} triangles drawn, {} saved ({:.0f}%)".format(
+            s["objects"], s["levels"], s["drawn"], s["full"], s["saved"],
+            100.0 * s["saved"] / s["full"] if s["full"] else 0.0)
+
+
+class Impostor(Resource):
+    """ a mesh photographed from views directions around the z axis into
+      one texture, each view size pixels square, to be drawn on quads
+      facing the camera.  draw_mesh(mesh) draws it for the pictures; by
+      default with fixed-function lighting from the camera """
+    def __init__(self, mesh, centre, radius, size=IMPOSTOR_SIZE, views=IMPOSTOR_VIEWS,
+                 draw_mesh=None):
+        self.centre = np.asarray(centre, dtype=np.float32)
+        self.radius = radius
+        self.size, self.views = size, views
+        self.quads = [] # queued by draw() for flush()
+        self.texture = glresources.gen("texture", size * views * size * 4)
+        glstate.bind_texture(GL_TEXTURE_2D, self.texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, size * views, size, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        self.capture(mesh, draw_mesh)
+        self.owned()
+
+    def capture(self, mesh, draw_mesh=None):
+        """ (re)take the pictures """
+        size, r = self.size, self.radius
+        depth = glresources.gen("texture")
+        glstate.bind_texture(GL_TEXTURE_2D, depth)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT24, size * self.views, size, 0,
+                     GL_DEPTH_COMPONENT, GL_FLOAT, None)
+        fbo = glresources.gen("framebuffer")
+        glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, depth, 0)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+            raise RuntimeError("impostor framebuffer incomplete: 0x%x" % status)
+        glPushAttrib(GL_ENABLE_BIT | GL_LIGHTING_BIT | GL_VIEWPORT_BIT |
+                     GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glClearColor(0.0, 0.0, 0.0, 0.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glEnable(GL_DEPTH_TEST)
+        if draw_mesh is None:
+            glEnable(GL_LIGHTING)
+            glEnable(GL_LIGHT0) # from the camera
+            glEnable(GL_COLOR_MATERIAL)
+            glColor4f(1.0, 1.0, 1.0, 1.0)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(-r, r, -r, r, 0.0, 4.0 * r)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        cx, cy, cz = (float(c) for c in self.centre)
+        for view in range(self.views):
+            glViewport(view * size, 0, size, size)
+            angle = 2.0 * math.pi * view / self.views
+            glLoadIdentity()
+            gluLookAt(cx + 2.0 * r * math.cos(angle), cy + 2.0 * r * math.sin(angle), cz,
+                      cx, cy, cz, 0.0, 0.0, 1.0)
+            if draw_mesh is None:
+                mesh.draw()
+            else:
+                draw_mesh(mesh)
+        glstate.restore()
+        glPopMatrix()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopAttrib()
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glresources.release("framebuffer", fbo)
+        glresources.release("texture", depth)
+
+    def draw(self, position, eye):
+        """ queue the quad for a copy at position, seen from eye, for flush() """
+        cx, cy, cz = (float(p) + c for p, c in zip(position, self.centre))
+        angle = math.atan2(eye[1] - cy, eye[0] - cx)
+        view = int(round(angle * self.views / (2.0 * math.pi))) % self.views
+        # the quad faces the camera, turning about z only like the pictures
+        rx, ry = -math.sin(angle) * self.radius, math.cos(angle) * self.radius
+        r = self.radius
+        u0, u1 = view / float(self.views), (view + 1) / float(self.views)
+        self.quads.append((u0, 0.0, cx - rx, cy - ry, cz - r,
+                           u1, 0.0, cx + rx, cy + ry, cz - r,
+                           u1, 1.0, cx + rx, cy + ry, cz + r,
+                           u0, 1.0, cx - rx, cy - ry, cz + r))
+
+    def flush(self):
+        """ draw the queued quads in one call """
+        if not self.quads:
+            return
+        data = np.array(self.quads, dtype=np.float32)
+        self.quads = []
+        glstate.restore()
+        glstate.bind_texture(GL_TEXTURE_2D, self.texture)
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT)
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glEnable(GL_TEXTURE_2D)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_CULL_FACE)
+        glEnable(GL_ALPHA_TEST)
+        glAlphaFunc(GL_GREATER, 0.5)
+        glInterleavedArrays(GL_T2F_V3F, 0, data.ctypes.data_as(POINTER(GLfloat)))
+        glDrawArrays(GL_QUADS, 0, len(data) * 4)
+        glPopClientAttrib()
+        glPopAttrib()
+
+    def release(self):
+        glresources.release("texture", getattr(self, "texture", None))
+        self.texture = None
@@ -0,0 +1,142 @@
+"""
+ Merge lots of static meshes into a few big ones
+
+ Level geometry is made of many copies of a few shapes (walls, floor tiles).
+ Drawn as separate TNVMesh objects, each copy costs buffer binds, a client
+ attrib push/pop and a dozen pointer calls.  A MeshBatch collects the
+ MeshData for every copy, moves it into place on the CPU, and builds one
+ TNVMesh per order string in which every piece name (material group) is a
+ single TNVPiece in one shared index buffer, so the whole batch draws with
+ one glDrawElements per material group.
+
+"""
+import numpy as np
+from pyglet.gl import *
+
+from tnvmesh import TNVMesh, TNVIndexBuffer, attribute_offsets
+from meshopt import triangulate
+
+# primitives whose index lists can simply be joined end to end
+LIST_PRIMITIVES = (GL_POINTS, GL_LINES, GL_TRIANGLES, GL_QUADS)
+
+def list_indices(indices, primitive):
+    """ (indices, primitive) for a piece as a list primitive that can be
+      merged: strips and fans become GL_TRIANGLES or GL_LINES.  Raises
+      ValueError for anything else (e.g. adjacency primitives) """
+    if primitive in LIST_PRIMITIVES:
+        return np.asarray(indices, dtype=np.uint32), primitive
+    if primitive in (GL_LINE_STRIP, GL_LINE_LOOP):
+        indices = np.asarray(indices, dtype=np.uint32)
+        if primitive == GL_LINE_LOOP and len(indices) > 2:
+            indices = np.append(indices, indices[0])
+        return np.stack((indices[:-1], indices[1:]), axis=1).ravel(), GL_LINES
+    triangles = triangulate(indices, primitive)
+    if triangles is None:
+        raise ValueError("can't merge primitive 0x%x" % primitive)
+    return triangles.astype(np.uint32).ravel(), GL_TRIANGLES
+
+def translation(x, y, z):
+    """ 4x4 matrix moving points by (x, y, z) """
+    m = np.identity(4)
+    m[:3, 3] = (x, y, z)
+    return m
+
+def rotation_z(degrees):
+    """ 4x4 matrix rotating anticlockwise about the z axis, like glRotatef """
+    a = np.radians(degrees)
+    c, s = np.cos(a), np.sin(a)
+    m = np.identity(4)
+    m[:2, :2] = ((c, -s), (s, c))
+    return m
+
+def scaling(sx, sy, sz):
+    """ 4x4 matrix scaling along each axis """
+    return np.diag((sx, sy, sz, 1.0))
+
+def transform_vertices(vertices, order, matrix):
+    """ transform a (nvertices, floats per vertex) array in place:
+      V by the 4x4 matrix, N by its inverse transpose (renormalised).
+      Texture coordinates are left alone.
+    """
+    _, offsets = attribute_offsets(order)
+    if 'V' in order:
+        v = offsets['V'] // 4
+        pos = vertices[:, v:v+3]
+        pos[:] = pos @ matrix[:3, :3].T + matrix[:3, 3]
+    if 'N' in order:
+        n = offsets['N'] // 4
+        normals = vertices[:, n:n+3]
+        normals[:] = normals @ np.linalg.inv(matrix[:3, :3])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= np.where(lengths > 0.0, lengths, 1.0)
+    return vertices
+
+
+class MeshBatch:
+    """ builder for merged static geometry.
+
+      batch = MeshBatch()
+      for x, y in wall_positions:
+          batch.add(wall_data, translation(x, y, 0))
+      batch.build()
+      ...
+      batch.draw()
+    """
+    def __init__(self):
+        # order -> [vertex arrays, {name: [index arrays]}, {name: primitive}, nvertices]
+        self.groups = {}
+        self.meshes = []
+
+    def add(self, meshdata, matrix=None):
+        """ add a copy of a MeshData, transformed by a 4x4 matrix.  Strip
+          and fan pieces are merged as lists (see list_indices()).
+          Raises ValueError, adding nothing, if a piece can't be merged
+          or doesn't match the primitive of earlier pieces of that name """
+        order = meshdata.order
+        floats = attribute_offsets(order)[0] // 4
+        vertices = np.array(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+        bucket = self.groups.get(order, [[], {}, {}, 0])
+        pieces = {}
+        for name, (indices, prim) in meshdata.pieces.items():
+            indices, prim = list_indices(indices, prim)
+            if bucket[2].get(name, prim) != prim:
+                raise ValueError("piece {!r} has mixed primitives".format(name))
+            pieces[name] = (indices, prim)
+        if matrix is not None:
+            transform_vertices(vertices, order, np.asarray(matrix, dtype=np.float64))
+        self.groups[order] = bucket
+        base = bucket[3]
+        bucket[0].append(vertices)
+        for name, (indices, prim) in pieces.items():
+            bucket[2][name] = prim
+            bucket[1].setdefault(name, []).append(indices + base)
+        bucket[3] = base + len(vertices)
+
+    def build(self):
+        """ upload everything added so far, replacing any previous build.
+          Returns the list of merged TNVMesh objects, one per order string.
+        """
+        self.release()
+        self.meshes = []
+        for order, (vertex_arrays, index_lists, prims, nvertices) in self.groups.items():
+            vertices = np.concatenate(vertex_arrays)
+            indices = TNVIndexBuffer(
+                (name, (np.concatenate(arrays), prims[name]))
+                for name, arrays in index_lists.items())
+            self.meshes.append(TNVMesh(vertices, order, indices.pieces))
+        return self.meshes
+
+    def clear(self):
+        """ forget everything added and built, ready to build again """
+        self.release()
+        self.groups = {}
+        self.meshes = []
+
+    def release(self):
+        """ give up the built meshes' GL objects """
+        for mesh in self.meshes:
+            mesh.release()
+
+    def draw(self, pieces=None, program=None):
+        for mesh in self.meshes:
+            mesh.draw(pieces, program)
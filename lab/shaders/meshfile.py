@@ -0,0 +1,198 @@
+"""
+ Mesh files, and a cache of meshes built from code
+
+ A .tnvm file is
+
+   "TNVM", version (uint32), header length (uint32), all little-endian
+   a JSON header: order, stride, nvertices, vertex offset and bytes, the
+     index typecode, index offset, and pieces [name, primitive, first
+     index, nindices] in one shared index buffer
+   the interleaved float32 vertices, from a multiple of ALIGN bytes
+   the indices, likewise aligned
+
+ load() maps the file and hands slices of the map straight to
+ glBufferData; only the small header is parsed.  The map is
+ copy-on-write (ACCESS_COPY), so it is writable as far as ctypes can
+ tell and gl_array() uses it in place rather than copying.
+
+ MeshCache keeps meshes built by functions (level chunks, generated
+ props) as files named by a hash of their inputs, the function's name
+ and the function's bytecode, so they are built again only when one of
+ those changes.
+
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+from pyglet.gl import *
+
+from tnvmesh import (TNVMesh, TNVIndexBuffer, MeshData,
+                     attribute_offsets, index_typecode, index_array)
+
+MAGIC = b"TNVM"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sII")
+ALIGN = 64
+
+def aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+def save(path, meshdata):
+    """ write MeshData to path; the file appears all at once """
+    stride = attribute_offsets(meshdata.order)[0]
+    vertices = np.ascontiguousarray(meshdata.vertexdata, dtype=np.float32).ravel()
+    pieces = dict((name, (np.asarray(indices), prim))
+                  for name, (indices, prim) in meshdata.pieces.items())
+    codes = [index_typecode(indices) for indices, prim in pieces.values()]
+    typecode = max(codes, key="BHI".index) if codes else "B"
+    table = []
+    first = 0
+    for name, (indices, prim) in pieces.items():
+        table.append((name, int(prim), first, len(indices)))
+        first += len(indices)
+    indices = np.concatenate([index_array(indices, typecode) for indices, prim in pieces.values()]
+                             or [np.zeros(0, typecode)]).astype(typecode)
+    header = dict(order=meshdata.order, stride=stride, nvertices=len(vertices) * 4 // stride,
+                  vertex_bytes=vertices.nbytes, typecode=typecode, index_bytes=indices.nbytes,
+                  pieces=table)
+    # offsets depend on the header's length, which depends on the offsets;
+    # leave room for them to grow
+    header["vertex_offset"] = header["index_offset"] = 0
+    start = aligned(PREAMBLE.size + len(json.dumps(header)) + 32)
+    header["vertex_offset"] = start
+    header["index_offset"] = aligned(start + vertices.nbytes)
+    text = json.dumps(header).encode("utf-8")
+    # a temporary file of its own, so writers racing on a path don't
+    # interleave; the last to finish wins
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".",
+                                    prefix=os.path.basename(path) + ".", delete=False)
+    try:
+        with f:
+            f.write(PREAMBLE.pack(MAGIC, VERSION, len(text)) + text)
+            f.write(b"\0" * (start - f.tell()))
+            f.write(vertices.tobytes())
+            f.write(b"\0" * (header["index_offset"] - f.tell()))
+            f.write(indices.tobytes())
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+def read_header(mapped):
+    magic, version, length = PREAMBLE.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a version %d mesh file" % VERSION)
+    return json.loads(bytes(mapped[PREAMBLE.size:PREAMBLE.size + length]).decode("utf-8"))
+
+def open_map(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+def load(path):
+    """ a TNVMesh from a mesh file, or None if it has no vertices.
+      Raises ValueError if it isn't a mesh file """
+    # every view of the map is released before it is closed; the buffers
+    # have their own copies once glBufferData returns
+    with open_map(path) as mapped:
+        header = read_header(mapped)
+        if not header["nvertices"]:
+            return None
+        vo, io = header["vertex_offset"], header["index_offset"]
+        with memoryview(mapped) as view:
+            with view[vo:vo + header["vertex_bytes"]] as vertices:
+                mesh = TNVMesh(vertices, header["order"])
+            if header["pieces"]:
+                layout = dict((name, (first, n, prim))
+                              for name, prim, first, n in header["pieces"])
+                with view[io:io + header["index_bytes"]] as indices:
+                    mesh.pieces.update(TNVIndexBuffer.from_raw(
+                        indices, header["typecode"], layout).pieces)
+    return mesh
+
+def load_meshdata(path):
+    """ MeshData from a mesh file, its arrays backed by the map, for
+      work on the CPU side such as merging into a MeshBatch """
+    mapped = open_map(path)
+    header = read_header(mapped)
+    vertices = np.frombuffer(mapped, np.float32, header["vertex_bytes"] // 4,
+                             header["vertex_offset"])
+    indices = np.frombuffer(mapped, header["typecode"],
+                            header["index_bytes"] // np.dtype(header["typecode"]).itemsize,
+                            header["index_offset"])
+    pieces = dict((name, (indices[first:first + n], prim))
+                  for name, prim, first, n in header["pieces"])
+    return MeshData(vertices, header["order"], pieces)
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "xash", "meshes")
+
+def content_key(fn, *inputs, version=0):
+    """ a hash of what fn(*inputs) builds: its name, its bytecode and
+      constants, the inputs (numpy arrays by their bytes) and version,
+      for changes in what fn calls """
+    h = hashlib.sha1()
+    code = getattr(fn, "__code__", None)
+    h.update(("%s.%s %d %r" % (fn.__module__, fn.__qualname__, VERSION, version)
+              ).encode("utf-8"))
+    if code is not None:
+        h.update(code.co_code)
+        h.update(repr(code.co_consts).encode("utf-8"))
+    for value in inputs:
+        if isinstance(value, np.ndarray):
+            h.update(("%s %s" % (value.dtype, value.shape)).encode("ascii"))
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            h.update(repr(value).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class MeshCache:
+    """ meshes built by functions, kept on disk under cachedir """
+    def __init__(self, cachedir=None):
+        self.cachedir = cachedir or default_cache_dir()
+        self.stats = dict(hits=0, misses=0)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key + ".tnvm")
+
+    def meshdata(self, fn, *inputs, version=0):
+        """ the MeshData fn(*inputs) builds (or None), from the cache if
+          it has been built before with the same inputs and code (and
+          version, see content_key()) """
+        path = self.path(content_key(fn, *inputs, version=version))
+        try:
+            data = load_meshdata(path)
+        except (OSError, ValueError, KeyError):
+            return self.build(path, fn, inputs)
+        self.stats["hits"] += 1
+        return data if len(data.vertexdata) else None
+
+    def mesh(self, fn, *inputs, version=0):
+        """ a TNVMesh of what fn(*inputs) builds (or None), loaded
+          straight from the cache file if there is one """
+        path = self.path(content_key(fn, *inputs, version=version))
+        try:
+            mesh = load(path)
+        except (OSError, ValueError, KeyError):
+            data = self.build(path, fn, inputs)
+            return None if data is None else data.make()
+        self.stats["hits"] += 1
+        return mesh
+
+    def build(self, path, fn, inputs):
+        self.stats["misses"] += 1
+        data = fn(*inputs)
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            # an empty file for None, so that isn't built again either
+            save(path, data if data is not None else MeshData(np.zeros(0, np.float32)))
+        except OSError as e:
+            logging.warning("could not cache mesh: %s", e)
+        return data
@@ -0,0 +1,361 @@
+"""
+ Offline optimisation of MeshData for the post-transform vertex cache
+
+ * identical interleaved vertices are merged, so faces that share
+   corners share indices
+ * GL_QUADS, strip and fan pieces become GL_TRIANGLES (quads aren't in
+   core profiles)
+ * triangles are reordered for vertex cache locality using Tom Forsyth's
+   "Linear-Speed Vertex Cache Optimisation"
+ * vertices are renumbered in the order they are first used
+
+ optimize() returns the new MeshData and a dict of statistics including
+ the ACMR (average cache miss ratio: vertices transformed per triangle)
+ of each piece before and after.  1.0 or below is very good, 3.0 means
+ no vertex is ever reused.
+
+ simplify() makes lower levels of detail by edge collapse: the edge
+ whose removal changes the surface least, by Garland and Heckbert's
+ quadric error metric, is collapsed onto one of its ends, again and
+ again until few enough triangles are left.  Collapsing onto an existing
+ vertex means only the indices change, so the simplified pieces use the
+ same interleaved vertex data as the originals.
+
+"""
+import heapq
+from collections import deque
+
+import numpy as np
+from pyglet.gl import *
+
+from tnvmesh import MeshData, attribute_offsets
+
+CACHE_SIZE = 32
+
+# scoring constants from Forsyth's article
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+def triangulate(indices, primitive):
+    """ return an (ntriangles, 3) array for a piece, or None if the
+      primitive isn't made of triangles or quads.  Strips keep their
+      winding, and lose the degenerate triangles joining strips """
+    indices = np.asarray(indices, dtype=np.int64)
+    if primitive == GL_TRIANGLES:
+        return indices[:len(indices) // 3 * 3].reshape(-1, 3)
+    elif primitive == GL_QUADS:
+        quads = indices[:len(indices) // 4 * 4].reshape(-1, 4)
+        return np.concatenate((quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]))
+    elif primitive in (GL_TRIANGLE_STRIP, GL_QUAD_STRIP):
+        i = np.arange(max(len(indices) - 2, 0))
+        triangles = np.stack((indices[i], indices[i + 1], indices[i + 2]), axis=1)
+        # every other triangle of a strip is wound the other way
+        triangles[1::2] = triangles[1::2][:, [1, 0, 2]]
+        a, b, c = triangles.T
+        return triangles[(a != b) & (b != c) & (c != a)]
+    elif primitive in (GL_TRIANGLE_FAN, GL_POLYGON):
+        i = np.arange(1, max(len(indices) - 1, 1))
+        return np.stack((np.full(len(i), indices[0] if len(indices) else 0),
+                         indices[i], indices[i + 1]), axis=1)
+    return None
+
+def acmr(triangles, cache_size=CACHE_SIZE):
+    """ average cache miss ratio of a FIFO vertex cache of cache_size """
+    if not len(triangles):
+        return 0.0
+    cache = deque(maxlen=cache_size)
+    incache = set()
+    misses = 0
+    for v in np.asarray(triangles).ravel().tolist():
+        if v not in incache:
+            misses += 1
+            if len(cache) == cache_size:
+                incache.discard(cache[0])
+            cache.append(v)
+            incache.add(v)
+    return misses / float(len(triangles))
+
+def _vertex_score(cache_position, remaining, cache_size):
+    if remaining == 0:
+        return -1.0
+    score = 0.0
+    if cache_position >= 0:
+        if cache_position < 3:
+            score = LAST_TRI_SCORE
+        else:
+            scaler = 1.0 / (cache_size - 3)
+            score = (1.0 - (cache_position - 3) * scaler) ** CACHE_DECAY_POWER
+    return score + VALENCE_BOOST_SCALE * remaining ** -VALENCE_BOOST_POWER
+
+def forsyth_order(triangles, nvertices, cache_size=CACHE_SIZE):
+    """ return triangles (an (n, 3) array) reordered for the vertex cache """
+    tris = np.asarray(triangles).tolist()
+    ntris = len(tris)
+    vtris = [[] for _ in range(nvertices)]
+    for t, tri in enumerate(tris):
+        for v in tri:
+            vtris[v].append(t)
+    position = [-1] * nvertices
+    vscore = [_vertex_score(-1, len(ts), cache_size) for ts in vtris]
+    tscore = [vscore[a] + vscore[b] + vscore[c] for a, b, c in tris]
+    emitted = [False] * ntris
+    order = []
+    cache = []
+    scan = 0 # next triangle to try when nothing in the cache has a score
+    best = max(range(ntris), key=tscore.__getitem__) if ntris else -1
+    while len(order) < ntris:
+        if best < 0:
+            while emitted[scan]:
+                scan += 1
+            best = scan
+        tri = tris[best]
+        emitted[best] = True
+        order.append(best)
+        for v in tri:
+            vtris[v].remove(best)
+        # the new triangle's vertices go to the front of the cache
+        cache = tri + [v for v in cache if v not in tri]
+        for v in cache[cache_size:]:
+            position[v] = -1
+        evicted = cache[cache_size:]
+        cache = cache[:cache_size]
+        touched = set()
+        for i, v in enumerate(cache):
+            position[v] = i
+        for v in cache + evicted:
+            score = _vertex_score(position[v], len(vtris[v]), cache_size)
+            delta = score - vscore[v]
+            vscore[v] = score
+            for t in vtris[v]:
+                tscore[t] += delta
+                touched.add(t)
+        best = -1
+        bestscore = -1.0
+        for t in touched:
+            if tscore[t] > bestscore:
+                best, bestscore = t, tscore[t]
+    return np.asarray(tris, dtype=np.int64)[order].reshape(-1, 3)
+
+def optimize(meshdata, cache_size=CACHE_SIZE):
+    """ return (optimised MeshData, stats) """
+    floats = attribute_offsets(meshdata.order)[0] // 4
+    vertices = np.array(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+    vertices += 0.0 # so -0.0 and 0.0 are the same bytes
+    rows = vertices.view(np.dtype((np.void, vertices.itemsize * floats))).ravel()
+    _, first, remap = np.unique(rows, return_index=True, return_inverse=True)
+    remap = remap.ravel()
+    unique_vertices = vertices[first]
+    stats = {"vertices": (len(vertices), len(unique_vertices))}
+    pieces = {}
+    for name, (indices, prim) in meshdata.pieces.items():
+        triangles = triangulate(indices, prim)
+        if triangles is None:
+            pieces[name] = (remap[np.asarray(indices, dtype=np.int64)], prim)
+            continue
+        before = acmr(triangles, cache_size)
+        triangles = forsyth_order(remap[triangles], len(unique_vertices), cache_size)
+        pieces[name] = (triangles, GL_TRIANGLES)
+        stats[name] = (before, acmr(triangles, cache_size))
+    # renumber vertices in the order the pieces first use them
+    used = np.concatenate([p.ravel() for p, prim in pieces.values()] + [np.arange(len(unique_vertices))])
+    _, firstuse = np.unique(used, return_index=True)
+    neworder = used[np.sort(firstuse)]
+    renumber = np.empty_like(neworder)
+    renumber[neworder] = np.arange(len(neworder))
+    pieces = dict((name, (renumber[p].ravel(), prim)) for name, (p, prim) in pieces.items())
+    return MeshData(unique_vertices[neworder].ravel(), meshdata.order, pieces), stats
+
+BOUNDARY_WEIGHT = 100.0 # how hard open edges (holes, outlines) resist moving
+MAX_FLIP = 0.2          # reject collapses turning a triangle's normal further
+
+def position_columns(order):
+    """ the slice of a row of vertex floats in order holding V """
+    start = attribute_offsets(order)[1]["V"] // 4
+    return slice(start, start + 3)
+
+def _weld_positions(vertices, order):
+    """ (positions, pid): each distinct position once, and the position
+      of each vertex, so that corners split for normals or texture seams
+      collapse together """
+    points = np.ascontiguousarray(vertices[:, position_columns(order)]) + 0.0
+    rows = points.view(np.dtype((np.void, points.itemsize * 3))).ravel()
+    _, first, pid = np.unique(rows, return_index=True, return_inverse=True)
+    return points[first].astype(np.float64), pid.ravel()
+
+def _normals(points, triangles):
+    a, b, c = (points[triangles[:, i]] for i in range(3))
+    return np.cross(b - a, c - a)
+
+def _quadrics(points, triangles):
+    """ (npoints, 4, 4) sums of the area-weighted plane quadrics of the
+      triangles around each point, plus planes along open edges """
+    normals = _normals(points, triangles)
+    area = np.linalg.norm(normals, axis=1)
+    unit = normals / np.maximum(area, 1e-12)[:, None]
+    planes = np.hstack((unit, -(unit * points[triangles[:, 0]]).sum(1)[:, None]))
+    q = planes[:, :, None] * planes[:, None, :] * area[:, None, None]
+    quadrics = np.zeros((len(points), 4, 4))
+    for i in range(3):
+        np.add.at(quadrics, triangles[:, i], q)
+    # an edge used by one triangle is open: keep it where it is with a
+    # plane through it at right angles to the triangle
+    edges = np.concatenate([triangles[:, [i, (i + 1) % 3]] for i in range(3)])
+    owner = np.tile(np.arange(len(triangles)), 3)
+    key = np.sort(edges, axis=1)
+    _, inverse, count = np.unique(key, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    open_edge = count[inverse] == 1
+    edges, owner = edges[open_edge], owner[open_edge]
+    along = points[edges[:, 1]] - points[edges[:, 0]]
+    side = np.cross(along, unit[owner])
+    length = np.linalg.norm(side, axis=1)
+    ok = length > 1e-12
+    side = side[ok] / length[ok, None]
+    planes = np.hstack((side, -(side * points[edges[ok, 0]]).sum(1)[:, None]))
+    q = planes[:, :, None] * planes[:, None, :] * (
+        BOUNDARY_WEIGHT * (along[ok] ** 2).sum(1))[:, None, None]
+    for i in range(2):
+        np.add.at(quadrics, edges[ok, i], q)
+    return quadrics
+
+def simplify(meshdata, ratio=0.5, min_triangles=4):
+    """ MeshData with the triangle and quad pieces of meshdata cut down
+      by edge collapse to about ratio of their triangles (as
+      GL_TRIANGLES), using the same vertexdata.  Pieces are simplified
+      together, so where they meet stays closed.  Other primitives are
+      copied as they are """
+    floats = attribute_offsets(meshdata.order)[0] // 4
+    vertices = np.asarray(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+    points, pid = _weld_positions(vertices, meshdata.order)
+    corners, owners, others = [], [], {}
+    for name, (indices, prim) in meshdata.pieces.items():
+        triangles = triangulate(indices, prim)
+        if triangles is None:
+            others[name] = (indices, prim)
+        else:
+            corners.append(triangles)
+            owners.append(name)
+    if not corners:
+        return MeshData(meshdata.vertexdata, meshdata.order, others)
+    sizes = [len(t) for t in corners]
+    corners = np.concatenate(corners)
+    tris = pid[corners]
+    quadrics = _quadrics(points, tris)
+    homogeneous = np.hstack((points, np.ones((len(points), 1))))
+
+    tris = tris.tolist()
+    alive = [a != b and b != c and c != a for a, b, c in tris]
+    around = [set() for _ in points] # triangles using each point
+    for t, tri in enumerate(tris):
+        if alive[t]:
+            for p in tri:
+                around[p].add(t)
+    version = [0] * len(points)
+    removed = [False] * len(points)
+    heap = []
+
+    def push(a, b):
+        q = quadrics[a] + quadrics[b]
+        # onto b (a goes) or onto a
+        cost_b = homogeneous[b] @ q @ homogeneous[b]
+        cost_a = homogeneous[a] @ q @ homogeneous[a]
+        if cost_a < cost_b:
+            a, b, cost_b = b, a, cost_a
+        heapq.heappush(heap, (cost_b, a, b, version[a], version[b]))
+
+    def flips(a, b):
+        """ would moving point a onto b turn a triangle over? """
+        for t in around[a]:
+            tri = tris[t]
+            if b in tri:
+                continue
+            before = _normals(points, np.array([tri]))[0]
+            after = _normals(points, np.array([[b if p == a else p for p in tri]]))[0]
+            lengths = np.linalg.norm(before) * np.linalg.norm(after)
+            if lengths < 1e-20 or before @ after < MAX_FLIP * lengths:
+                return True
+        return False
+
+    edges = set()
+    for t, (a, b, c) in enumerate(tris):
+        if alive[t]:
+            edges.update((min(x, y), max(x, y)) for x, y in ((a, b), (b, c), (c, a)))
+    for a, b in edges:
+        push(a, b)
+    count = sum(alive)
+    target = max(int(count * ratio), min_triangles)
+    while count > target and heap:
+        cost, a, b, va, vb = heapq.heappop(heap)
+        if removed[a] or removed[b] or va != version[a] or vb != version[b]:
+            continue
+        if flips(a, b):
+            continue
+        # a goes: its triangles either vanish (those on the edge) or use b
+        for t in around[a]:
+            tri = tris[t]
+            if b in tri:
+                alive[t] = False
+                count -= 1
+                for p in tri:
+                    if p != a:
+                        around[p].discard(t)
+            else:
+                tri[tri.index(a)] = b
+                around[b].add(t)
+        around[a] = set()
+        removed[a] = True
+        quadrics[b] += quadrics[a]
+        version[b] += 1
+        for n in set(p for t in around[b] for p in tris[t]) - {b}:
+            push(b, n)
+
+    # each corner becomes the vertex at its point most like the original
+    # (the same normal and texture coordinates if there is one)
+    at = {}
+    for v, p in enumerate(pid.tolist()):
+        at.setdefault(p, []).append(v)
+    position = position_columns(meshdata.order)
+    attributes = np.delete(vertices, np.arange(floats)[position], axis=1)
+    nearest = {}
+    def corner(v, p):
+        if pid[v] == p:
+            return v
+        key = (v, p)
+        if key not in nearest:
+            candidates = at[p]
+            distance = ((attributes[candidates] - attributes[v]) ** 2).sum(1)
+            nearest[key] = candidates[int(np.argmin(distance))]
+        return nearest[key]
+
+    pieces = dict(others)
+    start = 0
+    corners = corners.tolist()
+    for name, size in zip(owners, sizes):
+        kept = []
+        for t in range(start, start + size):
+            if alive[t]:
+                kept.append([corner(v, p) for v, p in zip(corners[t], tris[t])])
+        start += size
+        pieces[name] = (np.array(kept, dtype=np.int64).reshape(-1), GL_TRIANGLES)
+    return MeshData(meshdata.vertexdata, meshdata.order, pieces)
+
+def floor_data(width, length):
+    """ MeshData for a width x length floor of GL_QUADS with every quad
+      written out separately, the way naive level code would build it """
+    vdata = []
+    for x in range(width):
+        for y in range(length):
+            for dx, dy in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                vdata.extend((x + dx, y + dy, 0.0, 0.0, 0.0, 1.0, x + dx, y + dy))
+    return MeshData(vdata, 'VNT', dict(floor=(range(width * length * 4), GL_QUADS)))
+
+if __name__ == '__main__':
+    import tnvmesh
+    for name, data in [("cuboid", tnvmesh.cuboid_data(0.5, 0.5, 0.5)),
+                       ("floor 64x64", floor_data(64, 64))]:
+        optimised, stats = optimize(data)
+        print("{}: vertices {} -> {}".format(name, *stats["vertices"]))
+        for piece in data.pieces:
+            print("  {} ACMR {:.3f} -> {:.3f}".format(piece, *stats[piece]))
@@ -0,0 +1,156 @@
+"""
+ A render queue: collect everything to be drawn in a frame, then draw
+ it in the order that costs least
+
+ Each DrawItem is (program, uniforms, mesh, pieces, transform, texture)
+ plus a depth; program None means the fixed-function pipeline.  The
+ texture is a GL name, bound to GL_TEXTURE_2D, or a textures.TextureArray
+ or Atlas, bound to its own target.  submit() sorts them on a packed
+ integer key:
+
+   bit 63     transparent
+   opaque:      program (12 bits), texture (12 bits), mesh (12 bits),
+                depth (24 bits) nearest first, to cut overdraw
+   transparent: depth (24 bits) furthest first, so blending works,
+                then program, texture and mesh
+
+ and draws them through glstate, ShaderProgram and TNVMesh, so only
+ real changes of program, texture and mesh cost anything.  stats says
+ how many changes that was, and how many drawing in the order the items
+ were added would have taken.  Transparent items are alpha blended and
+ don't write depth.
+
+"""
+from math import sqrt
+
+from pyglet.gl import *
+
+import glstate
+
+DEPTH_BITS = 24
+ID_BITS = 12
+
+class DrawItem:
+    """ one thing to draw.  transform is a 4x4 matrix, either a numpy
+      array (row-major, like meshbatch's) or 16 floats in GL's column-major
+      order, applied to the modelview matrix while drawing.  target is
+      what texture is bound to, by default its target attribute if it has
+      one or GL_TEXTURE_2D """
+    def __init__(self, program, mesh, pieces=None, uniforms=None,
+                 transform=None, texture=0, depth=0.0, transparent=False,
+                 target=None):
+        self.program = program
+        self.mesh = mesh
+        self.pieces = pieces
+        self.uniforms = uniforms
+        self.texture = texture
+        if target is None:
+            target = getattr(texture, "target", GL_TEXTURE_2D)
+        self.target = target
+        self.depth = depth
+        self.transparent = transparent
+        self.key = 0
+        if transform is None:
+            self.matrix = None
+        else:
+            if hasattr(transform, "ravel"):
+                transform = transform.ravel(order="F").tolist()
+            self.matrix = (GLfloat * 16)(*transform)
+
+class RenderQueue:
+    def __init__(self, far=100.0):
+        self.far = far # depths are clamped to 0..far for sorting
+        self.eye = None # camera position, to find depths from transforms
+        self.items = []
+        self.stats = {}
+
+    def add(self, program, mesh, pieces=None, uniforms=None, transform=None,
+            texture=0, depth=None, transparent=False, target=None):
+        """ queue something to draw this frame.  If depth is None it is
+          the distance from eye to the transform's translation """
+        if depth is None:
+            depth = self.distance(transform)
+        item = DrawItem(program, mesh, pieces, uniforms, transform,
+                        texture, depth, transparent, target)
+        self.items.append(item)
+        return item
+
+    def distance(self, transform):
+        if self.eye is None or transform is None:
+            return 0.0
+        if hasattr(transform, "ravel"):
+            x, y, z = transform[0][3], transform[1][3], transform[2][3]
+        else:
+            x, y, z = transform[12:15]
+        ex, ey, ez = self.eye
+        return sqrt((x - ex) ** 2 + (y - ey) ** 2 + (z - ez) ** 2)
+
+    def sort(self):
+        """ give each item its sort key and sort them """
+        ranks = ({}, {}, {})
+        def rank(kind, key):
+            # small number for each distinct program, texture or mesh
+            found = ranks[kind]
+            return found.setdefault(key, len(found) & ((1 << ID_BITS) - 1))
+        depthscale = ((1 << DEPTH_BITS) - 1) / self.far
+        for item in self.items:
+            depth = int(min(max(item.depth, 0.0), self.far) * depthscale)
+            state = ((rank(0, id(item.program)) << (2 * ID_BITS))
+                     | (rank(1, (item.target, item.texture)) << ID_BITS)
+                     | rank(2, id(item.mesh)))
+            if item.transparent:
+                depth = (1 << DEPTH_BITS) - 1 - depth
+                item.key = (1 << 63) | (depth << (3 * ID_BITS)) | state
+            else:
+                item.key = (state << DEPTH_BITS) | depth
+        unsorted = self.changes(self.items)
+        self.items.sort(key=lambda item: item.key)
+        return unsorted
+
+    @staticmethod
+    def changes(items):
+        """ number of program, texture and mesh changes drawing items in order """
+        count = 0
+        program = texture = mesh = None
+        for item in items:
+            bound = (item.target, item.texture)
+            count += ((item.program is not program) + (bound != texture)
+                      + (item.mesh is not mesh))
+            program, texture, mesh = item.program, bound, item.mesh
+        return count
+
+    def submit(self):
+        """ sort and draw everything queued, and empty the queue """
+        unsorted = self.sort()
+        changes = self.changes(self.items)
+        blending = False
+        for item in self.items:
+            if item.transparent and not blending:
+                # transparent items come last: blend them over the rest,
+                # depth tested but not hiding each other
+                blending = True
+                glstate.enable(GL_BLEND)
+                glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+                glDepthMask(GL_FALSE)
+            program = item.program
+            if program is None: # fixed function
+                glstate.use_program(0)
+            else:
+                program.use()
+                if item.uniforms:
+                    program.set(**item.uniforms)
+            # texture 0 too, so untextured items don't get the last one
+            glstate.bind_texture(item.target, getattr(item.texture, "id", item.texture))
+            if item.matrix is not None:
+                glPushMatrix()
+                glMultMatrixf(item.matrix)
+                item.mesh.draw(item.pieces, program)
+                glPopMatrix()
+            else:
+                item.mesh.draw(item.pieces, program)
+        if blending:
+            glDepthMask(GL_TRUE)
+            glstate.disable(GL_BLEND)
+        self.stats = dict(items=len(self.items), changes=changes,
+                          unsorted_changes=unsorted, saved=unsorted - changes)
+        self.items = []
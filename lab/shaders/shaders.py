@@ -1,13 +1,30 @@
 """
 
-Simplistic Shader and ShaderProgram objects
+Simplistic Shader and ShaderProgram objects,
+and a ShaderCache to avoid compiling and linking them more than needed
 
 """
-
+import os
+import hashlib
+import tempfile
+import logging
+import weakref
+import itertools
+import numpy as np
 from pyglet.gl import *
 from ctypes import cast, byref, POINTER, c_char_p, c_char, create_string_buffer
 
-class GLobject:
+import glstate
+import glresources
+from glresources import Resource
+
+class GLobject(Resource):
+    kind = None # for glresources
+
+    def release(self):
+        glresources.release(self.kind, getattr(self, "id", None))
+        self.id = None
+
     def intval(self, param):
         res = GLint(0)
         self.get_int_fn(self.id, param, byref(res))
@@ -24,41 +41,361 @@ class GLobject:
 class Shader(GLobject):
     get_int_fn = glGetShaderiv
     get_info_log_fn = glGetShaderInfoLog
+    kind = "shader"
 
     def __init__(self, source, shadertype=GL_FRAGMENT_SHADER):
         self.id = glCreateShader(shadertype)
+        glresources.track("shader", self.id)
+        self.owned()
         self.source = source
+        self.shadertype = shadertype
         sourceptr = c_char_p(source)
         glShaderSource(self.id, 1, cast(byref(sourceptr), POINTER(POINTER(c_char))), None)
         glCompileShader(self.id)
         self.status = bool(self.intval(GL_COMPILE_STATUS))
         self.log = self.infolog()
         if not self.status:
+            self.release()
             raise RuntimeError(self.log)
 
+# uniform type -> (glUniform*v function, ctype, components per element)
+# anything not listed (samplers, images) is set as an int
+UNIFORM_SETTERS = {
+    GL_FLOAT: (glUniform1fv, GLfloat, 1),
+    GL_FLOAT_VEC2: (glUniform2fv, GLfloat, 2),
+    GL_FLOAT_VEC3: (glUniform3fv, GLfloat, 3),
+    GL_FLOAT_VEC4: (glUniform4fv, GLfloat, 4),
+    GL_INT: (glUniform1iv, GLint, 1),
+    GL_INT_VEC2: (glUniform2iv, GLint, 2),
+    GL_INT_VEC3: (glUniform3iv, GLint, 3),
+    GL_INT_VEC4: (glUniform4iv, GLint, 4),
+    GL_BOOL: (glUniform1iv, GLint, 1),
+    GL_BOOL_VEC2: (glUniform2iv, GLint, 2),
+    GL_BOOL_VEC3: (glUniform3iv, GLint, 3),
+    GL_BOOL_VEC4: (glUniform4iv, GLint, 4),
+    GL_UNSIGNED_INT: (glUniform1uiv, GLuint, 1),
+    GL_UNSIGNED_INT_VEC2: (glUniform2uiv, GLuint, 2),
+    GL_UNSIGNED_INT_VEC3: (glUniform3uiv, GLuint, 3),
+    GL_UNSIGNED_INT_VEC4: (glUniform4uiv, GLuint, 4),
+}
+# matrix type -> (glUniformMatrix*fv function, components per element)
+# type: (setter, columns, rows); GL's matCxR has C columns of R rows
+MATRIX_SETTERS = {
+    GL_FLOAT_MAT2: (glUniformMatrix2fv, 2, 2),
+    GL_FLOAT_MAT3: (glUniformMatrix3fv, 3, 3),
+    GL_FLOAT_MAT4: (glUniformMatrix4fv, 4, 4),
+    GL_FLOAT_MAT2x3: (glUniformMatrix2x3fv, 2, 3),
+    GL_FLOAT_MAT2x4: (glUniformMatrix2x4fv, 2, 4),
+    GL_FLOAT_MAT3x2: (glUniformMatrix3x2fv, 3, 2),
+    GL_FLOAT_MAT3x4: (glUniformMatrix3x4fv, 3, 4),
+    GL_FLOAT_MAT4x2: (glUniformMatrix4x2fv, 4, 2),
+    GL_FLOAT_MAT4x3: (glUniformMatrix4x3fv, 4, 3),
+}
+
+def flatten(value):
+    """ a tuple of the numbers in value, which can be a number,
+    a numpy array or (nested) sequences """
+    if hasattr(value, "ravel"):
+        return tuple(value.ravel().tolist())
+    try:
+        items = iter(value)
+    except TypeError:
+        return (value,)
+    flat = []
+    for v in items:
+        flat.extend(flatten(v))
+    return tuple(flat)
+
+class Uniform:
+    """ an active uniform found by reflection: its location, type and
+    array size, and the last value uploaded to it """
+    def __init__(self, name, location, utype, size):
+        self.name = name
+        self.location = location
+        self.type = utype
+        self.size = size
+        self.value = None
+        if utype in MATRIX_SETTERS:
+            self.setter, self.columns, self.rows = MATRIX_SETTERS[utype]
+            self.components = self.columns * self.rows
+            self.ctype = GLfloat
+            self.matrix = True
+        else:
+            self.setter, self.ctype, self.components = UNIFORM_SETTERS.get(
+                utype, (glUniform1iv, GLint, 1))
+            self.matrix = False
+
+    def flat(self, value):
+        """ value as a flat tuple, checked against the uniform's size.
+        Matrices are always row-major, m[row][col] as numpy and meshbatch
+        write them, whether given as numpy arrays, nested sequences or
+        flat sequences of numbers, and are put in GL's column-major order.
+        Raises ValueError if value isn't a whole number of elements, at
+        least one and at most the array size """
+        value = flatten(value)
+        count, extra = divmod(len(value), self.components)
+        if extra or not 1 <= count <= self.size:
+            raise ValueError("uniform %s takes %s of %d numbers, not %d" % (
+                self.name, "one" if self.size == 1 else "1 to %d" % self.size,
+                self.components, len(value)))
+        if self.matrix:
+            value = np.reshape(value, (count, self.rows, self.columns))
+            value = tuple(value.swapaxes(1, 2).ravel().tolist())
+        return value
+
+    def upload(self, value):
+        """ set the uniform in the bound program to a flat() value, unless
+        it already has it """
+        if value == self.value:
+            return False
+        count = len(value) // self.components
+        data = (self.ctype * (count * self.components))(*value)
+        if self.matrix:
+            self.setter(self.location, count, GL_FALSE, data)
+        else:
+            self.setter(self.location, count, data)
+        self.value = value
+        return True
+
+# numbers for ShaderPrograms that, unlike GL names, are never reused
+_serials = itertools.count(1)
+
 class ShaderProgram(GLobject):
     get_int_fn = glGetProgramiv
     get_info_log_fn = glGetProgramInfoLog
+    kind = "program"
 
-    def __init__(self, *shaders):
+    def __init__(self, *shaders, attributes=None, retrievable=False):
+        """ attributes is an optional {name: location} dict of generic
+        vertex attributes to bind before linking, e.g. tnvmesh.INSTANCE_ATTRIBUTES.
+        If retrievable, ask for the linked binary to be kept for binary() """
         self.id = glCreateProgram()
+        glresources.track("program", self.id)
+        self.owned()
         for shader in shaders:
             glAttachShader(self.id, shader.id)
+        for name, loc in (attributes or {}).items():
+            nbuf = create_string_buffer(name.encode("ascii"))
+            glBindAttribLocation(self.id, loc, cast(nbuf, POINTER(c_char)))
+        if retrievable:
+            glProgramParameteri(self.id, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
         glLinkProgram(self.id)
+        self.linked()
+
+    @classmethod
+    def from_binary(cls, binaryformat, data):
+        """ load a program saved by binary().  Raises RuntimeError if the
+        driver rejects it, e.g. after a driver update """
+        self = cls.__new__(cls)
+        self.id = glCreateProgram()
+        glresources.track("program", self.id)
+        try:
+            glProgramBinary(self.id, binaryformat, data, len(data))
+            self.linked()
+        except GLException as e:
+            self.release()
+            raise RuntimeError(e)
+        self.owned()
+        return self
+
+    def release(self):
+        """ release the program, and the vertex array objects meshes made
+          for it """
+        for mesh in list(getattr(self, "meshes", ())):
+            mesh.forget_program(self.serial)
+        self.meshes = weakref.WeakSet()
+        super().release()
+
+    def linked(self):
+        self.serial = next(_serials)
+        self.meshes = weakref.WeakSet() # TNVMeshes with a VAO for this
         self.status = bool(self.intval(GL_LINK_STATUS))
         self.log = self.infolog()
         if not self.status:
-            raise RuntimeError(self.log)
-        self.uniforms = {}
+            self.release()
+            raise RuntimeError(self.log or "program not linked")
+        self.uniforms = self.reflect_uniforms()
+        self.pending = {}
+        self.attributes = {}
+
+    def reflect_uniforms(self):
+        """ {name: Uniform} for every active uniform.  Arrays are listed
+        under their name without the [0] """
+        uniforms = {}
+        maxlength = max(self.intval(GL_ACTIVE_UNIFORM_MAX_LENGTH), 1)
+        namebuf = create_string_buffer(maxlength)
+        length, size, utype = GLsizei(0), GLint(0), GLenum(0)
+        for i in range(self.intval(GL_ACTIVE_UNIFORMS)):
+            glGetActiveUniform(self.id, i, maxlength, byref(length), byref(size),
+                               byref(utype), namebuf)
+            name = namebuf.value.decode("ascii")
+            if name.startswith("gl_"):
+                continue
+            location = glGetUniformLocation(self.id, namebuf)
+            if name.endswith("[0]"):
+                name = name[:-3]
+            uniforms[name] = Uniform(name, location, utype.value, size.value)
+        return uniforms
+
+    def binary(self):
+        """ return (format, bytes) of the linked program """
+        length = self.intval(GL_PROGRAM_BINARY_LENGTH)
+        buf = create_string_buffer(length)
+        binaryformat = GLenum(0)
+        glGetProgramBinary(self.id, length, None, byref(binaryformat), buf)
+        return binaryformat.value, buf.raw
+
+    def attribute(self, name):
+        """ location of a vertex attribute, or -1 if the program has none """
+        loc = self.attributes.get(name)
+        if loc is None:
+            nbuf = create_string_buffer(name.encode("ascii"))
+            loc = glGetAttribLocation(self.id, cast(nbuf, POINTER(c_char)))
+            self.attributes[name] = loc
+        return loc
 
     def use(self):
-        glUseProgram(self.id)
+        glstate.use_program(self.id)
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            for name, value in pending.items():
+                self.uniforms[name].upload(value)
 
     def set(self, **uniforms):
+        """ set uniforms by name with values of the right shape for their
+        type (numbers, sequences or numpy arrays).  Unchanged values are not
+        uploaded again, and if this program is not the one in use the values
+        wait until the next use().  Names the program doesn't use are ignored.
+        Matrices are row-major however they are given; see Uniform.flat() """
         for name, val in uniforms.items():
-            num = self.uniforms.get(name)
-            if num is None:
-                nbuf = create_string_buffer(name.encode("ascii"))
-                num = glGetUniformLocation(self.id, cast(nbuf, POINTER(c_char)))
-                self.uniforms[name] = num
-            glUniform4f(num, *val)
+            uniform = self.uniforms.get(name)
+            if uniform is None:
+                continue
+            value = uniform.flat(val)
+            if glstate.program == self.id:
+                uniform.upload(value)
+            elif value == uniform.value:
+                self.pending.pop(name, None)
+            else:
+                self.pending[name] = value
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "xash", "shaders")
+
+class ShaderCache:
+    """ Make each Shader and ShaderProgram only once.
+
+    Shaders are shared between programs by (source, type), programs are
+    remembered by the set of shaders (and attribute bindings) they are
+    linked from.  Where GL_ARB_get_program_binary is available, linked
+    programs are also saved under cachedir, in a directory for the driver
+    vendor, renderer and version, and loaded from there next time without
+    compiling anything.  A binary the driver rejects is deleted and the
+    program built from source again.  cachedir defaults to
+    default_cache_dir(); use cachedir=False for no disk cache.
+    """
+    def __init__(self, cachedir=None):
+        if cachedir is None:
+            cachedir = default_cache_dir()
+        self.shaders = {}
+        self.programs = {}
+        self.binary_dir = None
+        if cachedir and (gl_info.have_extension("GL_ARB_get_program_binary")
+                         or gl_info.have_version(4, 1)):
+            nformats = GLint(0)
+            glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, byref(nformats))
+            if nformats.value > 0:
+                driver = "\n".join((gl_info.get_vendor(), gl_info.get_renderer(),
+                                    gl_info.get_version()))
+                self.binary_dir = os.path.join(
+                    cachedir, hashlib.sha1(driver.encode("utf-8")).hexdigest()[:16])
+
+    @staticmethod
+    def shader_key(source, shadertype=GL_FRAGMENT_SHADER):
+        return (shadertype, hashlib.sha1(source).hexdigest())
+
+    def shader(self, source, shadertype=GL_FRAGMENT_SHADER):
+        """ a compiled Shader for source, shared with anyone else asking """
+        key = self.shader_key(source, shadertype)
+        shader = self.shaders.get(key)
+        if shader is None:
+            shader = self.shaders[key] = Shader(source, shadertype)
+        return shader
+
+    def program(self, *sources, attributes=None):
+        """ a linked ShaderProgram.  Each of sources is a Shader, a
+        (source, shadertype) pair, or just source for a fragment shader """
+        specs = []
+        for s in sources:
+            if isinstance(s, Shader):
+                s = (s.source, s.shadertype)
+            elif isinstance(s, bytes):
+                s = (s, GL_FRAGMENT_SHADER)
+            specs.append(s)
+        shader_keys = sorted(self.shader_key(*s) for s in specs)
+        key = (tuple(shader_keys), tuple(sorted((attributes or {}).items())))
+        program = self.programs.get(key)
+        if program is None:
+            program = self.load_binary(key)
+        if program is None:
+            shaders = [self.shader(*s) for s in specs]
+            program = ShaderProgram(*shaders, attributes=attributes,
+                                    retrievable=self.binary_dir is not None)
+            self.save_binary(key, program)
+        self.programs[key] = program
+        return program
+
+    def binary_path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.binary_dir, name + ".bin")
+
+    def load_binary(self, key):
+        if self.binary_dir is None:
+            return None
+        path = self.binary_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            return ShaderProgram.from_binary(int.from_bytes(data[:4], "little"), data[4:])
+        except RuntimeError as e:
+            logging.info("rejected program binary %s: %s", path, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def save_binary(self, key, program):
+        if self.binary_dir is None:
+            return
+        try:
+            binaryformat, data = program.binary()
+            if not data:
+                return
+            os.makedirs(self.binary_dir, exist_ok=True)
+            path = self.binary_path(key)
+            # a temporary file of its own, so programs started together
+            # don't write over each other's
+            fd, temp = tempfile.mkstemp(dir=self.binary_dir,
+                                        prefix=os.path.basename(path) + ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(binaryformat.to_bytes(4, "little") + data)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            logging.warning("could not save program binary: %s", e)
+
+    def release(self):
+        """ release every shader and program made so far """
+        for obj in list(self.shaders.values()) + list(self.programs.values()):
+            obj.release()
+        self.shaders.clear()
+        self.programs.clear()
@@ -11,8 +11,9 @@ from pyglet.window import key
 import ctypes
 from ctypes import byref, cast, POINTER
 
-from shaders import Shader, ShaderProgram
+from shaders import Shader, ShaderProgram, ShaderCache
 import tnvmesh
+import glstate
 
 SIMPLE_VSHADER = b"""
 #version 130
@@ -86,10 +87,11 @@ class TWin:
             self.bg_colour = (0,0,0,1)
         w = self.win = pyglet.window.Window(width, height, *args, **kw)
         self.mesh = tnvmesh.make_cuboid(0.5, 0.5, 0.2)
-        vshader = Shader(SIMPLE_VSHADER, GL_VERTEX_SHADER)
-        gingham = ShaderProgram(vshader, Shader(GINGHAM_FSHADER))
-        graph = ShaderProgram(vshader, Shader(GRAPHPAPER_FSHADER))
-        edges = ShaderProgram(vshader, Shader(EDGES_FSHADER))
+        cache = ShaderCache()
+        vshader = (SIMPLE_VSHADER, GL_VERTEX_SHADER)
+        gingham = cache.program(vshader, GINGHAM_FSHADER)
+        graph = cache.program(vshader, GRAPHPAPER_FSHADER)
+        edges = cache.program(vshader, EDGES_FSHADER)
         self.shaders = [gingham, graph, edges]
         self.shaderindex = 0
         self.angle = 0.0
@@ -131,8 +133,8 @@ class TWin:
             self.height -= 0.1
 
     def on_draw(self):
-        glEnable(GL_CULL_FACE)
-        glEnable(GL_DEPTH_TEST)
+        glstate.enable(GL_CULL_FACE)
+        glstate.enable(GL_DEPTH_TEST)
         glClearColor(*self.bg_colour)
         glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
         glLoadIdentity()
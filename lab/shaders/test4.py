@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+ Draw a field of cuboids with one instanced draw call.
+ Arrow keys move the camera, SPACE toggles between instanced
+ drawing and drawing each copy separately.
+"""
+import sys
+import time
+import random
+import pyglet
+from pyglet.gl import *
+from pyglet.window import key
+
+from shaders import Shader, ShaderProgram
+import tnvmesh
+import glstate
+
+INSTANCED_VSHADER = b"#version 130\n" + tnvmesh.INSTANCE_GLSL + b"""
+smooth out float brightness;
+smooth out vec4 tint;
+
+void main()
+{
+  vec3 sunlight_direction = normalize(vec3(3.0, 1.0, 7.0));
+  vec3 normal = instance_normal(gl_Normal);
+  brightness = 0.3 + 0.7 * max(0.0, dot(normal, sunlight_direction));
+  tint = instance_tint;
+  gl_Position = gl_ModelViewProjectionMatrix * instance_vertex(gl_Vertex);
+  gl_TexCoord[0] = gl_MultiTexCoord0;
+}
+"""
+
+SINGLE_VSHADER = b"""
+#version 130
+smooth out float brightness;
+smooth out vec4 tint;
+
+void main()
+{
+  vec3 sunlight_direction = normalize(vec3(3.0, 1.0, 7.0));
+  vec3 normal = normalize(gl_NormalMatrix * gl_Normal);
+  brightness = 0.3 + 0.7 * max(0.0, dot(normal, sunlight_direction));
+  tint = gl_Color;
+  gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+  gl_TexCoord[0] = gl_MultiTexCoord0;
+}
+"""
+
+EDGES_FSHADER = b"""
+#version 130
+uniform vec4 ink = vec4(0.2, 0.2, 0.2, 1.0);
+
+smooth in float brightness;
+smooth in vec4 tint;
+
+void main()
+{
+   vec2 dists = abs(vec4(0.5) - fract(gl_TexCoord[0] * 5.0)).st;
+   float cmix = smoothstep(0.4, 0.5, max(dists.s, dists.t));
+   gl_FragColor = mix(tint, ink, cmix) * brightness;
+}
+"""
+
+class TWin:
+    def __init__(self, width, height, ncopies, *args, **kw):
+        w = self.win = pyglet.window.Window(width, height, *args, **kw)
+        self.mesh = tnvmesh.make_cuboid(0.1, 0.1, 0.1)
+        self.copies = []
+        data = []
+        for i in range(ncopies):
+            x, y = random.uniform(-10, 10), random.uniform(-10, 10)
+            angle = random.uniform(0, 360)
+            tint = (random.random(), random.random(), random.random(), 1.0)
+            self.copies.append((x, y, angle, tint))
+            data.extend(tnvmesh.instance(x, y, 0.0, angle, 1.0, tint))
+        self.instances = tnvmesh.TNVInstances(data)
+        fshader = Shader(EDGES_FSHADER)
+        self.instanced = ShaderProgram(Shader(INSTANCED_VSHADER, GL_VERTEX_SHADER), fshader,
+                                       attributes=tnvmesh.INSTANCE_ATTRIBUTES)
+        self.single = ShaderProgram(Shader(SINGLE_VSHADER, GL_VERTEX_SHADER), fshader)
+        self.use_instancing = True
+        self.angle = 0.0
+        self.height = 3.0
+        w.set_handlers(self.on_draw, self.on_resize, self.on_key_press)
+
+    def on_resize(self, w, h):
+        glViewport(0, 0, w, h)
+        glMatrixMode(gl.GL_PROJECTION)
+        glLoadIdentity()
+        gluPerspective(45.0, w / max(1.0, float(h)), 0.5, 100.0)
+        glMatrixMode(gl.GL_MODELVIEW)
+        return pyglet.event.EVENT_HANDLED
+
+    def on_key_press(self, sym, modifiers):
+        if sym == key.SPACE:
+            self.use_instancing = not self.use_instancing
+        elif sym == key.LEFT:
+            self.angle += 5.0
+        elif sym == key.RIGHT:
+            self.angle -= 5.0
+        elif sym == key.UP:
+            self.height += 0.5
+        elif sym == key.DOWN:
+            self.height -= 0.5
+
+    def on_draw(self):
+        t0 = time.perf_counter()
+        glstate.enable(GL_CULL_FACE)
+        glstate.enable(GL_DEPTH_TEST)
+        glClearColor(0.4, 0.2, 0.5, 1.0)
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        glLoadIdentity()
+        gluLookAt(0.0, -12.0, self.height, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+        glRotatef(self.angle, 0.0, 0.0, 1.0)
+        if self.use_instancing:
+            self.instanced.use()
+            self.mesh.draw_instanced(self.instances, program=self.instanced)
+        else:
+            self.single.use()
+            for x, y, angle, tint in self.copies:
+                glPushMatrix()
+                glTranslatef(x, y, 0.0)
+                glRotatef(angle, 0.0, 0.0, 1.0)
+                glColor4f(*tint)
+                self.mesh.draw()
+                glPopMatrix()
+        glFinish()
+        self.win.set_caption("{} {:.1f} ms".format(
+            "instanced" if self.use_instancing else "separate",
+            (time.perf_counter() - t0) * 1000.0))
+
+if __name__ == '__main__':
+    ncopies = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    win = TWin(400, 400, ncopies, caption="Instancing", resizable=True)
+    pyglet.app.run()
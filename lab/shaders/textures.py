@@ -0,0 +1,229 @@
+"""
+ Textures for batched drawing: array textures and atlases
+
+ Binding a texture per material would split every batch, so many images
+ go into one texture and the vertex data says which part to use.
+
+ * TextureArray puts same-sized images in the layers of a
+   GL_TEXTURE_2D_ARRAY.  Texture coordinates repeat within a layer, so
+   tiled walls and floors work, and the layer comes from the "L" vertex
+   attribute (see apply_layers()), read by shaders as "layer"
+   (LAYER_GLSL).
+ * Atlas packs images of any size onto shelves of one GL_TEXTURE_2D,
+   with a border of repeated edge pixels round each so mipmaps don't
+   bleed, and remap() moves a piece's texture coordinates into an
+   image's region.  Coordinates can't repeat there, so it suits faces
+   textured 0-1, like the U coordinates of cuboid_data() and the level.
+
+ Both generate mipmaps.  Images are numpy (height, width, 4) or
+ (height, width, 3) uint8 arrays with the bottom row first, as GL and
+ pyglet have them; load_image() reads a file that way.
+
+"""
+from ctypes import POINTER
+
+import numpy as np
+from pyglet.gl import *
+
+import glstate
+import glresources
+from glresources import Resource
+from tnvmesh import MeshData, attribute_offsets
+
+LAYER_GLSL = b"""
+uniform sampler2DArray textures;
+in float layer;
+"""
+
+def load_image(path):
+    """ an image file as a (height, width, 4) uint8 array """
+    import pyglet.image
+    image = pyglet.image.load(path).get_image_data()
+    data = image.get_data("RGBA", image.width * 4)
+    return np.frombuffer(data, dtype=np.uint8).reshape(image.height, image.width, 4)
+
+def rgba(image):
+    image = np.asarray(image, dtype=np.uint8)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], 3, axis=2)
+    if image.shape[2] == 3:
+        image = np.concatenate((image, np.full(image.shape[:2] + (1,), 255, np.uint8)), axis=2)
+    return image
+
+def resample(image, width, height):
+    """ nearest-neighbour resize """
+    h, w = image.shape[:2]
+    if (w, h) == (width, height):
+        return image
+    ys = (np.arange(height) * h // height)
+    xs = (np.arange(width) * w // width)
+    return image[ys[:, None], xs[None, :]]
+
+class TextureArray(Resource):
+    """ same-sized images in the layers of one array texture """
+    target = GL_TEXTURE_2D_ARRAY
+
+    def __init__(self, size=256):
+        self.size = size
+        self.images = []
+        self.layers = {} # name -> layer
+        self.id = None
+        self.owned()
+
+    def add(self, name, image):
+        """ the layer for an image, resized to fit if need be """
+        layer = self.layers.get(name)
+        if layer is None:
+            layer = self.layers[name] = len(self.images)
+            self.images.append(resample(rgba(image), self.size, self.size))
+        return layer
+
+    def build(self):
+        """ upload every layer and make the mipmaps.  Raises ValueError
+          if no images have been added """
+        if not self.images:
+            raise ValueError("texture array has no layers to build")
+        data = np.ascontiguousarray(np.stack(self.images))
+        if self.id is None:
+            self.id = glresources.gen("texture")
+        glresources.resize("texture", self.id, data.nbytes * 4 // 3) # with mipmaps
+        self.bind()
+        glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_RGBA8, self.size, self.size,
+                     len(self.images), 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                     data.ctypes.data_as(POINTER(GLubyte)))
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        glGenerateMipmap(GL_TEXTURE_2D_ARRAY)
+        return self
+
+    def bind(self, unit=GL_TEXTURE0):
+        glstate.bind_texture(self.target, self.id, unit)
+
+    def release(self):
+        glresources.release("texture", getattr(self, "id", None))
+        self.id = None
+
+class Atlas(Resource):
+    """ images of any size packed into one texture """
+    target = GL_TEXTURE_2D
+
+    def __init__(self, size=1024, border=4):
+        self.size = size
+        self.border = border # edge pixels repeated round each image
+        self.pixels = np.zeros((size, size, 4), dtype=np.uint8)
+        self.regions = {} # name -> (u0, v0, u1, v1)
+        self.shelves = [] # [y, height, x used]
+        self.top = 0
+        self.id = None
+        self.owned()
+
+    def add(self, name, image):
+        """ the (u0, v0, u1, v1) region of an image.  Raises ValueError if
+          there's no room left """
+        region = self.regions.get(name)
+        if region is not None:
+            return region
+        image = rgba(image)
+        h, w = image.shape[:2]
+        b = self.border
+        x, y = self.place(w + 2 * b, h + 2 * b)
+        self.pixels[y:y + h + 2 * b, x:x + w + 2 * b] = np.pad(
+            image, ((b, b), (b, b), (0, 0)), mode="edge")
+        s = float(self.size)
+        region = self.regions[name] = ((x + b) / s, (y + b) / s,
+                                       (x + b + w) / s, (y + b + h) / s)
+        return region
+
+    def place(self, w, h):
+        """ (x, y) for a w x h rectangle: on the first shelf it fits,
+          or a new shelf """
+        for shelf in self.shelves:
+            y, height, used = shelf
+            if h <= height and used + w <= self.size:
+                shelf[2] += w
+                return used, y
+        if self.top + h > self.size or w > self.size:
+            raise ValueError("atlas is full")
+        self.shelves.append([self.top, h, w])
+        self.top += h
+        return 0, self.top - h
+
+    def build(self):
+        """ upload the atlas and make mipmaps, no more of them than the
+          borders keep from bleeding """
+        if self.id is None:
+            self.id = glresources.gen("texture")
+        glresources.resize("texture", self.id, self.pixels.nbytes * 4 // 3)
+        self.bind()
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.size, self.size, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, self.pixels.ctypes.data_as(POINTER(GLubyte)))
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL,
+                        max(int(np.log2(max(self.border, 1))), 0))
+        glGenerateMipmap(GL_TEXTURE_2D)
+        return self
+
+    def bind(self, unit=GL_TEXTURE0):
+        glstate.bind_texture(self.target, self.id, unit)
+
+    def release(self):
+        glresources.release("texture", getattr(self, "id", None))
+        self.id = None
+
+    def remap(self, meshdata, images, which="U"):
+        """ MeshData with the texture coordinates which ("T" or "U") of
+          each piece moved into the region of an image: images is
+          {piece name: image name}.  Coordinates are taken to be 0-1.
+          Vertices a remapped piece shares with other pieces are copied
+          first, so each piece's coordinates are moved only once """
+        floats = attribute_offsets(meshdata.order)[0] // 4
+        vertices = np.array(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+        t = attribute_offsets(meshdata.order)[1][which] // 4
+        pieces = dict(meshdata.pieces)
+        users = np.zeros(len(vertices), dtype=np.int64) # pieces using each vertex
+        for indices, prim in pieces.values():
+            users[np.unique(np.asarray(indices, dtype=np.int64))] += 1
+        for piece, name in images.items():
+            if piece not in pieces:
+                continue
+            u0, v0, u1, v1 = self.regions[name]
+            indices, prim = pieces[piece]
+            indices = np.asarray(indices, dtype=np.int64)
+            used = np.unique(indices)
+            shared = used[users[used] > 1]
+            if len(shared):
+                # this piece gets its own copies of the shared vertices
+                copies = np.arange(len(vertices), len(vertices) + len(shared))
+                at = np.minimum(np.searchsorted(shared, indices), len(shared) - 1)
+                indices = np.where(shared[at] == indices, copies[at], indices)
+                vertices = np.concatenate((vertices, vertices[shared]))
+                users[shared] -= 1
+                pieces[piece] = (indices, prim)
+                used = np.unique(indices)
+            st = vertices[used, t:t + 2]
+            vertices[used, t:t + 2] = np.clip(st, 0.0, 1.0) * (u1 - u0, v1 - v0) + (u0, v0)
+        return MeshData(vertices.ravel(), meshdata.order, pieces)
+
+def apply_layers(meshdata, layers, default=0):
+    """ MeshData with an "L" attribute giving the TextureArray layer for
+      each vertex from its piece: layers is {piece name: layer}.  A vertex
+      in more than one piece gets the layer of the last """
+    order = meshdata.order
+    floats = attribute_offsets(order)[0] // 4
+    vertices = np.array(meshdata.vertexdata, dtype=np.float32).reshape(-1, floats)
+    if "L" in order:
+        column = attribute_offsets(order)[1]["L"] // 4
+    else:
+        vertices = np.concatenate((vertices, np.full((len(vertices), 1), default,
+                                                     dtype=np.float32)), axis=1)
+        column, order = floats, order + "L"
+    for piece, layer in layers.items():
+        if piece in meshdata.pieces:
+            used = np.asarray(meshdata.pieces[piece][0], dtype=np.int64)
+            vertices[used, column] = layer
+    return MeshData(vertices.ravel(), order, meshdata.pieces)
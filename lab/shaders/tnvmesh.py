@@ -4,121 +4,681 @@
  Contains:
  * A buffer of floats, holding interleaved attribute data.
    This will always include vertex data but might also have texture coords and
-   normals.
+   normals.  The data can be a list, or anything supporting the buffer
+   protocol (numpy float32 arrays, array.array("f"), memoryview) which
+   is uploaded without copying.
  * Some pieces of mesh that can be drawn.
 
  Pieces consist of:
- * A buffer of indices into the attribute buffer.
+ * A buffer of indices into the attribute buffer, of the smallest type
+   that can hold them, possibly shared with other pieces.
  * A primitive type (usually GL_TRIANGLES) to be used to render the
    shape.
 
+ Lower levels of detail of a piece are pieces too, named by lod_name();
+ lod_pieces() picks the names to draw at a level (see lod.py).
+
+ Buffers and vertex array objects belong to glresources: release() a
+ mesh (or end the scope() it was made in) and they are deleted, or
+ pooled, at the next glresources.collect().
+
 """
+import array
+import mmap
 from pyglet.gl import *
-from ctypes import byref, cast, POINTER
+from ctypes import byref, cast, sizeof, memmove, POINTER
 from math import sin, cos, pi
 from functools import partial
 
-class TNVMesh:
+import glstate
+import glresources
+from glresources import Resource
+
+# ctypes to use for each array.array / struct typecode we can upload
+GL_ARRAY_TYPES = {"f": GLfloat, "B": GLubyte, "H": GLushort, "I": GLuint}
+
+# untyped buffers whose bytes gl_array() takes as items of any type
+RAW_TYPES = (bytes, bytearray, mmap.mmap)
+
+def gl_array(data, typecode="f"):
+    """ return a ctypes array of data suitable for glBufferData.
+
+    Anything that supports the buffer protocol (numpy arrays, array.array,
+    memoryview...) holding items of the right type is used in place
+    without any per-element Python work, as are the bytes of untyped
+    buffers (bytes, bytearray, mmap, or a memoryview of one), which must
+    be a whole number of items.  Read-only buffers are copied once with a
+    memcpy, and non-contiguous ones (e.g. a strided numpy slice) once to
+    make them contiguous.  Anything else (lists, tuples, ranges, or
+    buffers of other item types) is converted element by element.
+    """
+    ctype = GL_ARRAY_TYPES[typecode]
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = None
+    if view is not None:
+        fmt = view.format.lstrip("@=<")
+        owner = data.obj if isinstance(data, memoryview) else data
+        if isinstance(owner, RAW_TYPES) or (
+                view.itemsize == sizeof(ctype) and fmt == typecode):
+            if view.c_contiguous:
+                raw = view.cast("B")
+            else:
+                raw = memoryview(view.tobytes())
+            if raw.nbytes % sizeof(ctype):
+                raise ValueError("%d bytes isn't a whole number of %r items"
+                                 % (raw.nbytes, typecode))
+            T = ctype * (raw.nbytes // sizeof(ctype))
+            if raw.readonly:
+                return T.from_buffer_copy(raw)
+            return T.from_buffer(raw)
+        # other item types; flatten and convert the slow way
+        data = memoryview(view.tobytes()).cast(fmt)
+    arr = (ctype*len(data))()
+    for i,f in enumerate(data):
+        arr[i] = f
+    return arr
+
+# size in bytes of each kind of attribute in the interleaved data.
+# L (a texture array layer, see textures.py) is only for shaders
+ATTRIBUTE_SIZES = {"T":8, "U":8,
+                   "V":12, "N":12, "L":4}
+
+def attribute_offsets(order):
+    """ return (stride, {attribute: offset}) in bytes for an order string """
+    offsets = {}
+    offset = 0
+    for c in order:
+        offsets[c] = offset
+        offset += ATTRIBUTE_SIZES[c]
+    return offset, offsets
+
+# names of generic vertex attributes that shaders can declare instead of
+# using gl_Vertex, gl_Normal, gl_MultiTexCoord0 and gl_MultiTexCoord1
+ATTRIBUTE_NAMES = {"V": "position", "N": "normal",
+                   "T": "texcoord0", "U": "texcoord1", "L": "layer"}
+
+# lower levels of detail of a piece are more pieces, named "piece@1"...
+LOD_SEPARATOR = "@"
+
+def lod_name(name, level):
+    """ the name of piece name's copy at detail level (0 is name itself) """
+    return name if level == 0 else "%s%s%d" % (name, LOD_SEPARATOR, level)
+
+_have_vao = None
+_have_sync = None
+
+def have_vao():
+    """ are vertex array objects available in the current context? """
+    global _have_vao
+    if _have_vao is None:
+        _have_vao = (gl_info.have_version(3, 0)
+                     or gl_info.have_extension("GL_ARB_vertex_array_object"))
+    return _have_vao
+
+def have_sync():
+    """ are fences, buffer copies and base vertex drawing available? """
+    global _have_sync
+    if _have_sync is None:
+        _have_sync = gl_info.have_version(3, 2)
+    return _have_sync
+
+def gl_call(name, *args):
+    """ call the GL function name as this module has it now, which is
+      glprofile's wrapper if a Profiler has been installed since """
+    return globals()[name](*args)
+
+class TNVMesh(Resource):
     def __init__(self, vertexdata, order='V', pieces=None):
         self.order = order
-        self.vbuf = GLuint(0)
-        glGenBuffers(1, byref(self.vbuf))
-        self.stride = 0
+        self.vaos = {} # program serial (0 for none) -> vertex array object
         self.enables = []
-        offset = 0
-        # calculate total size of data for each vertex
-        sizes = {"T":8, "U":8,
-                 "V":12, "N":12}
+        sizes = ATTRIBUTE_SIZES
         array_types = {"V":GL_VERTEX_ARRAY,
                        "T":GL_TEXTURE_COORD_ARRAY,
                        "U":GL_TEXTURE_COORD_ARRAY,
                        "N":GL_NORMAL_ARRAY}
         texture_units = {"T":GL_TEXTURE0, "U":GL_TEXTURE1}
-        self.stride = sum(sizes[c] for c in order)
         # calculate offset in interleaved data for each array
-        offsets = {}
-        for c in order:
-            offsets[c] = offset
-            offset += sizes[c]
-        assert self.stride == offset
-        # build a list of functions to call before drawing
+        self.stride, offsets = attribute_offsets(order)
+        self.offsets = offsets
+        # build a list of functions to call before drawing, by name so
+        # that they are looked up when called (see gl_call())
         def addfun(*args):
-            self.enables.append(partial(*args))
+            self.enables.append(partial(gl_call, *args))
         for k in sizes:
+            if k not in array_types:
+                continue # generic attributes only, set up by bind_vao()
             used = k in order
-            enableDisable = glEnableClientState if used else glDisableClientState
+            enableDisable = "glEnableClientState" if used else "glDisableClientState"
             if k in texture_units:
                 # specify which texture array we are talking about
-                addfun(glClientActiveTexture, texture_units[k])
+                addfun("glClientActiveTexture", texture_units[k])
             if used:
                 if k == 'V':
-                    addfun(glVertexPointer, 3, GL_FLOAT, self.stride, offsets[k])
+                    addfun("glVertexPointer", 3, GL_FLOAT, self.stride, offsets[k])
                 elif k == 'T':
-                    addfun(glTexCoordPointer, 2, GL_FLOAT, self.stride, offsets[k])
+                    addfun("glTexCoordPointer", 2, GL_FLOAT, self.stride, offsets[k])
                 elif k == 'U': # second set of texture coords
-                    addfun(glTexCoordPointer, 2, GL_FLOAT, self.stride, offsets[k])
+                    addfun("glTexCoordPointer", 2, GL_FLOAT, self.stride, offsets[k])
                 elif k == 'N':
-                    addfun(glNormalPointer, GL_FLOAT, self.stride, offsets[k])
+                    addfun("glNormalPointer", GL_FLOAT, self.stride, offsets[k])
             addfun(enableDisable, array_types[k]) # enable or disable array
+        # the client active texture isn't part of a VAO; leave it as we found it
+        addfun("glClientActiveTexture", GL_TEXTURE0)
 
-        data = (GLfloat*len(vertexdata))()
-        for i,f in enumerate(vertexdata):
-            data[i] = f
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbuf)
-        glBufferData(GL_ARRAY_BUFFER, len(data) * 4, byref(data), GL_STATIC_DRAW)
-        self.nvertices = (len(vertexdata) * 4) // self.stride
+        self.basevertex = 0
+        self.upload(vertexdata)
         self.pieces = {}
         if pieces:
             self.pieces.update(pieces)
+        self.owned()
 
-    def __del__(self):
-        glDeleteBuffers(1, byref(self.vbuf))
+    def upload(self, vertexdata):
+        """ make and fill the vertex buffer (called once from __init__) """
+        data = gl_array(vertexdata, "f")
+        self.vbuf = glresources.buffer(GL_ARRAY_BUFFER, data)
+        self.nvertices = sizeof(data) // self.stride
+
+    def release(self):
+        """ give up the buffers, and those of the pieces, which mustn't
+          be shared with another mesh """
+        glresources.release("pooled buffer", getattr(self, "vbuf", None))
+        self.vbuf = None # its name may be reused
+        for vao in getattr(self, "vaos", {}).values():
+            glresources.release("vertex array", vao)
+        self.vaos = {}
+        for piece in getattr(self, "pieces", {}).values():
+            piece.release()
+
+    def forget_program(self, serial):
+        """ release the vertex array object for a program that is gone """
+        glresources.release("vertex array", self.vaos.pop(serial, None))
 
     def add_piece(self, name, piece):
         self.pieces[name] = piece
 
-    def draw(self, pieces=None):
+    def lod_pieces(self, level, pieces=None):
+        """ the names of the pieces to draw at detail level (0 is full
+          detail) for pieces (by default every full-detail piece).  Where
+          a piece has no copy at that level, the coarsest finer one is
+          used.  See lod_name() and lod.lod_data()
+        """
+        if pieces is None:
+            pieces = [name for name in self.pieces if LOD_SEPARATOR not in name]
+        result = []
+        for name in pieces:
+            for l in range(level, 0, -1):
+                if lod_name(name, l) in self.pieces:
+                    name = lod_name(name, l)
+                    break
+            result.append(name)
+        return result
+
+    def triangles(self, pieces=None):
+        """ how many triangles drawing pieces (by default all) draws """
+        names = self.pieces if pieces is None else pieces
+        return sum(self.pieces[k].triangles for k in names if k in self.pieces)
+
+    def bind_vao(self, program=None):
+        """ bind a vertex array object recording the attribute layout
+          for drawing with a ShaderProgram, creating it the first time.
+          It records the fixed-function client arrays (so this needs a
+          compatibility profile context) and points any attributes named
+          in ATTRIBUTE_NAMES that the program declares at the data.
+        """
+        # not keyed by program id, which GL reuses once a program is deleted
+        key = program.serial if program is not None else 0
+        vao = self.vaos.get(key)
+        if vao is not None:
+            glstate.bind_vertex_array(vao)
+            return vao
+        if program is not None:
+            program.meshes.add(self)
+        vao = glresources.gen("vertex array")
+        glstate.bind_vertex_array(vao)
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.vbuf)
+        self.point_arrays(program)
+        self.vaos[key] = vao
+        return vao
+
+    def point_arrays(self, program=None):
+        """ with the vertex buffer bound, set up the fixed-function arrays
+          and the generic attributes program declares (see ATTRIBUTE_NAMES) """
+        for f in self.enables:
+            f()
+        if program is not None:
+            for c in self.order:
+                loc = program.attribute(ATTRIBUTE_NAMES[c])
+                if loc >= 0:
+                    glVertexAttribPointer(loc, ATTRIBUTE_SIZES[c] // 4, GL_FLOAT,
+                                          GL_FALSE, self.stride, self.offsets[c])
+                    glEnableVertexAttribArray(loc)
+
+    def draw(self, pieces=None, program=None):
+        """ draw some or all pieces.  program is the ShaderProgram in use,
+          needed if it reads generic attributes (see ATTRIBUTE_NAMES).
+          The mesh's vertex array object is left bound, so drawing it again
+          costs no binds; call glstate.restore() before other GL code.
+        """
         if pieces is None:
             todraw = self.pieces.values()
         else:
             todraw = [self.pieces[k] for k in pieces if k in self.pieces]
         if not todraw:
             return
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbuf)
+        if have_vao():
+            self.bind_vao(program)
+            for p in todraw:
+                p.draw(self.basevertex)
+            return
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.vbuf)
         glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
         try:
-            for f in self.enables:
-                f()
+            self.point_arrays(program)
             for p in todraw:
-                p.draw()
+                p.draw(self.basevertex)
         finally:
             glPopClientAttrib()
+            glstate.forget_buffers()
+
+    def draw_instanced(self, instances, pieces=None, program=None):
+        """ draw a copy of the mesh for every instance in a TNVInstances,
+          with a single glDrawElementsInstanced call per piece.
+          The shader program must read the instance attributes (see INSTANCE_GLSL)
+        """
+        if pieces is None:
+            todraw = self.pieces.values()
+        else:
+            todraw = [self.pieces[k] for k in pieces if k in self.pieces]
+        if not todraw or not instances.count:
+            return
+        if have_vao():
+            self.bind_vao(program)
+            instances.bind()
+            try:
+                for p in todraw:
+                    p.draw_instanced(instances.count, self.basevertex)
+            finally:
+                instances.unbind()
+            return
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.vbuf)
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        try:
+            self.point_arrays(program)
+            instances.bind()
+            try:
+                for p in todraw:
+                    p.draw_instanced(instances.count, self.basevertex)
+            finally:
+                instances.unbind()
+        finally:
+            glPopClientAttrib()
+            glstate.forget_buffers()
+
+# GL index types for each array typecode, smallest first
+INDEX_TYPES = {"B": GL_UNSIGNED_BYTE, "H": GL_UNSIGNED_SHORT, "I": GL_UNSIGNED_INT}
+
+def index_typecode(indices):
+    """ the smallest index typecode ("B", "H" or "I") that can hold all
+      of indices """
+    if hasattr(indices, "max"):
+        top = int(indices.max()) if len(indices) else 0
+    else:
+        top = max(indices, default=0)
+    if top < 0x100:
+        return "B"
+    elif top < 0x10000:
+        return "H"
+    return "I"
+
+def index_array(indices, typecode):
+    """ indices as a buffer of typecode items, without copying if they
+      already are one """
+    try:
+        if memoryview(indices).format.lstrip("@=<") == typecode:
+            return indices
+    except TypeError:
+        pass
+    if hasattr(indices, "astype"): # numpy
+        return indices.astype(typecode)
+    return array.array(typecode, indices)
+
+# how long each wait for the GPU to finish with a copy lasts (ns)
+SYNC_TIMEOUT = 1000000000
+
+class DynamicTNVMesh(TNVMesh):
+    """ A TNVMesh whose vertex data is changed often, e.g. every frame.
+
+      The buffer holds `frames` copies of the data, used in turn.  Each
+      update() fences the copy that has just been drawn from and writes the
+      next one, which the GPU finished with frames-1 updates ago, so it
+      hardly ever has to wait.  Having waited on the fence ourselves, the
+      copy is written through an unsynchronized glMapBufferRange, so the
+      driver doesn't wait (or copy) again the way it would for
+      glBufferSubData.  Pieces are drawn with a base vertex that selects
+      the current copy.  Unchanged vertices are carried over with
+      glCopyBufferSubData, so partial updates only upload what changed.
+
+      With frames=1, or without GL 3.2, full updates orphan the buffer
+      instead and partial updates go straight in with glBufferSubData.
+    """
+    def __init__(self, vertexdata, order='V', pieces=None, frames=3):
+        self.frames = frames if have_sync() else 1
+        self.fences = [None] * self.frames
+        self.current = 0
+        super().__init__(vertexdata, order, pieces)
 
-class TNVPiece:
-    def __init__(self, indices, primitive=GL_TRIANGLES):
+    def release(self):
+        for fence in getattr(self, "fences", ()):
+            glresources.defer("sync", fence)
+        self.fences = [None] * self.frames
+        glresources.release("buffer", getattr(self, "vbuf", None))
+        self.vbuf = None
+        super().release()
+
+    def upload(self, vertexdata):
+        data = gl_array(vertexdata, "f")
+        self.size = sizeof(data) # bytes in each copy
+        self.nvertices = self.size // self.stride
+        # not pooled: the storage is orphaned and replaced
+        self.vbuf = glresources.gen("buffer", self.size * self.frames)
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.vbuf)
+        glBufferData(GL_ARRAY_BUFFER, self.size * self.frames, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, self.size, byref(data))
+
+    def wait(self, copy):
+        """ wait until the GPU has finished drawing from a copy, for as
+          long as it takes: writing to it any sooner would change what
+          is being drawn """
+        fence = self.fences[copy]
+        if not fence:
+            return
+        flags = GL_SYNC_FLUSH_COMMANDS_BIT
+        while True:
+            result = glClientWaitSync(fence, flags, SYNC_TIMEOUT)
+            if result in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                break
+            if result == GL_WAIT_FAILED:
+                glFinish()
+                break
+            flags = 0 # GL_TIMEOUT_EXPIRED: already flushed, keep waiting
+        glDeleteSync(fence)
+        self.fences[copy] = None
+
+    def update(self, vertexdata, offset=0):
+        """ replace the vertices from number offset onwards with vertexdata,
+          leaving the others as they were """
+        data = gl_array(vertexdata, "f")
+        start = offset * self.stride
+        end = start + sizeof(data)
+        if end > self.size:
+            raise ValueError("update past the end of the mesh")
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.vbuf)
+        if self.frames == 1:
+            if start == 0 and end == self.size:
+                # orphan: the driver gives us fresh storage without waiting
+                glBufferData(GL_ARRAY_BUFFER, self.size, None, GL_STREAM_DRAW)
+            glBufferSubData(GL_ARRAY_BUFFER, start, sizeof(data), byref(data))
+            return
+        previous = self.current
+        self.fences[previous] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.current = (previous + 1) % self.frames
+        self.wait(self.current)
+        src = previous * self.size
+        dst = self.current * self.size
+        if start > 0 or end < self.size:
+            glstate.bind_buffer(GL_COPY_READ_BUFFER, self.vbuf)
+            glstate.bind_buffer(GL_COPY_WRITE_BUFFER, self.vbuf)
+            if start > 0:
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+                                    src, dst, start)
+            if end < self.size:
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+                                    src + end, dst + end, self.size - end)
+        pointer = glMapBufferRange(GL_ARRAY_BUFFER, dst + start, sizeof(data),
+                                   GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_RANGE_BIT
+                                   | GL_MAP_UNSYNCHRONIZED_BIT)
+        if pointer:
+            memmove(pointer, data, sizeof(data))
+            glUnmapBuffer(GL_ARRAY_BUFFER)
+        else:
+            glBufferSubData(GL_ARRAY_BUFFER, dst + start, sizeof(data), byref(data))
+        self.basevertex = self.current * self.nvertices
+
+
+class TNVPiece(Resource):
+    """ indices into a TNVMesh's vertices and a primitive to draw them with.
+      The index type is the smallest that holds the largest index, unless
+      typecode ("B", "H" or "I") is given.  Pieces can also share one index
+      buffer at different offsets, see TNVIndexBuffer.
+    """
+    def __init__(self, indices, primitive=GL_TRIANGLES, typecode=None):
         self.prim = primitive
-        self.ibuf = GLuint(0)
-        glGenBuffers(1, byref(self.ibuf))
-        data = (GLushort*len(indices))()
-        for i,j in enumerate(indices):
-            data[i] = j
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibuf)
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, len(indices)*2, byref(data), GL_STATIC_DRAW)
-        self.nindices = len(indices)
-
-    def __del__(self):
-        glDeleteBuffers(1, byref(self.ibuf))
-
-    def draw(self):
+        self.typecode = typecode or index_typecode(indices)
+        self.gltype = INDEX_TYPES[self.typecode]
+        data = gl_array(index_array(indices, self.typecode), self.typecode)
+        self.ibuf = glresources.buffer(GL_ELEMENT_ARRAY_BUFFER, data)
+        self.nindices = len(data)
+        self.offset = 0
+        self.shared = None
+        self.owned()
+
+    @classmethod
+    def sharing(cls, shared, offset, nindices, primitive=GL_TRIANGLES):
+        """ a piece drawing nindices indices from a TNVIndexBuffer,
+          starting offset indices in """
+        piece = cls.__new__(cls)
+        piece.prim = primitive
+        piece.typecode = shared.typecode
+        piece.gltype = INDEX_TYPES[shared.typecode]
+        piece.ibuf = shared.ibuf
+        piece.nindices = nindices
+        piece.offset = offset * sizeof(GL_ARRAY_TYPES[shared.typecode])
+        piece.shared = shared # keep the buffer alive
+        shared.users += 1
+        return piece
+
+    @property
+    def triangles(self):
+        """ how many triangles draw() draws """
+        n = self.nindices
+        if self.prim == GL_TRIANGLES:
+            return n // 3
+        elif self.prim == GL_QUADS:
+            return n // 4 * 2
+        elif self.prim in (GL_TRIANGLE_STRIP, GL_TRIANGLE_FAN, GL_POLYGON):
+            return max(n - 2, 0)
+        return 0
+
+    def release(self):
+        """ give up the index buffer.  A shared one is only released
+          when the last piece using it is """
+        shared = getattr(self, "shared", None)
+        if shared is not None:
+            if getattr(self, "ibuf", None) is not None:
+                shared.unshare()
+        else:
+            glresources.release("pooled buffer", getattr(self, "ibuf", None))
+        self.ibuf = None
+
+    def draw(self, basevertex=0):
         """ only makes sense inside TNVMesh.draw() where array buffer has been bound """
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibuf)
-        glDrawElements(self.prim, self.nindices, GL_UNSIGNED_SHORT, 0)
+        glstate.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, self.ibuf)
+        if basevertex:
+            glDrawElementsBaseVertex(self.prim, self.nindices, self.gltype,
+                                     self.offset, basevertex)
+        else:
+            glDrawElements(self.prim, self.nindices, self.gltype, self.offset)
+
+    def draw_instanced(self, count, basevertex=0):
+        """ only makes sense inside TNVMesh.draw_instanced() """
+        glstate.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, self.ibuf)
+        if basevertex:
+            glDrawElementsInstancedBaseVertex(self.prim, self.nindices, self.gltype,
+                                              self.offset, count, basevertex)
+        else:
+            glDrawElementsInstanced(self.prim, self.nindices, self.gltype,
+                                    self.offset, count)
+
+
+class TNVIndexBuffer(Resource):
+    """ one element buffer holding the indices of several pieces,
+      so big meshes need neither many buffers nor splitting.
+      Give it {name: (indices, primitive)} and take the TNVPiece objects
+      from its pieces dict.
+    """
+    def __init__(self, pieces, typecode=None):
+        pieces = dict(pieces)
+        if typecode is None:
+            codes = [index_typecode(indices) for indices, prim in pieces.values()]
+            typecode = max(codes, key="BHI".index) if codes else "B"
+        raw = bytearray()
+        layout = {}
+        offset = 0
+        for name, (indices, prim) in pieces.items():
+            nindices = len(indices)
+            raw += memoryview(index_array(indices, typecode)).cast("B")
+            layout[name] = (offset, nindices, prim)
+            offset += nindices
+        self.upload(raw, typecode, layout)
+
+    @classmethod
+    def from_raw(cls, raw, typecode, layout):
+        """ an index buffer of the bytes raw (anything gl_array() takes
+          as-is), holding pieces {name: (offset, nindices, primitive)} """
+        ibuffer = cls.__new__(cls)
+        ibuffer.upload(raw, typecode, layout)
+        return ibuffer
+
+    def upload(self, raw, typecode, layout):
+        self.typecode = typecode
+        data = gl_array(raw, typecode)
+        self.ibuf = glresources.buffer(GL_ELEMENT_ARRAY_BUFFER, data)
+        self.nindices = len(data)
+        self.users = 0 # pieces still drawing from the buffer
+        self.pieces = dict((name, TNVPiece.sharing(self, offset, nindices, prim))
+                           for name, (offset, nindices, prim) in layout.items())
 
+    def unshare(self):
+        """ a piece is done with the buffer; release it after the last """
+        self.users -= 1
+        if self.users <= 0:
+            self.release()
+
+    def release(self):
+        glresources.release("pooled buffer", getattr(self, "ibuf", None))
+        self.ibuf = None
+
+
+# Per-instance attributes read by instanced vertex shaders, and the generic
+# attribute locations they are bound to.  NVIDIA aliases generic locations
+# with the fixed-function arrays: 0 vertex, 2 normal, 3 colour, 4 secondary
+# colour, 5 fog coordinate and 8-15 texture units 0-7.  Meshes use texture
+# units 0 and 1 (8 and 9), so these go in 10-12, which only alias texture
+# units that are never enabled.
+INSTANCE_ATTRIBUTES = {"instance_offset": 10,   # xyz translation, w scale
+                       "instance_rotation": 11, # quaternion (x, y, z, w)
+                       "instance_tint": 12}     # rgba colour
+INSTANCE_FLOATS = 12
+
+# GLSL to paste into an instanced vertex shader after the #version line.
+# Use instance_vertex(gl_Vertex), instance_normal(gl_Normal) and instance_tint
+INSTANCE_GLSL = b"""
+in vec4 instance_offset;
+in vec4 instance_rotation;
+in vec4 instance_tint;
+
+vec3 instance_rotate(vec3 v)
+{
+  vec3 q = instance_rotation.xyz;
+  return v + 2.0 * cross(q, cross(q, v) + instance_rotation.w * v);
+}
+
+vec4 instance_vertex(vec4 v)
+{
+  return vec4(instance_rotate(v.xyz) * instance_offset.w + instance_offset.xyz, 1.0);
+}
+
+vec3 instance_normal(vec3 n)
+{
+  return instance_rotate(n);
+}
+"""
+
+def instance(x, y, z, angle=0.0, scale=1.0, tint=(1.0, 1.0, 1.0, 1.0)):
+    """ the 12 floats of instance data for a copy of a mesh moved to x,y,z,
+      rotated by angle degrees about the z axis and scaled """
+    half = angle * pi / 360.0
+    return [x, y, z, scale, 0.0, 0.0, sin(half), cos(half)] + list(tint)
+
+class TNVInstances(Resource):
+    """ A buffer of per-instance attributes, 12 floats per instance
+      laid out as described by INSTANCE_ATTRIBUTES (see instance())
+    """
+    def __init__(self, instancedata=(), usage=GL_STATIC_DRAW):
+        self.usage = usage
+        self.ibuf = glresources.gen("buffer")
+        self.count = 0
+        self.update(instancedata)
+        self.owned()
+
+    def release(self):
+        glresources.release("buffer", getattr(self, "ibuf", None))
+        self.ibuf = None
+
+    def update(self, instancedata):
+        """ replace all the instance data """
+        data = gl_array(instancedata, "f")
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.ibuf)
+        glBufferData(GL_ARRAY_BUFFER, sizeof(data), byref(data), self.usage)
+        glresources.resize("buffer", self.ibuf, sizeof(data))
+        self.count = len(data) // INSTANCE_FLOATS
+
+    def bind(self):
+        """ point the instance attributes at this buffer, advancing once per instance """
+        glstate.bind_buffer(GL_ARRAY_BUFFER, self.ibuf)
+        stride = INSTANCE_FLOATS * 4
+        for i, loc in enumerate(sorted(INSTANCE_ATTRIBUTES.values())):
+            glVertexAttribPointer(loc, 4, GL_FLOAT, GL_FALSE, stride, i * 16)
+            glVertexAttribDivisor(loc, 1)
+            glEnableVertexAttribArray(loc)
+
+    def unbind(self):
+        for loc in INSTANCE_ATTRIBUTES.values():
+            glVertexAttribDivisor(loc, 0)
+            glDisableVertexAttribArray(loc)
+
+
+class MeshData:
+    """ the CPU-side description of a mesh, before it is uploaded:
+      interleaved vertex data, its order string, and pieces as
+      {name: (indices, primitive)}.  Keep one of these around when the
+      data is needed again, e.g. to merge copies into a MeshBatch.
+    """
+    def __init__(self, vertexdata, order='V', pieces=None):
+        self.vertexdata = vertexdata
+        self.order = order
+        self.pieces = dict(pieces) if pieces else {}
+
+    def make(self):
+        """ upload to a new TNVMesh, with all pieces in one index buffer """
+        pieces = TNVIndexBuffer(self.pieces).pieces if self.pieces else None
+        return TNVMesh(self.vertexdata, self.order, pieces)
 
 
 def make_cuboid(dx, dy, dz):
-    """ make a TNVMesh with a single piece called "cuboid" made of GL_QUADS 
+    """ make a TNVMesh with a single piece called "cuboid" made of GL_QUADS
       centered on the origin, with width 2*dx, length 2*dy, height 2*dz.
+      See cuboid_data()
+    """
+    return cuboid_data(dx, dy, dz).make()
+
+def cuboid_data(dx, dy, dz):
+    """ make MeshData for a cuboid with a single piece called "cuboid"
+      made of GL_QUADS centered on the origin, with width 2*dx,
+      length 2*dy, height 2*dz.
 
       Texture coords 0 are scaled with the cuboid size
       Texture coords 1 are 0-1 on each face regardless of size
@@ -151,6 +711,5 @@ def make_cuboid(dx, dy, dz):
      dx, -dy, -dz,  0,  0, -1, dx, dy, 1, 1,
     -dx, -dy, -dz,  0,  0, -1, 0,  dy, 0, 1,
     ]
-    QUAD_CUBOID_PIECE = TNVPiece(range(24), GL_QUADS)
-    return TNVMesh(vdata, order, dict(cuboid=QUAD_CUBOID_PIECE))
+    return MeshData(vdata, order, dict(cuboid=(range(24), GL_QUADS)))
 
@@ -10,7 +10,9 @@ import sys
 
 def main():
     here = os.path.abspath(os.path.split(__file__)[0])
-    libs = [here, os.path.join(here, "tdgl3")]
+    # lab/shaders until its modules graduate to tdgl3
+    libs = [here, os.path.join(here, "tdgl3"),
+            os.path.join(here, "lab", "shaders")]
     sys.path[:0] = libs
     import xash.main
     xash.main.main()
@@ -0,0 +1,13 @@
+"""
+ The tests need no GL context: they cover the numpy and ctypes side of
+ the lab modules and xash.  pyglet mustn't make its hidden window on
+ import, so that they run without a display.
+"""
+import os
+import sys
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, ".."), os.path.join(here, "..", "lab", "shaders")]
+
+import pyglet
+pyglet.options['shadow_window'] = False
@@ -0,0 +1,43 @@
+import numpy as np
+
+from xash.level import Level, FLOOR, DOOR
+from xash.fov import shadowcast, line_of_sight, FieldOfView
+
+def test_line_of_sight():
+    blocked = np.zeros((10, 10), dtype=bool)
+    blocked[5, 1:9] = True
+    sources = [(2, 2), (2, 2), (2, 2), (0, 0), (0, 0)]
+    targets = [(7, 2), (2, 8), (5, 5), (9, 0), (9, 9)]
+    assert line_of_sight(blocked, sources, targets).tolist() == [True, False, True, True, False]
+    assert line_of_sight(blocked, [(0, 0)], [(9, 9)], radius=5).tolist() == [False]
+    assert len(line_of_sight(blocked, [], [])) == 0
+
+def test_shadowcast():
+    blocked = np.zeros((21, 21), dtype=bool)
+    blocked[10, 12] = True
+    seen = shadowcast(blocked, 10, 10, radius=8)
+    assert seen[10, 12] and not seen[10, 15]
+    assert seen[10, 2] and not seen[10, 1] # the radius
+    assert not shadowcast(blocked, -1, 3).any()
+
+def test_field_of_view_forgets_on_change():
+    level = Level(10, 3)
+    level.fill(0, 1, 10, 2, FLOOR)
+    fov = FieldOfView(level)
+    assert fov.visible(0, 1)[1, 9]
+    assert fov.can_see([(0, 1)], [(9, 1)]).tolist() == [True]
+    level[5, 1] = DOOR
+    assert not fov.visible(0, 1)[1, 9]
+    assert fov.can_see([(0, 1)], [(9, 1)]).tolist() == [False]
+    assert fov.chunks(0, 1) == {(0, 0)}
+
+def test_field_of_view_bounds_its_caches(monkeypatch):
+    import xash.fov
+    monkeypatch.setattr(xash.fov, "PAIRS_CACHE_SIZE", 5)
+    level = Level(10, 3)
+    level.fill(0, 1, 10, 2, FLOOR)
+    fov = FieldOfView(level)
+    fov.can_see([(0, 1)] * 10, [(x, 1) for x in range(10)])
+    assert len(fov.pairs) == 5
+    assert list(fov.pairs)[-1] == (0, 1, 9, 1)
+    assert fov.can_see([(0, 1)], [(9, 1)]).tolist() == [True]
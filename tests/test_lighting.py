@@ -0,0 +1,49 @@
+import numpy as np
+
+from lighting import cluster_lights, depth_range, slice_of, Lights
+from xash.level import perspective, look_at
+
+WIDTH, HEIGHT, TILE, SLICES = 320, 240, 32, 16
+
+def test_depth_range():
+    near, far = depth_range(perspective(60.0, 4 / 3.0, 0.05, 100.0))
+    assert np.isclose(near, 0.05) and np.isclose(far, 100.0)
+
+def test_view_positions():
+    lights = Lights([(1.0, 2.0, 3.0)], [4.0], [(1.0, 1.0, 1.0)])
+    view = look_at((1.0, 2.0, 10.0), (1.0, 2.0, 0.0), (0.0, 1.0, 0.0))
+    assert np.allclose(lights.view_positions(view), [(0.0, 0.0, -7.0)])
+    assert lights.add((0, 0, 0), 1.0) == 1 and len(lights) == 2
+
+def test_cluster_lights_is_conservative():
+    """ every light reaching a point in view is listed for its cluster """
+    rng = np.random.RandomState(3)
+    projection = perspective(60.0, WIDTH / float(HEIGHT), 0.05, 100.0)
+    centres = np.column_stack((rng.uniform(-20, 20, (300, 2)), rng.uniform(-60, 5, 300)))
+    radii = rng.uniform(0.5, 6.0, 300)
+    grid, indices = cluster_lights(centres, radii, projection, WIDTH, HEIGHT, TILE, SLICES)
+    tiles_y = -(-HEIGHT // TILE)
+    assert grid.shape == (SLICES * tiles_y, -(-WIDTH // TILE), 2)
+    assert grid[..., 1].sum() == len(indices)
+    near, far = depth_range(projection)
+    inverse = np.linalg.inv(projection)
+    # random points in view, from pixel and depth
+    n = 4000
+    pixel = rng.uniform(0, (WIDTH, HEIGHT), (n, 2))
+    depth = near * (far / near) ** rng.uniform(0, 1, n)
+    clip_z = (projection[2, 2] * -depth + projection[2, 3]) / depth
+    ndc = np.column_stack((pixel / (WIDTH, HEIGHT) * 2 - 1, clip_z, np.ones(n)))
+    points = ndc @ inverse.T
+    points = points[:, :3] / points[:, 3:]
+    s = slice_of(-points[:, 2], near, far, SLICES)
+    tx, ty = (pixel // TILE).astype(int).T
+    for p, cluster in zip(points, zip(s * tiles_y + ty, tx)):
+        first, count = grid[cluster]
+        listed = set(indices[first:first + count].tolist())
+        reaching = np.nonzero(((centres - p) ** 2).sum(1) < radii ** 2)[0]
+        assert set(reaching.tolist()) <= listed
+
+def test_no_lights():
+    grid, indices = cluster_lights(np.zeros((0, 3)), np.zeros(0),
+                                   perspective(60.0, 1.0, 0.1, 50.0), 64, 64, TILE, 4)
+    assert len(indices) == 0 and not grid[..., 1].any()
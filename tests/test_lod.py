@@ -0,0 +1,66 @@
+import numpy as np
+from pyglet.gl import GL_TRIANGLES
+
+from tnvmesh import MeshData, cuboid_data, lod_name
+from meshopt import simplify, position_columns
+from lod import LODSelector, lod_data, bounding_sphere
+
+def grid(n, order="VN"):
+    """ an n x n grid of vertices, bumpy in z, as GL_TRIANGLES """
+    xs, ys = np.meshgrid(np.arange(n), np.arange(n))
+    positions = np.stack((xs.ravel(), ys.ravel(), np.sin(xs.ravel() * 0.3)), axis=1)
+    normals = np.tile((0.0, 0.0, 1.0), (n * n, 1))
+    columns = dict(V=positions, N=normals)
+    vertices = np.hstack([columns[c] for c in order]).astype(np.float32)
+    indices = []
+    for y in range(n - 1):
+        for x in range(n - 1):
+            a = y * n + x
+            indices += [a, a + 1, a + n + 1, a, a + n + 1, a + n]
+    return MeshData(vertices.ravel(), order, dict(grid=(np.array(indices), GL_TRIANGLES)))
+
+def test_simplify_cuts_triangles():
+    data = grid(12)
+    simpler = simplify(data, 0.3)
+    indices, prim = simpler.pieces["grid"]
+    assert prim == GL_TRIANGLES
+    full = len(data.pieces["grid"][0]) // 3
+    assert 0 < len(indices) // 3 <= full * 0.3 + 1
+    assert simpler.vertexdata is data.vertexdata
+
+def test_simplify_finds_positions_by_order():
+    a, b = simplify(grid(12, "VN"), 0.3), simplify(grid(12, "NV"), 0.3)
+    assert len(a.pieces["grid"][0]) == len(b.pieces["grid"][0]) > 0
+    assert position_columns("NV") == slice(3, 6)
+
+def test_lod_data_and_bounding_sphere():
+    data = lod_data(cuboid_data(1.0, 2.0, 3.0), (0.5,))
+    assert set(data.pieces) == {"cuboid", "cuboid@1"}
+    centre, radius = bounding_sphere(grid(5, "NV"))
+    assert np.allclose(centre[:2], (2.0, 2.0))
+    assert radius > 2.0 * np.sqrt(2.0) - 1e-6
+
+def test_lod_name():
+    assert lod_name("walls", 0) == "walls"
+    assert lod_name("walls", 2) == "walls@2"
+
+def test_levels_by_distance():
+    selector = LODSelector((10.0, 20.0))
+    assert [selector.level(d, d) for d in (5.0, 15.0, 25.0)] == [0, 1, 2]
+
+def test_hysteresis():
+    selector = LODSelector((10.0, 20.0), hysteresis=0.1)
+    assert selector.level("prop", 9.5) == 0
+    assert selector.level("prop", 10.5) == 0 # not far enough past 10
+    assert selector.level("prop", 11.5) == 1
+    assert selector.level("prop", 9.5) == 1 # not far enough back
+    assert selector.level("prop", 8.5) == 0
+    assert selector.level("prop", 30.0) == 2 # a jump goes straight there
+    selector.forget("prop")
+    assert selector.level("prop", 10.5) == 1
+
+def test_impostor_level():
+    selector = LODSelector((10.0,), impostor=40.0)
+    assert selector.impostor_level == 2
+    assert selector.level("far", 50.0) == 2
+    assert len(selector.stats["levels"]) == 3
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from pyglet.gl import (GL_TRIANGLES, GL_TRIANGLE_STRIP, GL_TRIANGLE_FAN, GL_LINES,
+                       GL_LINE_LOOP, GL_QUADS, GL_TRIANGLES_ADJACENCY)
+
+from tnvmesh import MeshData
+from meshbatch import MeshBatch, list_indices, translation, rotation_z, transform_vertices
+
+def triangle(prim=GL_TRIANGLES, indices=(0, 1, 2)):
+    return MeshData(np.array([0, 0, 0, 0, 0, 1,
+                              1, 0, 0, 0, 0, 1,
+                              0, 1, 0, 0, 0, 1,
+                              1, 1, 0, 0, 0, 1], dtype=np.float32), "VN",
+                    dict(face=(list(indices), prim)))
+
+def test_list_indices():
+    indices, prim = list_indices([0, 1, 2, 3], GL_TRIANGLE_STRIP)
+    assert prim == GL_TRIANGLES
+    assert indices.tolist() == [0, 1, 2, 2, 1, 3]
+    indices, prim = list_indices([0, 1, 2, 3], GL_TRIANGLE_FAN)
+    assert indices.tolist() == [0, 1, 2, 0, 2, 3]
+    indices, prim = list_indices([0, 1, 2], GL_LINE_LOOP)
+    assert prim == GL_LINES
+    assert indices.tolist() == [0, 1, 1, 2, 2, 0]
+    assert list_indices([0, 1, 2, 3], GL_QUADS)[1] == GL_QUADS
+    with pytest.raises(ValueError):
+        list_indices(range(6), GL_TRIANGLES_ADJACENCY)
+
+def test_add_offsets_and_transforms():
+    batch = MeshBatch()
+    batch.add(triangle())
+    batch.add(triangle(), translation(10, 0, 0))
+    vertex_arrays, index_lists, prims, nvertices = batch.groups["VN"]
+    assert nvertices == 8
+    assert [a.tolist() for a in index_lists["face"]] == [[0, 1, 2], [4, 5, 6]]
+    assert vertex_arrays[1][:, 0].tolist() == [10, 11, 10, 11]
+
+def test_add_merges_strips_as_lists():
+    batch = MeshBatch()
+    batch.add(triangle())
+    batch.add(triangle(GL_TRIANGLE_STRIP, (0, 1, 2, 3)))
+    assert batch.groups["VN"][2]["face"] == GL_TRIANGLES
+    assert batch.groups["VN"][1]["face"][1].tolist() == [4, 5, 6, 6, 5, 7]
+
+def test_add_rejects_without_changing_anything():
+    batch = MeshBatch()
+    batch.add(triangle())
+    before = batch.groups["VN"][3]
+    with pytest.raises(ValueError):
+        batch.add(triangle(GL_LINES, (0, 1)))
+    assert batch.groups["VN"][3] == before
+    assert len(batch.groups["VN"][0]) == 1
+    with pytest.raises(ValueError):
+        MeshBatch().add(triangle(GL_TRIANGLES_ADJACENCY, range(6)))
+
+class Built:
+    """ stands in for a built TNVMesh """
+    released = False
+    def release(self):
+        self.released = True
+
+def test_clear_releases_what_was_built():
+    batch = MeshBatch()
+    batch.add(triangle())
+    built = Built()
+    batch.meshes = [built]
+    batch.clear()
+    assert batch.groups == {} and batch.meshes == []
+    assert built.released
+
+def test_transform_normals():
+    vertices = np.array([[1, 0, 0, 1, 0, 0]], dtype=np.float32)
+    transform_vertices(vertices, "VN", rotation_z(90) @ translation(0, 0, 5))
+    assert np.allclose(vertices, [[0, 1, 5, 0, 1, 0]], atol=1e-6)
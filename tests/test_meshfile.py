@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from pyglet.gl import GL_QUADS, GL_TRIANGLES
+
+import meshfile
+from tnvmesh import MeshData, cuboid_data
+from meshfile import save, load_meshdata, content_key, MeshCache
+
+def test_round_trip(tmp_path):
+    data = cuboid_data(1.0, 2.0, 3.0)
+    data.pieces["top"] = (np.arange(300, dtype=np.int64) % 24, GL_TRIANGLES)
+    path = str(tmp_path / "cuboid.tnvm")
+    save(path, data)
+    loaded = load_meshdata(path)
+    assert loaded.order == data.order
+    assert np.array_equal(loaded.vertexdata, np.asarray(data.vertexdata, dtype=np.float32))
+    for name, (indices, prim) in data.pieces.items():
+        assert loaded.pieces[name][1] == prim
+        assert np.array_equal(loaded.pieces[name][0], np.asarray(indices))
+    assert [p.name for p in tmp_path.iterdir()] == ["cuboid.tnvm"] # no temporary left
+
+def test_not_a_mesh_file(tmp_path):
+    path = tmp_path / "junk.tnvm"
+    path.write_bytes(b"JUNK" + bytes(60))
+    with pytest.raises(ValueError):
+        load_meshdata(str(path))
+
+def plane(n):
+    return MeshData(np.zeros(n * 3, dtype=np.float32), "V",
+                    dict(plane=(list(range(n)), GL_QUADS)))
+
+def test_content_key():
+    tiles = np.zeros((4, 4), dtype=np.uint8)
+    assert content_key(plane, 4) == content_key(plane, 4)
+    assert content_key(plane, 4) != content_key(plane, 8)
+    assert content_key(plane, 4) != content_key(plane, 4, version=1)
+    assert content_key(cuboid_data, tiles) != content_key(cuboid_data, tiles + 1)
+
+def test_cache(tmp_path):
+    cache = MeshCache(str(tmp_path))
+    first = cache.meshdata(plane, 8)
+    again = cache.meshdata(plane, 8)
+    assert cache.stats == dict(hits=1, misses=1)
+    assert np.array_equal(first.pieces["plane"][0], again.pieces["plane"][0])
+    assert cache.meshdata(lambda: None) is None
+    assert cache.meshdata(lambda: None) is None
+    assert cache.stats == dict(hits=2, misses=2)
@@ -0,0 +1,23 @@
+import numpy as np
+from pyglet.gl import GL_TRIANGLES, GL_QUADS, GL_TRIANGLE_STRIP
+
+from meshopt import triangulate, acmr, optimize, floor_data
+
+def test_triangulate():
+    assert triangulate([0, 1, 2, 3], GL_QUADS).tolist() == [[0, 1, 2], [0, 2, 3]]
+    # the degenerate triangles joining two strips are dropped
+    strip = triangulate([0, 1, 2, 3, 3, 4, 4, 5, 6], GL_TRIANGLE_STRIP)
+    assert strip.tolist() == [[0, 1, 2], [2, 1, 3], [4, 5, 6]]
+
+def test_optimize_merges_and_improves_acmr():
+    data = floor_data(16, 16)
+    optimised, stats = optimize(data)
+    assert stats["vertices"] == (16 * 16 * 4, 17 * 17)
+    before, after = stats["floor"]
+    assert after < before
+    indices, prim = optimised.pieces["floor"]
+    assert prim == GL_TRIANGLES and len(indices) == 16 * 16 * 6
+
+def test_acmr():
+    assert acmr(np.array([[0, 1, 2]])) == 3.0
+    assert acmr(np.array([[0, 1, 2], [2, 1, 3]])) == 2.0
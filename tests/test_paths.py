@@ -0,0 +1,44 @@
+import numpy as np
+
+from xash.level import Level, random_level, FLOOR, ROCK, DOOR, OPEN_DOOR, WALKABLE
+from xash.paths import FlowField, PathService
+
+def test_flow_field_distances():
+    level = Level(10, 5)
+    level.fill(1, 1, 9, 2, FLOOR)
+    field = FlowField(level, [(1, 1)])
+    assert field.distance(8, 1) == 7
+    assert field.distance(0, 0) is None
+    assert field.step([(8, 1), (1, 1)]).tolist() == [[7, 1], [1, 1]]
+    assert FlowField(level, [(1, 1)], maxdist=3).distance(8, 1) is None
+
+def test_repair_matches_compute():
+    """ repairing after digging and filling gives the same distances
+      as computing from scratch """
+    level = random_level(48, 48, rooms=12, seed=11)
+    ys, xs = np.nonzero(np.isin(level.tiles, WALKABLE))
+    field = FlowField(level, [(xs[0], ys[0]), (xs[-1], ys[-1])])
+    rng = np.random.RandomState(5)
+    for step in range(30):
+        x, y = rng.randint(1, 47, 2)
+        level.fill(x, y, x + rng.randint(1, 4), y + rng.randint(1, 4),
+                   (FLOOR, ROCK, OPEN_DOOR, DOOR)[step % 4])
+        field.update()
+        fresh = FlowField(level, field.goals)
+        assert np.array_equal(field.dist, fresh.dist)
+
+def test_routes_follow_doors():
+    level = Level(20, 5)
+    level.fill(1, 1, 19, 2, FLOOR)
+    paths = PathService(level)
+    assert paths.cell_at(2, 1) == paths.cell_at(17, 1)
+    level[10, 1] = DOOR # splits the corridor
+    assert paths.cell_at(2, 1) != paths.cell_at(17, 1)
+    assert paths.route((2, 1), (17, 1)) is None
+    level[10, 1] = OPEN_DOOR
+    route = paths.route((2, 1), (17, 1))
+    assert route[0] == paths.cell_at(2, 1) and route[-1] == paths.cell_at(17, 1)
+    assert paths.route((2, 1), (17, 1)) == route
+    assert paths.stats["route_hits"] == 1
+    level[10, 1] = FLOOR
+    assert paths.cell_at(2, 1) == paths.cell_at(17, 1)
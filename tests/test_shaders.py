@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from pyglet.gl import GL_FLOAT_MAT4, GL_FLOAT_MAT2x3, GL_FLOAT_VEC4
+
+from shaders import Uniform
+
+def test_matrices_are_row_major_in_any_container():
+    uniform = Uniform("m", 0, GL_FLOAT_MAT4, 1)
+    m = np.arange(16.0).reshape(4, 4)
+    expected = tuple(m.T.ravel().tolist())
+    assert uniform.flat(m) == expected
+    assert uniform.flat(m.tolist()) == expected
+    assert uniform.flat(m.ravel().tolist()) == expected
+
+def test_non_square_matrices():
+    # mat2x3: 2 columns of 3 rows
+    uniform = Uniform("m", 0, GL_FLOAT_MAT2x3, 2)
+    rows = [[1, 2], [3, 4], [5, 6]]
+    assert uniform.flat(rows) == (1, 3, 5, 2, 4, 6)
+    assert uniform.flat([rows, rows]) == (1, 3, 5, 2, 4, 6) * 2
+
+def test_lengths_are_checked():
+    uniform = Uniform("v", 0, GL_FLOAT_VEC4, 3)
+    assert uniform.flat([[1, 2, 3, 4], [5, 6, 7, 8]]) == tuple(range(1, 9))
+    for bad in ([1, 2, 3], [], list(range(16))):
+        with pytest.raises(ValueError):
+            uniform.flat(bad)
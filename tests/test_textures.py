@@ -0,0 +1,7 @@
+import pytest
+
+from textures import TextureArray
+
+def test_empty_texture_array_says_so():
+    with pytest.raises(ValueError, match="no layers"):
+        TextureArray(4).build()
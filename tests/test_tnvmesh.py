@@ -0,0 +1,44 @@
+import array
+import ctypes
+
+import numpy as np
+import pytest
+
+from tnvmesh import gl_array, index_typecode, attribute_offsets
+
+def test_gl_array_uses_float32_in_place():
+    data = np.arange(12, dtype=np.float32)
+    arr = gl_array(data, "f")
+    assert len(arr) == 12
+    assert ctypes.addressof(arr) == data.ctypes.data
+    data[3] = 99.0
+    assert arr[3] == 99.0
+
+def test_gl_array_converts_other_types():
+    assert list(gl_array([1, 2, 3], "f")) == [1.0, 2.0, 3.0]
+    assert list(gl_array(np.arange(4, dtype=np.int64), "f")) == [0.0, 1.0, 2.0, 3.0]
+    assert list(gl_array(np.arange(3, dtype=np.int64), "I")) == [0, 1, 2]
+    assert list(gl_array(array.array("f", [0.5, 1.5]), "f")) == [0.5, 1.5]
+
+def test_gl_array_takes_raw_bytes():
+    raw = np.array([1.0, 2.0], dtype=np.float32).tobytes()
+    assert list(gl_array(raw, "f")) == [1.0, 2.0]
+    assert list(gl_array(memoryview(bytearray(raw)), "f")) == [1.0, 2.0]
+
+def test_gl_array_copies_non_contiguous():
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)[:, 1]
+    assert list(gl_array(data, "f")) == [1.0, 5.0, 9.0]
+
+def test_gl_array_rejects_partial_items():
+    with pytest.raises(ValueError):
+        gl_array(b"\0" * 6, "f")
+
+def test_index_typecode():
+    assert index_typecode([0, 255]) == "B"
+    assert index_typecode(np.array([256])) == "H"
+    assert index_typecode(np.array([70000])) == "I"
+    assert index_typecode([]) == "B"
+
+def test_attribute_offsets():
+    assert attribute_offsets("VNTU") == (40, dict(V=0, N=12, T=24, U=32))
+    assert attribute_offsets("NVL") == (28, dict(N=0, V=12, L=24))
@@ -0,0 +1,52 @@
+import numpy as np
+
+from xash.level import Level, random_level, FLOOR, DOOR, OPEN_DOOR, ROCK, WALL_HEIGHT
+from xash.visibility import PVS, find_cells, floor_plan, permissive_fov, plan_key
+from xash.fov import shadowcast, opaque
+
+def test_find_cells_split_at_doors():
+    level = Level(12, 3)
+    level.fill(1, 1, 11, 2, FLOOR)
+    level[6, 1] = DOOR
+    cells, ncells = find_cells(floor_plan(level))
+    assert ncells == 3
+    assert cells[1, 2] != cells[1, 9]
+    assert cells[0, 0] < 0
+
+def test_permissive_fov_sees_round_a_pillar():
+    level = Level(9, 9)
+    level.fill(1, 1, 8, 8, FLOOR)
+    level[4, 4] = ROCK
+    rows = (floor_plan(level) == ROCK).tolist()
+    seen = [[False] * 9 for _ in range(9)]
+    permissive_fov(rows, 2, 4, seen)
+    seen = np.array(seen)
+    assert seen[4, 4] # the pillar itself
+    assert seen[3, 6] and seen[5, 6]
+    assert seen[0, 4] and seen[8, 8] # walls all round
+
+def test_pvs_is_conservative():
+    """ whatever shadowcasting sees from a tile, the PVS of its cell has """
+    level = random_level(48, 48, rooms=12, seed=7)
+    pvs = PVS.compute(level)
+    blocked = opaque(level.tiles)
+    rng = np.random.RandomState(1)
+    ys, xs = np.nonzero(level.tiles == FLOOR)
+    size = level.chunk_size
+    for i in rng.choice(len(xs), 60, replace=False):
+        x, y = xs[i], ys[i]
+        chunks = pvs.chunks_from((x + 0.5, y + 0.5, 0.5))
+        sy, sx = np.nonzero(shadowcast(blocked, x, y, radius=100))
+        assert set(zip((sx // size).tolist(), (sy // size).tolist())) <= chunks
+    assert pvs.chunks_from((xs[0] + 0.5, ys[0] + 0.5, WALL_HEIGHT + 1.0)) is None
+    assert pvs.matches(level)
+
+def test_plan_key_ignores_doors_opening():
+    level = random_level(32, 32, rooms=6, seed=2)
+    key = plan_key(level)
+    doors = np.argwhere(level.tiles == DOOR)
+    y, x = doors[0]
+    level[x, y] = OPEN_DOOR
+    assert plan_key(level) == key
+    level[x, y] = ROCK
+    assert plan_key(level) != key
@@ -0,0 +1,181 @@
+"""
+
+  Field of view and line of sight on a Level
+
+  The player's view is found by recursive shadowcasting (Bjorn
+  Bergstrom's, one octant at a time), which only looks at the tiles
+  that can be seen.  Monsters ask line_of_sight() about many
+  (source, target) pairs at once: every line is sampled in one numpy
+  operation, so a turn full of monsters costs a handful of array ops
+  rather than a Python loop per monster per tile.
+
+  Rock and closed doors block sight.  FieldOfView caches both kinds of
+  answer keyed by position, up to a limit with the least recently used
+  dropped first, and throws them away when the level's revision changes,
+  which is what opening or closing a door does.
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from xash.level import ROCK, DOOR
+
+OPAQUE = (ROCK, DOOR)
+RADIUS = 12
+CACHE_SIZE = 64 # fields of view remembered
+PAIRS_CACHE_SIZE = CACHE_SIZE * 64 # lines of sight remembered
+
+# (xx, xy, yx, yy) transforms from octant coordinates to the grid
+OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+           (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+def opaque(tiles):
+    return np.isin(tiles, OPAQUE)
+
+def shadowcast(blocked, x, y, radius=RADIUS, rows=None):
+    """ boolean grid of the tiles visible from (x, y), given a boolean
+      grid of tiles that block sight (and optionally the same as nested
+      lists).  Blocking tiles that are seen (walls, doors) are visible
+      themselves """
+    height, width = blocked.shape
+    seen = np.zeros(blocked.shape, dtype=bool)
+    if not (0 <= x < width and 0 <= y < height):
+        return seen
+    seen[y, x] = True
+    # plain lists are much faster than numpy for single elements
+    if rows is None:
+        rows = blocked.tolist()
+    r2 = radius * radius
+
+    def cast(row, start, end, xx, xy, yx, yy):
+        if start < end:
+            return
+        new_start = start
+        for j in range(row, radius + 1):
+            dx, dy = -j - 1, -j
+            wall = False
+            while dx <= 0:
+                dx += 1
+                # slopes of the left and right edges of this tile
+                l_slope = (dx - 0.5) / (dy + 0.5)
+                r_slope = (dx + 0.5) / (dy - 0.5)
+                if start < r_slope:
+                    continue
+                elif end > l_slope:
+                    break
+                tx, ty = x + dx * xx + dy * xy, y + dx * yx + dy * yy
+                if 0 <= tx < width and 0 <= ty < height:
+                    solid = rows[ty][tx]
+                    if dx * dx + dy * dy <= r2:
+                        seen[ty, tx] = True
+                else:
+                    solid = True
+                if wall:
+                    if solid:
+                        new_start = r_slope
+                    else:
+                        wall = False
+                        start = new_start
+                elif solid and j < radius:
+                    wall = True
+                    cast(j + 1, start, l_slope, xx, xy, yx, yy)
+                    new_start = r_slope
+            if wall:
+                break
+
+    for octant in OCTANTS:
+        cast(1, 1.0, 0.0, *octant)
+    return seen
+
+def line_of_sight(blocked, sources, targets, radius=None):
+    """ for each pair of (x, y) tiles in the (n, 2) arrays sources and
+      targets, whether nothing blocking lies on the line between them
+      (the end tiles themselves don't count).  Pairs further apart than
+      radius, if given, can't see each other """
+    sources = np.asarray(sources, dtype=np.int64).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.int64).reshape(-1, 2)
+    if not len(sources):
+        return np.zeros(0, dtype=bool)
+    height, width = blocked.shape
+    delta = targets - sources
+    steps = np.abs(delta).max(axis=1)
+    nsteps = max(int(steps.max()), 1)
+    # fraction of the way along each line at each step: (n, nsteps)
+    t = np.arange(1, nsteps)[None, :] / np.maximum(steps, 1)[:, None]
+    inner = t < 1.0
+    px = np.rint(sources[:, 0, None] + delta[:, 0, None] * t).astype(np.int64)
+    py = np.rint(sources[:, 1, None] + delta[:, 1, None] * t).astype(np.int64)
+    np.clip(px, 0, width - 1, out=px)
+    np.clip(py, 0, height - 1, out=py)
+    clear = ~(blocked[py, px] & inner).any(axis=1)
+    if radius is not None:
+        clear &= (delta * delta).sum(axis=1) <= radius * radius
+    return clear
+
+class FieldOfView:
+    """ cached FOV and line of sight for a Level """
+    def __init__(self, level, radius=RADIUS):
+        self.level = level
+        self.radius = radius
+        self.revision = None
+        self.blocked = None
+        self.rows = None
+        self.fovs = OrderedDict() # (x, y) -> seen grid, most recent last
+        self.pairs = OrderedDict() # (sx, sy, tx, ty) -> bool, most recent last
+        self.stats = dict(hits=0, misses=0)
+
+    def check(self):
+        """ forget everything if the level has changed """
+        if self.revision != self.level.revision:
+            self.revision = self.level.revision
+            self.blocked = opaque(self.level.tiles)
+            self.rows = self.blocked.tolist()
+            self.fovs.clear()
+            self.pairs.clear()
+
+    def visible(self, x, y):
+        """ boolean grid of tiles visible from (x, y) """
+        self.check()
+        found = self.fovs.get((x, y))
+        if found is not None:
+            self.fovs.move_to_end((x, y))
+            self.stats["hits"] += 1
+            return found
+        self.stats["misses"] += 1
+        found = self.fovs[(x, y)] = shadowcast(self.blocked, x, y, self.radius, self.rows)
+        if len(self.fovs) > CACHE_SIZE:
+            self.fovs.popitem(last=False)
+        return found
+
+    def can_see(self, sources, targets):
+        """ batched line_of_sight() within the radius, through the cache """
+        self.check()
+        sources = np.asarray(sources, dtype=np.int64).reshape(-1, 2)
+        targets = np.asarray(targets, dtype=np.int64).reshape(-1, 2)
+        keys = [tuple(k) for k in np.hstack((sources, targets)).tolist()]
+        result = np.zeros(len(keys), dtype=bool)
+        todo = []
+        for i, key in enumerate(keys):
+            known = self.pairs.get(key)
+            if known is None:
+                todo.append(i)
+            else:
+                self.pairs.move_to_end(key)
+                result[i] = known
+        self.stats["hits"] += len(keys) - len(todo)
+        self.stats["misses"] += len(todo)
+        if todo:
+            found = line_of_sight(self.blocked, sources[todo], targets[todo], self.radius)
+            result[todo] = found
+            self.pairs.update(zip((keys[i] for i in todo), found.tolist()))
+            while len(self.pairs) > PAIRS_CACHE_SIZE:
+                self.pairs.popitem(last=False)
+        return result
+
+    def chunks(self, x, y):
+        """ set of (cx, cy) keys of level chunks with something visible
+          from (x, y) in them, for LevelView.only """
+        size = self.level.chunk_size
+        ys, xs = np.nonzero(self.visible(x, y))
+        return set(zip((xs // size).tolist(), (ys // size).tolist()))
@@ -0,0 +1,428 @@
+"""
+
+  Dungeon levels
+
+  A Level is a grid of tile codes, one byte each, in a numpy array.
+  For drawing it is cut into square chunks, each baked into one TNVMesh
+  with pieces "floor", "walls" and "doors".  A LevelView keeps those
+  meshes up to date as tiles change, rebuilding only the chunks that
+  changed (at once, or with load() on an AssetLoader's workers), and
+  draws only the chunks whose bounding box is inside the view frustum
+  (and, given a visibility.PVS, potentially visible from where the
+  camera is).
+
+  Coordinates: tile (x, y) covers x..x+1, y..y+1 with the floor at z=0
+  and z up, as in the lab tests.
+
+"""
+import random
+import logging
+from collections import deque
+from functools import partial
+
+import numpy as np
+from pyglet.gl import *
+
+import tnvmesh
+from textures import apply_layers
+from lighting import Lights
+
+ROCK, FLOOR, DOOR, OPEN_DOOR = range(4)
+WALKABLE = (FLOOR, OPEN_DOOR)
+CHUNK_SIZE = 16
+WALL_HEIGHT = 1.0
+ORDER = 'VNTU'
+HISTORY = 256 # changes remembered for incremental updates
+MESH_VERSION = 1 # change when chunk meshes change, to miss cached ones
+
+# (dx, dy) to each neighbouring tile
+DIRECTIONS = ((1, 0), (0, 1), (-1, 0), (0, -1))
+
+class Level:
+    def __init__(self, width, height, chunk_size=CHUNK_SIZE):
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.tiles = np.full((height, width), ROCK, dtype=np.uint8)
+        self.revision = 0 # bumped by every change
+        self.history = deque(maxlen=HISTORY) # (revision, x0, y0, x1, y1)
+        self.nchunks = (-(-width // chunk_size), -(-height // chunk_size))
+        self.dirty = set((cx, cy) for cx in range(self.nchunks[0])
+                         for cy in range(self.nchunks[1]))
+
+    @property
+    def bytes_per_tile(self):
+        return self.tiles.nbytes / float(self.tiles.size)
+
+    def __getitem__(self, xy):
+        x, y = xy
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return int(self.tiles[y, x])
+        return ROCK
+
+    def __setitem__(self, xy, tile):
+        self.fill(xy[0], xy[1], xy[0] + 1, xy[1] + 1, tile)
+
+    def fill(self, x0, y0, x1, y1, tile):
+        """ set tiles x0 <= x < x1, y0 <= y < y1 """
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.tiles[y0:y1, x0:x1] = tile
+        self.revision += 1
+        self.history.append((self.revision, x0, y0, x1, y1))
+        # walls on the edge of a chunk belong to the tiles next to them
+        size = self.chunk_size
+        for cx in range(max(x0 - 1, 0) // size, min(x1, self.width - 1) // size + 1):
+            for cy in range(max(y0 - 1, 0) // size, min(y1, self.height - 1) // size + 1):
+                self.dirty.add((cx, cy))
+
+    def changes_since(self, revision):
+        """ rectangles (x0, y0, x1, y1) changed after revision, or None
+          if the history doesn't go back that far """
+        if revision == self.revision:
+            return []
+        if not self.history or self.history[0][0] > revision + 1:
+            return None
+        return [change[1:] for change in self.history if change[0] > revision]
+
+    def chunk_bounds(self, cx, cy):
+        """ ((xmin, ymin, zmin), (xmax, ymax, zmax)) of a chunk """
+        size = self.chunk_size
+        x0, y0 = cx * size, cy * size
+        return ((x0, y0, 0.0),
+                (min(x0 + size, self.width), min(y0 + size, self.height), WALL_HEIGHT))
+
+    def chunk_tiles(self, cx, cy):
+        """ the tiles of a chunk with a border of their neighbours, and
+          rock outside the level: all its mesh depends on """
+        size = self.chunk_size
+        x0, y0 = cx * size, cy * size
+        padded = np.full((size + 2, size + 2), ROCK, dtype=np.uint8)
+        part = self.tiles[max(y0 - 1, 0):y0 + size + 1, max(x0 - 1, 0):x0 + size + 1]
+        oy, ox = (1 if y0 == 0 else 0), (1 if x0 == 0 else 0)
+        padded[oy:oy + part.shape[0], ox:ox + part.shape[1]] = part
+        return padded
+
+    def chunk_meshdata(self, cx, cy):
+        """ MeshData for one chunk, or None if there is nothing in it """
+        return tiles_meshdata(self.chunk_tiles(cx, cy),
+                              cx * self.chunk_size, cy * self.chunk_size)
+
+def tiles_meshdata(padded, x0, y0):
+    """ MeshData for the tiles inside padded (see Level.chunk_tiles()),
+      the first of them at (x0, y0), or None if they are all rock """
+    inside = padded[1:-1, 1:-1]
+    open_ = np.isin(inside, WALKABLE)
+    pieces = {}
+    quads = []
+    nquads = 0
+    for name, faces in (("floor", floor_quads(np.nonzero(inside != ROCK), x0, y0)),
+                        ("walls", wall_quads(padded, open_, ROCK, x0, y0)),
+                        ("doors", wall_quads(padded, open_, DOOR, x0, y0))):
+        if len(faces):
+            quads.append(faces)
+            pieces[name] = (np.arange(nquads * 4, (nquads + len(faces)) * 4), GL_QUADS)
+            nquads += len(faces)
+    if not quads:
+        return None
+    return tnvmesh.MeshData(np.concatenate(quads).astype(np.float32).ravel(), ORDER, pieces)
+
+def floor_quads(yx, x0, y0):
+    """ (n, 4, 10) vertex data for floor quads on tiles at (ys, xs) """
+    ys, xs = yx
+    corners = np.array(((0, 0), (1, 0), (1, 1), (0, 1)), dtype=np.float32)
+    quads = np.zeros((len(xs), 4, 10), dtype=np.float32)
+    quads[:, :, 0] = (xs + x0)[:, None] + corners[:, 0]
+    quads[:, :, 1] = (ys + y0)[:, None] + corners[:, 1]
+    quads[:, :, 5] = 1.0 # normal up
+    quads[:, :, 6:8] = quads[:, :, 0:2]
+    quads[:, :, 8:10] = corners
+    return quads
+
+def wall_quads(padded, open_, solid, x0, y0):
+    """ (n, 4, 10) vertex data for wall faces where an open tile in the
+      chunk is next to a tile of type solid, facing the open tile """
+    size = open_.shape[0]
+    result = []
+    for dx, dy in DIRECTIONS:
+        beyond = padded[1 + dy:1 + dy + size, 1 + dx:1 + dx + size]
+        ys, xs = np.nonzero(open_ & (beyond == solid))
+        if not len(xs):
+            continue
+        n = np.array((-dx, -dy), dtype=np.float32)
+        along = np.array((-n[1], n[0]), dtype=np.float32) # bottom edge, left to right
+        mid = np.stack((xs + x0 + 0.5 + 0.5 * dx, ys + y0 + 0.5 + 0.5 * dy), axis=1)
+        a, b = mid - 0.5 * along, mid + 0.5 * along
+        quads = np.zeros((len(xs), 4, 10), dtype=np.float32)
+        quads[:, 0, 0:2], quads[:, 1, 0:2] = a, b
+        quads[:, 2, 0:2], quads[:, 3, 0:2] = b, a
+        quads[:, 2:4, 2] = WALL_HEIGHT
+        quads[:, :, 3:5] = n
+        # texture 0 runs along the wall in world units, 1 is 0-1 per face
+        u = (a * along).sum(axis=1)
+        quads[:, :, 6] = u[:, None] + np.array((0, 1, 1, 0))
+        quads[:, :, 7] = quads[:, :, 2]
+        quads[:, :, 8] = (0, 1, 1, 0)
+        quads[:, :, 9] = (0, 0, 1, 1)
+        result.append(quads)
+    if not result:
+        return np.zeros((0, 4, 10), dtype=np.float32)
+    return np.concatenate(result)
+
+def random_level(width, height, rooms=30, seed=None):
+    """ rectangular rooms joined by corridors, with doors where the
+      corridors enter the rooms """
+    rng = random.Random(seed)
+    level = Level(width, height)
+    centres = []
+    placed = []
+    for i in range(rooms * 4):
+        if len(placed) == rooms:
+            break
+        w, h = rng.randint(3, 10), rng.randint(3, 8)
+        x, y = rng.randint(1, width - w - 2), rng.randint(1, height - h - 2)
+        if any(x - 1 < px + pw and px - 1 < x + w and y - 1 < py + ph and py - 1 < y + h
+               for px, py, pw, ph in placed):
+            continue
+        placed.append((x, y, w, h))
+        level.fill(x, y, x + w, y + h, FLOOR)
+        centres.append((x + w // 2, y + h // 2))
+    for (ax, ay), (bx, by) in zip(centres, centres[1:]):
+        level.fill(min(ax, bx), ay, max(ax, bx) + 1, ay + 1, FLOOR)
+        level.fill(bx, min(ay, by), bx + 1, max(ay, by) + 1, FLOOR)
+    # doors where a corridor leaves a room: just outside its edge,
+    # with rock either side along the edge
+    for x, y, w, h in placed:
+        edge = ([(tx, y - 1, 1, 0) for tx in range(x, x + w)]
+                + [(tx, y + h, 1, 0) for tx in range(x, x + w)]
+                + [(x - 1, ty, 0, 1) for ty in range(y, y + h)]
+                + [(x + w, ty, 0, 1) for ty in range(y, y + h)])
+        for tx, ty, sx, sy in edge:
+            if (level[tx, ty] == FLOOR and level[tx + sx, ty + sy] == ROCK
+                and level[tx - sx, ty - sy] == ROCK):
+                level[tx, ty] = DOOR
+    return level
+
+def build_chunk(padded, x0, y0, layers=None, cache=None):
+    """ tiles_meshdata() through a meshfile.MeshCache if there is one,
+      with an L attribute from layers if given (see LevelView) """
+    if cache is None:
+        data = tiles_meshdata(padded, x0, y0)
+    else:
+        data = cache.meshdata(tiles_meshdata, padded, x0, y0, version=MESH_VERSION)
+    if data is not None and layers:
+        data = apply_layers(data, layers)
+    return data
+
+def torches(level, n, radius=4.0, seed=None):
+    """ lighting.Lights for n torches on walls, each just off a floor
+      tile beside rock, at random """
+    rng = np.random.RandomState(seed)
+    open_ = level.tiles == FLOOR
+    spots = []
+    for dx, dy in DIRECTIONS:
+        rock = np.full(open_.shape, True)
+        h, w = open_.shape
+        rock[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)] = (
+            level.tiles[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] == ROCK)
+        ys, xs = np.nonzero(open_ & rock)
+        spots.append(np.stack((xs + 0.5 + 0.4 * dx, ys + 0.5 + 0.4 * dy), axis=1))
+    spots = np.concatenate(spots)
+    chosen = spots[rng.choice(len(spots), min(n, len(spots)), replace=False)]
+    colours = np.array((1.0, 0.7, 0.35)) * rng.uniform(0.7, 1.0, (len(chosen), 1))
+    return Lights(np.column_stack((chosen, np.full(len(chosen), 0.75 * WALL_HEIGHT))),
+                  np.full(len(chosen), radius), colours)
+
+
+def frustum_planes(matrix):
+    """ the six planes (a, b, c, d), inside where ax+by+cz+d >= 0, of
+      the view frustum for a projection * modelview matrix (numpy, row-major) """
+    m = np.asarray(matrix, dtype=np.float64)
+    r0, r1, r2, r3 = m
+    return np.array((r3 + r0, r3 - r0, r3 + r1, r3 - r1, r3 + r2, r3 - r2))
+
+def current_matrices():
+    """ (projection, modelview) from the fixed-function matrix stacks """
+    proj, model = (GLfloat * 16)(), (GLfloat * 16)()
+    glGetFloatv(GL_PROJECTION_MATRIX, proj)
+    glGetFloatv(GL_MODELVIEW_MATRIX, model)
+    # GL matrices are column-major
+    return np.array(proj).reshape(4, 4).T, np.array(model).reshape(4, 4).T
+
+def current_matrix():
+    """ projection * modelview from the fixed-function matrix stacks """
+    proj, model = current_matrices()
+    return proj @ model
+
+def eye_position(modelview):
+    """ the camera position in world coordinates """
+    return np.linalg.inv(modelview)[:3, 3]
+
+def perspective(fovy, aspect, near, far):
+    """ the matrix gluPerspective would make (numpy, row-major) """
+    f = 1.0 / np.tan(np.radians(fovy) / 2.0)
+    return np.array(((f / aspect, 0, 0, 0), (0, f, 0, 0),
+                     (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+                     (0, 0, -1, 0)))
+
+def look_at(eye, centre, up=(0.0, 0.0, 1.0)):
+    """ the matrix gluLookAt would make (numpy, row-major) """
+    eye = np.asarray(eye, dtype=np.float64)
+    forward = np.asarray(centre, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    side = np.cross(forward, up)
+    side /= np.linalg.norm(side)
+    upward = np.cross(side, forward)
+    m = np.identity(4)
+    m[0, :3], m[1, :3], m[2, :3] = side, upward, -forward
+    m[:3, 3] = -m[:3, :3] @ eye
+    return m
+
+def boxes_visible(planes, lo, hi):
+    """ boolean array: which of the boxes lo[i]..hi[i] are at least
+      partly inside all the planes """
+    normals, d = planes[:, :3], planes[:, 3]
+    corner = np.where(normals[None, :, :] > 0, hi[:, None, :], lo[:, None, :])
+    return ((corner * normals[None]).sum(axis=2) + d >= 0).all(axis=1)
+
+
+class LevelView:
+    """ the TNVMesh chunks of a Level, for drawing """
+    def __init__(self, level, layers=None, cache=None):
+        self.level = level
+        self.cache = cache # meshfile.MeshCache for chunk meshes, if any
+        self.layers = layers # {piece: TextureArray layer} to give chunks an L attribute
+        self.meshes = {} # (cx, cy) -> TNVMesh
+        self.bounds = {}
+        self.pvs = None # visibility.PVS, if there is one for the level
+        self.only = None # chunk keys to limit drawing to, e.g. from fov
+        self.loading = {} # (cx, cy) -> number of the load() that will replace it
+        self.loads = 0
+        self.stats = dict(chunks=0, drawn=0, rebuilt=0)
+
+    def update(self, limit=None):
+        """ rebuild chunks whose tiles have changed, at most limit of them """
+        level = self.level
+        rebuilt = 0
+        for key in sorted(level.dirty):
+            if limit is not None and rebuilt >= limit:
+                break
+            level.dirty.discard(key)
+            self.loading.pop(key, None)
+            data = self.chunk_data(key)
+            self.replace(key, None if data is None else data.make())
+            rebuilt += 1
+        self.stats["rebuilt"] = rebuilt
+        return rebuilt
+
+    def chunk_job(self, key):
+        """ (fn, args) making the MeshData of a chunk from a copy of its
+          tiles, picklable for AssetLoader processes """
+        level = self.level
+        return build_chunk, (level.chunk_tiles(*key), key[0] * level.chunk_size,
+                             key[1] * level.chunk_size, self.layers, self.cache)
+
+    def chunk_data(self, key):
+        fn, args = self.chunk_job(key)
+        return fn(*args)
+
+    def replace(self, key, mesh):
+        old = self.meshes.pop(key, None)
+        if old is not None and old is not mesh:
+            old.release()
+        if mesh is None:
+            self.bounds.pop(key, None)
+        else:
+            self.meshes[key] = mesh
+            self.bounds[key] = self.level.chunk_bounds(*key)
+
+    def load(self, loader):
+        """ remake the changed chunks on the workers of an
+          assets.AssetLoader instead of now, and return Futures for them.
+          Each chunk's mesh is replaced as its future finishes, unless the
+          chunk has been remade again since """
+        futures = []
+        for key in sorted(self.level.dirty):
+            self.level.dirty.discard(key)
+            self.loads += 1
+            self.loading[key] = self.loads
+            fn, args = self.chunk_job(key)
+            future = loader.mesh(fn, *args)
+            future.add_done_callback(partial(self.loaded, key, self.loads))
+            futures.append(future)
+        return futures
+
+    def loaded(self, key, number, future):
+        if self.loading.get(key) != number:
+            # superseded: give up what it made
+            mesh = None if future.exception() else future.result()
+            if mesh is not None:
+                mesh.release()
+            return
+        del self.loading[key]
+        try:
+            self.replace(key, future.result())
+        except Exception:
+            logging.exception("making chunk %s", key)
+            self.level.dirty.add(key) # try again in update()
+
+    def release(self):
+        """ give up the chunk meshes, e.g. on leaving the level """
+        for mesh in self.meshes.values():
+            mesh.release()
+        self.meshes.clear()
+        self.bounds.clear()
+        self.loading.clear() # anything still loading is dropped when made
+        self.level.dirty.update((cx, cy) for cx in range(self.level.nchunks[0])
+                                for cy in range(self.level.nchunks[1]))
+
+    def visible(self, matrix=None, eye=None):
+        """ keys of the chunks inside the frustum of matrix, by default
+          the current projection * modelview, and in the potentially
+          visible set from the eye position if there is a PVS, and in
+          self.only if that is set """
+        keys = list(self.meshes)
+        if matrix is None:
+            proj, model = current_matrices()
+            matrix = proj @ model
+            if eye is None:
+                eye = eye_position(model)
+        if self.pvs is not None and self.pvs.revision != self.level.revision:
+            # opening doors doesn't matter, digging does
+            if self.pvs.matches(self.level):
+                self.pvs.revision = self.level.revision
+            else:
+                self.pvs = None
+        if self.pvs is not None and eye is not None:
+            seen = self.pvs.chunks_from(eye)
+            if seen is not None:
+                keys = [k for k in keys if k in seen]
+        if self.only is not None:
+            keys = [k for k in keys if k in self.only]
+        if not keys:
+            return []
+        lo = np.array([self.bounds[k][0] for k in keys])
+        hi = np.array([self.bounds[k][1] for k in keys])
+        inside = boxes_visible(frustum_planes(matrix), lo, hi)
+        return [k for k, v in zip(keys, inside) if v]
+
+    def queue(self, renderqueue, program=None, pieces=None, matrix=None, eye=None,
+              keys=None):
+        """ put the visible chunks in a RenderQueue """
+        self.update()
+        if keys is None:
+            keys = self.visible(matrix, eye)
+        for key in keys:
+            renderqueue.add(program, self.meshes[key], pieces)
+        self.stats["chunks"] = len(self.meshes)
+        self.stats["drawn"] = len(keys)
+
+    def draw(self, program=None, pieces=None, matrix=None, eye=None):
+        self.update()
+        keys = self.visible(matrix, eye)
+        for key in keys:
+            self.meshes[key].draw(pieces, program)
+        self.stats["chunks"] = len(self.meshes)
+        self.stats["drawn"] = len(keys)
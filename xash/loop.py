@@ -0,0 +1,129 @@
+"""
+
+  The game loop
+
+  The simulation advances in fixed ticks (rate per second) whatever the
+  frame rate, so the game plays the same on every machine.  Each frame
+  runs as many ticks as real time calls for, then draws with alpha, how
+  far it is between the last tick and the next, so that movement can be
+  interpolated (see Interpolated) and looks smooth at any frame rate.
+
+  If the ticks fall behind (the machine is too slow, or was busy), up to
+  max_ticks run per frame and the frame isn't drawn, so that the time goes
+  to catching up.  After max_skip frames like that the backlog is thrown
+  away: the game slows down rather than spiralling into never drawing.
+
+  With fps set, frames are capped to that rate by sleeping; otherwise
+  the loop runs as fast as vsync (or without it, the machine) allows.
+  timing has the update, render and idle milliseconds of the last frame.
+
+"""
+import time
+from collections import deque
+
+import numpy as np
+import pyglet
+
+MAX_FRAME_TIME = 0.25 # seconds; longer frames (e.g. in a debugger) count as this
+HISTORY = 120         # frames of timing kept for averages
+
+class Interpolated:
+    """ a value, e.g. a position, set once per tick and drawn between
+      its last two settings """
+    def __init__(self, value):
+        self.previous = self.current = np.array(value, dtype=np.float64)
+
+    def set(self, value):
+        self.previous = self.current
+        self.current = np.array(value, dtype=np.float64)
+
+    def at(self, alpha):
+        return self.previous + (self.current - self.previous) * alpha
+
+class GameLoop:
+    def __init__(self, window, update, draw, rate=30.0, fps=None,
+                 max_ticks=5, max_skip=3):
+        self.window = window
+        self.update = update # update(dt) advances the game by one tick
+        self.draw = draw     # draw(alpha) draws the frame
+        self.step = 1.0 / rate
+        self.fps = fps
+        self.max_ticks = max_ticks
+        self.max_skip = max_skip
+        self.lag = 0.0 # seconds of game time not yet simulated
+        self.ticks = 0
+        self.frames = 0
+        self.skipped = 0 # frames not drawn in a row
+        self.stats = dict(dropped=0, discarded=0.0)
+        self.timing = dict(update=0.0, render=0.0, idle=0.0)
+        self.history = deque(maxlen=HISTORY)
+        self.running = False
+
+    @property
+    def alpha(self):
+        return self.lag / self.step
+
+    def frame(self, elapsed):
+        """ tick and draw for elapsed seconds of real time; return whether
+          the frame was drawn """
+        clock = time.perf_counter
+        t0 = clock()
+        self.lag += min(elapsed, MAX_FRAME_TIME)
+        ticks = 0
+        while self.lag >= self.step and ticks < self.max_ticks:
+            self.update(self.step)
+            self.lag -= self.step
+            self.ticks += 1
+            ticks += 1
+        t1 = clock()
+        drawn = True
+        if self.lag >= self.step: # still behind
+            if self.skipped < self.max_skip:
+                drawn = False
+            else:
+                behind = self.lag - self.lag % self.step
+                self.stats["discarded"] += behind
+                self.lag -= behind
+        if drawn:
+            self.skipped = 0
+            self.window.switch_to()
+            self.draw(self.alpha)
+            self.window.flip()
+            self.frames += 1
+        else:
+            self.skipped += 1
+            self.stats["dropped"] += 1
+        t2 = clock()
+        self.timing["update"] = (t1 - t0) * 1000.0
+        self.timing["render"] = (t2 - t1) * 1000.0
+        return drawn
+
+    def run(self):
+        """ until the window closes or stop() """
+        clock = time.perf_counter
+        self.running = True
+        previous = clock()
+        while self.running and not self.window.has_exit:
+            start = clock()
+            self.window.dispatch_events()
+            pyglet.clock.tick(poll=True) # for anything else scheduled
+            self.frame(start - previous)
+            previous = start
+            if self.fps:
+                rest = start + 1.0 / self.fps - clock()
+                if rest > 0:
+                    time.sleep(rest)
+            self.timing["idle"] = max((clock() - start) * 1000.0 - self.timing["update"]
+                                      - self.timing["render"], 0.0)
+            self.history.append((self.timing["update"], self.timing["render"],
+                                 self.timing["idle"]))
+
+    def stop(self):
+        self.running = False
+
+    def averages(self):
+        """ mean update, render and idle ms over recent frames """
+        if not self.history:
+            return dict(self.timing)
+        update, render, idle = np.mean(self.history, axis=0)
+        return dict(update=float(update), render=float(render), idle=float(idle))
@@ -5,46 +5,28 @@
   The harsh economics of treasure-based adventuring
 
 """
+import sys
+import time
 import logging
 import argparse
-import pyglet
-
-def parsesize(wxh):
-    """ split WxH at 'x' and int each component """
-    return tuple(int(n) for n in wxh.split('x'))
-
-def construct_window(width, height, *args, **kw):
-    """ try to construct a window with as high
-    quality settings as possible """
-    for optdict in [
-        dict(major_version=3, minor_version=0,
-             sample_buffers=1, samples=4),
-        dict(sample_buffers=1, samples=4),
-        dict()]:
-        try:
-            config = pyglet.gl.Config(**optdict)
-            win = pyglet.window.Window(
-                width, height,
-                *args, config=config, **kw)
-            return win
-        except pyglet.window.NoSuchConfigException:
-            pass
-    return None
-
-class XashWindow:
-    """ container for pyglet Window displaying the game """
-    def __init__(self, args):
-        try:
-            width, height = parsesize(args.size)
-        except (ValueError, TypeError) as e:
-            logging.error(e)
-            width, height = (1024, 768)
-        win = construct_window(width, height,
-                               fullscreen=args.fullscreen)
-        if win is None:
-            logging.error("No window")
-            raise SystemExit(1)
-        self.win = win
+
+class Startup:
+    """ how long each step of starting up takes """
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.steps = []
+
+    def mark(self, name):
+        """ the step called name has just finished """
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    def report(self, out=sys.stderr):
+        for name, seconds in self.steps:
+            print("{:>24}: {:8.1f} ms".format(name, seconds * 1000.0), file=out)
+        print("{:>24}: {:8.1f} ms".format("total", (self.last - self.start) * 1000.0),
+              file=out)
 
 def main():
     """ read the command line """
@@ -54,7 +36,47 @@ def main():
         const=True, default=False)
     add("--size", metavar="WxH", default="1024x768",
         help="window size e.g. 1024x768")
+    add("--fps", type=float, default=0,
+        help="frame rate cap, 0 for none")
+    add("--no-vsync", dest="vsync", action="store_false", default=True)
+    add("--tick-rate", type=float, default=30.0,
+        help="game ticks per second")
+    add("--timing", action="store_true", default=False,
+        help="log frame timing every 2 seconds")
+    add("--profile", action="store_true", default=False,
+        help="show GL call counts and times over the game")
+    add("--profile-csv", metavar="FILE",
+        help="write the last few hundred frames' profile to FILE on exit")
+    add("--torches", type=int, default=0,
+        help="light levels with this many torches")
+    add("--forward-lighting", action="store_true", default=False,
+        help="light every fragment from the nearest few torches, "
+        "rather than deferred")
+    add("--seed", type=int, default=None,
+        help="make the same level every time")
+    add("--startup-profile", action="store_true", default=False,
+        help="print how long each step of starting up took")
     args = ap.parse_args()
-    win = XashWindow(args)
-    pyglet.app.run()
+    if args.timing:
+        logging.basicConfig(level=logging.INFO)
+    # the heavy imports wait until we know we need them
+    startup = Startup()
+    import pyglet
+    startup.mark("import pyglet")
+    import pyglet.gl
+    startup.mark("import pyglet.gl")
+    import numpy
+    startup.mark("import numpy")
+    from xash.window import XashWindow
+    startup.mark("import game modules")
+    win = XashWindow(args, startup)
+    startup.mark("set up game")
+    if args.startup_profile:
+        win.loop.frame(0.0)
+        startup.mark("first frame")
+        startup.report()
+    win.loop.run()
+    win.loader.shutdown()
+    if args.profile_csv:
+        win.profiler.write_csv(args.profile_csv)
 
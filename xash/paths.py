@@ -0,0 +1,282 @@
+"""
+
+  Pathfinding for crowds of monsters
+
+  Instead of every monster running its own A*, a FlowField holds the
+  distance from every tile to a set of goals (the player, the treasure),
+  found by one multi-source breadth-first search with numpy: the
+  frontier is an array of tile indices, expanded a ring at a time.  Then
+  any number of monsters step downhill together with FlowField.step().
+
+  When tiles change, FlowField.repair() fixes only what they affect: a
+  tile that opens can only shorten distances, so those spread out from
+  it with a heap; a tile that closes first clears every distance that
+  might have gone through it, then fills them in again from around the
+  cleared area.
+
+  For long routes to arbitrary goals a PathService also keeps a graph of
+  the level's rooms and doors (the cells of visibility.find_cells).
+  Routes through it are cached, and a monster heads for the next door
+  on its route using that door's flow field, which any other monster
+  passing through the same door shares.
+
+  Only FLOOR and OPEN_DOOR tiles can be walked on; moves are the four
+  DIRECTIONS.
+
+"""
+import heapq
+from collections import OrderedDict
+
+import numpy as np
+
+from xash.level import WALKABLE, DOOR, OPEN_DOOR, DIRECTIONS
+from xash.visibility import floor_plan, find_cells
+
+UNREACHED = np.iinfo(np.int32).max
+CACHE_SIZE = 64 # flow fields remembered by a PathService
+
+class FlowField:
+    """ distances to goals over a level, on a grid padded with a border of
+      unwalkable tiles and flattened, so neighbours are fixed offsets """
+    def __init__(self, level, goals, maxdist=None):
+        self.level = level
+        self.goals = [tuple(g) for g in goals]
+        self.maxdist = maxdist
+        self.stride = level.width + 2
+        self.offsets = np.array([dx + dy * self.stride for dx, dy in DIRECTIONS])
+        self.compute()
+
+    def index(self, x, y):
+        return (np.asarray(y) + 1) * self.stride + np.asarray(x) + 1
+
+    def walkable(self):
+        padded = np.zeros((self.level.height + 2, self.stride), dtype=bool)
+        padded[1:-1, 1:-1] = np.isin(self.level.tiles, WALKABLE)
+        return padded.ravel()
+
+    def goal_indices(self):
+        return [int(self.index(x, y)) for x, y in self.goals
+                if 0 <= x < self.level.width and 0 <= y < self.level.height]
+
+    def compute(self):
+        """ breadth-first search from all the goals at once """
+        self.walk = walk = self.walkable()
+        self.dist = dist = np.full(walk.shape, UNREACHED, dtype=np.int32)
+        frontier = np.array([i for i in self.goal_indices() if walk[i]], dtype=np.int64)
+        dist[frontier] = 0
+        d = 0
+        while len(frontier) and (self.maxdist is None or d < self.maxdist):
+            d += 1
+            near = (frontier[:, None] + self.offsets).ravel()
+            near = np.unique(near[walk[near] & (dist[near] == UNREACHED)])
+            dist[near] = d
+            frontier = near
+        self.revision = self.level.revision
+
+    def update(self):
+        """ catch up with changes to the level, by repair() if the level
+          remembers what changed, otherwise from scratch """
+        if self.revision == self.level.revision:
+            return
+        changes = self.level.changes_since(self.revision)
+        if changes is None:
+            self.compute()
+        else:
+            self.repair(changes)
+
+    def repair(self, changes):
+        """ fix the distances after the tiles in the rectangles
+          (x0, y0, x1, y1) changed """
+        walk, dist, offsets = self.walkable(), self.dist, self.offsets.tolist()
+        changed = []
+        for x0, y0, x1, y1 in changes:
+            ys, xs = np.mgrid[y0:y1, x0:x1]
+            changed.extend(self.index(xs.ravel(), ys.ravel()).tolist())
+        changed = set(changed)
+        # clear everything downhill of tiles that can't be walked on now
+        cleared = set()
+        todo = [i for i in changed if not walk[i] and dist[i] != UNREACHED]
+        while todo:
+            i = todo.pop()
+            if i in cleared:
+                continue
+            cleared.add(i)
+            d = dist[i] + 1
+            todo.extend(n for n in (i + o for o in offsets)
+                        if dist[n] == d and n not in cleared)
+        for i in cleared:
+            dist[i] = UNREACHED
+        # spread distances from the edge of the cleared area and from
+        # around tiles that have opened up
+        heap = []
+        for i in cleared | changed:
+            for n in (i + o for o in offsets):
+                if walk[n] and dist[n] != UNREACHED:
+                    heap.append((int(dist[n]), n))
+        for i in self.goal_indices():
+            if walk[i] and dist[i] != 0:
+                dist[i] = 0
+                heap.append((0, i))
+        heapq.heapify(heap)
+        maxdist = self.maxdist if self.maxdist is not None else UNREACHED
+        while heap:
+            d, i = heapq.heappop(heap)
+            if d > dist[i] or d >= maxdist:
+                continue
+            for n in (i + o for o in offsets):
+                if walk[n] and d + 1 < dist[n]:
+                    dist[n] = d + 1
+                    heapq.heappush(heap, (d + 1, n))
+        self.walk = walk
+        self.revision = self.level.revision
+
+    def distance(self, x, y):
+        """ steps from (x, y) to the nearest goal, or None if there's no way """
+        d = int(self.dist[self.index(x, y)])
+        return None if d == UNREACHED else d
+
+    def step(self, positions):
+        """ (n, 2) array of where agents at positions (x, y) should move
+          next: the neighbour nearest a goal, or where they are if none is
+          nearer than that """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        here = self.index(positions[:, 0], positions[:, 1])
+        near = here[:, None] + self.offsets
+        best = self.dist[near].argmin(axis=1)
+        target = near[np.arange(len(near)), best]
+        move = self.dist[target] < self.dist[here]
+        moves = np.array(DIRECTIONS)[best] * move[:, None]
+        return positions + moves
+
+class PathService:
+    """ flow fields and room-to-room routes for a level, kept up to date
+      as it changes """
+    def __init__(self, level):
+        self.level = level
+        self.fields = OrderedDict() # goals -> FlowField, most recent last
+        self.routes = {}            # (from cell, to cell) -> [cells]
+        self.revision = None
+        self.door_tiles = None      # where doors were when the graph was built
+        self.stats = dict(fields=0, repairs=0, routes=0, route_hits=0)
+
+    def field(self, goals, maxdist=None):
+        """ the FlowField toward goals, a list of (x, y) """
+        key = (tuple(tuple(g) for g in goals), maxdist)
+        found = self.fields.get(key)
+        if found is None:
+            found = self.fields[key] = FlowField(self.level, goals, maxdist)
+            self.stats["fields"] += 1
+            if len(self.fields) > CACHE_SIZE:
+                self.fields.popitem(last=False)
+        else:
+            self.fields.move_to_end(key)
+            if found.revision != self.level.revision:
+                found.update()
+                self.stats["repairs"] += 1
+        return found
+
+    def check(self):
+        """ rebuild the room graph if the level has changed """
+        level = self.level
+        if self.revision == level.revision:
+            return
+        changes = level.changes_since(self.revision) if self.revision is not None else None
+        doors = np.isin(level.tiles, (DOOR, OPEN_DOOR))
+        # doors opening or closing keep the graph; anything else becoming
+        # or ceasing to be a door, or rock or floor changing, may not
+        if changes is None or any(not (doors[y0:y1, x0:x1].all() and
+                                       self.door_tiles[y0:y1, x0:x1].all())
+                                  for x0, y0, x1, y1 in changes):
+            self.door_tiles = doors
+            self.cells, ncells = find_cells(floor_plan(level))
+            ys, xs = np.nonzero(self.cells >= 0)
+            ids = self.cells[ys, xs]
+            count = np.bincount(ids, minlength=ncells)
+            self.centres = np.stack((np.bincount(ids, xs, ncells),
+                                     np.bincount(ids, ys, ncells)), axis=1) / count[:, None]
+            self.doors = dict((int(self.cells[y, x]), (int(x), int(y)))
+                              for y, x in zip(*np.nonzero(doors)))
+            # cells next to each other
+            pairs = set()
+            for a, b in ((self.cells[:, :-1], self.cells[:, 1:]),
+                         (self.cells[:-1, :], self.cells[1:, :])):
+                touch = (a >= 0) & (b >= 0) & (a != b)
+                pairs.update(zip(a[touch].tolist(), b[touch].tolist()))
+            self.neighbours = [[] for _ in range(ncells)]
+            for a, b in pairs:
+                self.neighbours[a].append(b)
+                self.neighbours[b].append(a)
+        self.routes.clear() # doors may have opened or closed
+        self.revision = level.revision
+
+    def cell_at(self, x, y):
+        self.check()
+        return int(self.cells[y, x])
+
+    def route(self, start, goal):
+        """ list of cells from the cell at start to the cell at goal, or
+          None if closed doors or rock are in the way """
+        a, b = self.cell_at(*start), self.cell_at(*goal)
+        if a < 0 or b < 0:
+            return None
+        found = self.routes.get((a, b), False)
+        if found is not False:
+            self.stats["route_hits"] += 1
+            return found
+        self.stats["routes"] += 1
+        found = self.routes[(a, b)] = self.search(a, b)
+        return found
+
+    def search(self, a, b):
+        """ Dijkstra over the room graph, with closed doors impassable """
+        tiles, centres = self.level.tiles, self.centres
+        def passable(cell):
+            door = self.doors.get(cell)
+            return door is None or tiles[door[1], door[0]] == OPEN_DOOR
+        best = {a: 0.0}
+        came = {a: None}
+        heap = [(0.0, a)]
+        while heap:
+            d, cell = heapq.heappop(heap)
+            if cell == b:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = came[cell]
+                return path[::-1]
+            if d > best[cell]:
+                continue
+            for n in self.neighbours[cell]:
+                if not passable(n):
+                    continue
+                nd = d + float(np.hypot(*(centres[n] - centres[cell])))
+                if nd < best.get(n, np.inf):
+                    best[n] = nd
+                    came[n] = cell
+                    heapq.heappush(heap, (nd, n))
+        return None
+
+    def waypoint(self, start, goal):
+        """ where an agent at start should head for to get to goal: the
+          next door on its route, or the goal itself """
+        path = self.route(start, goal)
+        if path:
+            for cell in path[1:-1]:
+                door = self.doors.get(cell)
+                if door is not None:
+                    return door
+        return tuple(goal)
+
+    def step(self, positions, goals):
+        """ move each agent at positions one step toward its own goal
+          (both (n, 2) arrays of x, y), sharing flow fields between agents
+          with the same waypoint """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        goals = np.asarray(goals, dtype=np.int64).reshape(-1, 2)
+        heading = {}
+        for i, (start, goal) in enumerate(zip(positions.tolist(), goals.tolist())):
+            heading.setdefault(self.waypoint(start, goal), []).append(i)
+        moved = positions.copy()
+        for waypoint, agents in heading.items():
+            moved[agents] = self.field([waypoint]).step(positions[agents])
+        return moved
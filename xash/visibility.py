@@ -0,0 +1,286 @@
+"""
+
+  Potentially visible sets for dungeon levels
+
+  The walkable tiles of a level are split into cells: connected areas
+  with doors between them, each door being a cell of its own.  For every
+  cell we work out offline which chunks can be seen from anywhere in it.
+  The sets are conservative: a tile is in one if any point of it can be
+  seen from any point of the cell, with no limit on distance (see
+  permissive_fov() and cell_visibility()), so a chunk the camera can see
+  is never culled.  Doors are treated as open, so the set is right
+  whichever doors are shut.  Drawing then only needs the chunks in the
+  camera's cell's set (and in the frustum).
+
+  Sight lines only know about the floor plan, so the sets only hold while
+  the eye is below the tops of the walls; from higher up chunks_from()
+  returns None and nothing is culled.
+
+  Computing the sets for a big level takes a few seconds, so they are
+  saved under a cache directory keyed by a hash of the floor plan.
+
+"""
+import os
+import hashlib
+import tempfile
+import logging
+from collections import deque
+
+import numpy as np
+
+from xash.level import ROCK, DOOR, OPEN_DOOR, WALL_HEIGHT
+
+# change when compute() changes, so cached sets are computed again
+PVS_VERSION = 2
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "xash", "pvs")
+
+def floor_plan(level):
+    """ tiles with every door open: what the PVS depends on """
+    plan = level.tiles.copy()
+    plan[plan == DOOR] = OPEN_DOOR
+    return plan
+
+def find_cells(tiles):
+    """ an int32 grid giving each open tile's cell number (-1 for rock),
+      and the number of cells """
+    height, width = tiles.shape
+    cells = np.full(tiles.shape, -1, dtype=np.int32)
+    doors = (tiles == DOOR) | (tiles == OPEN_DOOR)
+    ncells = 0
+    for y, x in zip(*np.nonzero(tiles != ROCK)):
+        if cells[y, x] >= 0:
+            continue
+        cells[y, x] = ncells
+        if not doors[y, x]:
+            todo = deque([(x, y)])
+            while todo:
+                cx, cy = todo.popleft()
+                for nx, ny in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+                    if (0 <= nx < width and 0 <= ny < height and cells[ny, nx] < 0
+                        and tiles[ny, nx] != ROCK and not doors[ny, nx]):
+                        cells[ny, nx] = ncells
+                        todo.append((nx, ny))
+        ncells += 1
+    return cells, ncells
+
+def _relative(line, x, y):
+    """ > 0 where (x, y) is below line (xi, yi, xf, yf), < 0 above """
+    xi, yi, xf, yf = line
+    return (yf - yi) * (xf - x) - (xf - xi) * (yf - y)
+
+def _collinear(a, b):
+    return _relative(a, b[0], b[1]) == 0 and _relative(a, b[2], b[3]) == 0
+
+class _View:
+    """ the wedge between a shallow and a steep line, with the corners
+      (bumps) that have narrowed it, most recent first """
+    __slots__ = ("shallow", "steep", "shallow_bumps", "steep_bumps")
+
+    def __init__(self, shallow, steep, shallow_bumps=(), steep_bumps=()):
+        self.shallow, self.steep = shallow, steep
+        self.shallow_bumps, self.steep_bumps = shallow_bumps, steep_bumps
+
+    def copy(self):
+        return _View(list(self.shallow), list(self.steep),
+                     self.shallow_bumps, self.steep_bumps)
+
+    def raise_shallow(self, x, y):
+        line = self.shallow
+        line[2], line[3] = x, y
+        self.shallow_bumps = ((x, y),) + self.shallow_bumps
+        for bx, by in self.steep_bumps:
+            if _relative(line, bx, by) < 0:
+                line[0], line[1] = bx, by
+
+    def lower_steep(self, x, y):
+        line = self.steep
+        line[2], line[3] = x, y
+        self.steep_bumps = ((x, y),) + self.steep_bumps
+        for bx, by in self.shallow_bumps:
+            if _relative(line, bx, by) > 0:
+                line[0], line[1] = bx, by
+
+    def closed(self):
+        """ have the lines met along an edge of the source square? """
+        line = self.shallow
+        return _collinear(line, self.steep) and (
+            _relative(line, 0, 1) == 0 or _relative(line, 1, 0) == 0)
+
+def _quadrant(rows, seen, x0, y0, sx, sy, extent_x, extent_y):
+    """ permissive_fov() for the quadrant in direction (sx, sy), in
+      coordinates where the source square is (0, 0)-(1, 1) """
+    views = [_View([0, 1, extent_x, 0], [1, 0, 0, extent_y])]
+    for i in range(1, extent_x + extent_y + 1):
+        if not views:
+            return
+        index = 0
+        for j in range(max(0, i - extent_x), min(i, extent_y) + 1):
+            x, y = i - j, j
+            # the square's top left and bottom right corners
+            while index < len(views) and _relative(views[index].steep, x + 1, y) >= 0:
+                index += 1 # below the square: try steeper views
+            if index == len(views):
+                break
+            view = views[index]
+            if _relative(view.shallow, x, y + 1) <= 0:
+                continue # above it, between views
+            tx, ty = x0 + x * sx, y0 + y * sy
+            seen[ty][tx] = True
+            if not rows[ty][tx]:
+                continue
+            through_shallow = _relative(view.shallow, x + 1, y) < 0
+            through_steep = _relative(view.steep, x, y + 1) > 0
+            if through_shallow and through_steep:
+                del views[index]
+            elif through_shallow:
+                view.raise_shallow(x, y + 1)
+                if view.closed():
+                    del views[index]
+            elif through_steep:
+                view.lower_steep(x + 1, y)
+                if view.closed():
+                    del views[index]
+            else:
+                # the square splits the view in two, either side of it
+                steeper = view.copy()
+                views.insert(index + 1, steeper)
+                view.lower_steep(x + 1, y)
+                if view.closed():
+                    del views[index]
+                else:
+                    index += 1
+                steeper.raise_shallow(x, y + 1)
+                if steeper.closed():
+                    del views[index]
+
+def permissive_fov(rows, x, y, seen):
+    """ mark in seen (nested lists of bools) every tile some point of
+      which can be seen from some point of tile (x, y), however far
+      away.  rows are nested lists, true for tiles that block sight;
+      blocking tiles that are seen are marked too.  This is Jonathon
+      Duerig's precise permissive field of view: a wedge of lines out
+      of the source square for each gap, narrowed at the corners of the
+      blocking squares it passes """
+    height, width = len(rows), len(rows[0])
+    seen[y][x] = True
+    for sx, sy in ((1, 1), (1, -1), (-1, -1), (-1, 1)):
+        extent_x = width - 1 - x if sx > 0 else x
+        extent_y = height - 1 - y if sy > 0 else y
+        _quadrant(rows, seen, x, y, sx, sy, extent_x, extent_y)
+
+def neighbours8(mask):
+    """ mask grown by one tile in all eight directions """
+    grown = mask.copy()
+    h, w = mask.shape
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            grown[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] |= (
+                mask[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)])
+    return grown
+
+def cell_visibility(plan, cells, cell, rows=None):
+    """ boolean grid of the tiles some point of which can be seen from
+      some point of a cell.  A line of sight either stays inside the
+      cell's tiles (so ends in one of them or a neighbour) or leaves
+      them through a border tile: one with a neighbour, diagonals
+      included, that isn't in the cell.  So only the border tiles need a
+      permissive_fov() """
+    if rows is None:
+        rows = (plan == ROCK).tolist()
+    mask = cells == cell
+    seen = neighbours8(mask)
+    border = mask & neighbours8(~mask)
+    # the map's edge is outside the cell too
+    border[[0, -1], :] |= mask[[0, -1], :]
+    border[:, [0, -1]] |= mask[:, [0, -1]]
+    marks = seen.tolist()
+    for y, x in zip(*np.nonzero(border)):
+        permissive_fov(rows, int(x), int(y), marks)
+    return np.array(marks, dtype=bool)
+
+class PVS:
+    """ cells of a level and the chunks visible from each """
+    def __init__(self, cells, visible, chunk_size, key):
+        self.cells = cells       # grid of cell numbers
+        self.visible = visible   # (ncells, chunks down, chunks across) bools
+        self.chunk_size = chunk_size
+        self.key = key           # hash of the floor plan
+        self.revision = None     # level revision the key was last checked at
+        self.sets = {}
+
+    @classmethod
+    def compute(cls, level):
+        plan = floor_plan(level)
+        cells, ncells = find_cells(plan)
+        size = level.chunk_size
+        ncx, ncy = level.nchunks
+        visible = np.zeros((ncells, ncy, ncx), dtype=bool)
+        rows = (plan == ROCK).tolist()
+        for cell in range(ncells):
+            sy, sx = np.nonzero(cell_visibility(plan, cells, cell, rows))
+            visible[cell, sy // size, sx // size] = True
+        return cls(cells, visible, size, plan_key(level))
+
+    @classmethod
+    def load_or_compute(cls, level, cachedir=None):
+        """ the PVS for a level, from the cache if it was computed before """
+        cachedir = cachedir or default_cache_dir()
+        key = plan_key(level)
+        path = os.path.join(cachedir, key + ".npz")
+        try:
+            with np.load(path) as f:
+                return cls(f["cells"], np.unpackbits(f["visible"], axis=-1,
+                                                     count=level.nchunks[0]).astype(bool),
+                           int(f["chunk_size"]), key)
+        except (OSError, KeyError, ValueError):
+            pass
+        pvs = cls.compute(level)
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            # a temporary file of its own, as games started together
+            # may both be saving this PVS
+            fd, temp = tempfile.mkstemp(dir=cachedir, prefix=key + ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, cells=pvs.cells,
+                                        visible=np.packbits(pvs.visible, axis=-1),
+                                        chunk_size=pvs.chunk_size)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            logging.warning("could not save PVS: %s", e)
+        return pvs
+
+    def matches(self, level):
+        return self.key == plan_key(level)
+
+    def cell_at(self, x, y):
+        h, w = self.cells.shape
+        if 0 <= x < w and 0 <= y < h:
+            return int(self.cells[int(y), int(x)])
+        return -1
+
+    def chunks_from(self, eye):
+        """ set of (cx, cy) chunk keys visible from the eye position,
+          or None if the PVS can't say (outside the map or above the walls) """
+        x, y, z = eye
+        if z >= WALL_HEIGHT:
+            return None
+        cell = self.cell_at(np.floor(x), np.floor(y))
+        if cell < 0:
+            return None
+        found = self.sets.get(cell)
+        if found is None:
+            cy, cx = np.nonzero(self.visible[cell])
+            found = self.sets[cell] = set(zip(cx.tolist(), cy.tolist()))
+        return found
+
+def plan_key(level):
+    h = hashlib.sha1(floor_plan(level).tobytes())
+    h.update(repr((level.tiles.shape, level.chunk_size, PVS_VERSION)).encode("ascii"))
+    return h.hexdigest()
@@ -0,0 +1,299 @@
+"""
+
+  The game window
+
+  Imported by main() once the command line has been read, since
+  pyglet.gl and the drawing modules take a while to load.
+
+"""
+import os
+import json
+import logging
+from functools import partial
+
+import numpy as np
+import pyglet
+from pyglet.gl import *
+
+import glstate
+import glresources
+from renderqueue import RenderQueue
+from assets import AssetLoader
+from lighting import Lights
+from xash.level import LevelView, ROCK, FLOOR, random_level, torches, current_matrices
+from xash.visibility import PVS
+from xash.fov import FieldOfView
+from xash.loop import GameLoop, Interpolated
+
+# configs to try, best first
+CONFIG_TEMPLATES = [
+    dict(major_version=3, minor_version=0,
+         sample_buffers=1, samples=4),
+    dict(sample_buffers=1, samples=4),
+    dict()]
+LEVEL_SIZE = (64, 64) # of the level made at startup
+CACHED_ATTRIBUTES = ("red_size", "green_size", "blue_size", "alpha_size",
+                     "depth_size", "stencil_size")
+
+def parsesize(wxh):
+    """ split WxH at 'x' and int each component """
+    return tuple(int(n) for n in wxh.split('x'))
+
+def config_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "xash", "config.json")
+
+def config_cache_key(screen):
+    """ what a cached config is only good for """
+    return "{} {} {}x{} pyglet {}".format(
+        os.environ.get("DISPLAY", ""), type(screen).__name__,
+        screen.width, screen.height, pyglet.version)
+
+def config_quality(config):
+    return (config.red_size + config.green_size + config.blue_size,
+            config.depth_size, config.samples, config.alpha_size)
+
+def choose_configs(screen, templates):
+    """ for each template that the screen can do, the best matching
+    config, found without creating any windows """
+    for optdict in templates:
+        template = pyglet.gl.Config(**dict(dict(double_buffer=True, depth_size=24),
+                                           **optdict))
+        matches = screen.get_matching_configs(template)
+        if matches:
+            yield optdict, max(matches, key=config_quality)
+
+def construct_window(width, height, *args, startup=None, **kw):
+    """ try to construct a window with as high quality settings as
+    possible.  The screen is asked which configs it can do rather than
+    making windows to find out, and the config chosen last time is tried
+    first """
+    screen = pyglet.canvas.get_display().get_default_screen()
+    path = config_cache_path()
+    key = config_cache_key(screen)
+    templates = list(CONFIG_TEMPLATES)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            templates = [cached["template"]] + [t for t in templates
+                                                if t != cached["template"]]
+    except (OSError, ValueError, KeyError):
+        pass
+    for optdict, config in choose_configs(screen, templates):
+        if startup is not None:
+            startup.mark("choose config")
+        try:
+            win = pyglet.window.Window(
+                width, height,
+                *args, config=config, **kw)
+        except (pyglet.window.NoSuchConfigException, pyglet.gl.ContextException):
+            continue
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # ask for exactly this config next time
+            chosen = dict(optdict, **dict((name, getattr(config, name))
+                                          for name in CACHED_ATTRIBUTES))
+            with open(path, "w") as f:
+                json.dump(dict(key=key, template=chosen), f)
+        except OSError as e:
+            logging.warning("could not cache config: %s", e)
+        return win
+    return None
+
+class XashWindow:
+    """ container for pyglet Window displaying the game """
+    def __init__(self, args, startup=None):
+        try:
+            width, height = parsesize(args.size)
+        except (ValueError, TypeError) as e:
+            logging.error(e)
+            width, height = (1024, 768)
+        win = construct_window(width, height,
+                               fullscreen=args.fullscreen,
+                               vsync=args.vsync, startup=startup)
+        if win is None:
+            logging.error("No window")
+            raise SystemExit(1)
+        if startup is not None:
+            startup.mark("create window")
+        self.win = win
+        self.queue = RenderQueue()
+        self.level_view = None # LevelView of the current level
+        self.fov = None # FieldOfView of the current level
+        self.seen = None # (tile, revision) of the eye, chunks and lights seen from it
+        self.loader = AssetLoader()
+        self.loading = [] # futures to finish before the level is shown
+        self.ntorches = args.torches
+        self.forward_lighting = args.forward_lighting
+        self.lights = None # lighting.Lights of the current level
+        self.lighting = None # made when there are lights to draw
+        # (eye, centre) of the camera, and where ticks should put it
+        self.camera = Interpolated(((0.5, 0.5, 0.5), (1.5, 0.5, 0.5)))
+        self.camera_goal = self.camera.current
+        self.loop = GameLoop(win, self.update, self.render,
+                             rate=args.tick_rate, fps=args.fps or None)
+        if args.timing:
+            pyglet.clock.schedule_interval(self.log_timing, 2.0)
+        self.profiler = self.overlay = None
+        if args.profile or args.profile_csv:
+            import glprofile
+            self.profiler = glprofile.Profiler()
+            self.profiler.install()
+        if args.profile:
+            self.overlay = pyglet.text.Label(
+                "", font_name="monospace", font_size=10, x=8, y=height - 8,
+                anchor_y="top", multiline=True, width=width - 16,
+                color=(255, 255, 0, 255))
+        self.load_level(random_level(*LEVEL_SIZE, seed=args.seed))
+        if startup is not None:
+            startup.mark("start level")
+
+    def load_level(self, level):
+        """ show level once its chunks and PVS have been made in the
+        background, with a progress bar until then """
+        if self.level_view is not None:
+            self.level_view.release()
+        self.level_view = LevelView(level)
+        self.fov = FieldOfView(level)
+        self.seen = None
+        self.loading = self.level_view.load(self.loader)
+        pvs = self.loader.load(PVS.load_or_compute, level)
+        pvs.add_done_callback(partial(self.pvs_loaded, self.level_view))
+        self.loading.append(pvs)
+        self.lights = torches(level, self.ntorches) if self.ntorches else None
+        # start on the first floor tile, looking along x
+        ys, xs = np.nonzero(level.tiles == FLOOR)
+        if len(xs):
+            eye = (xs[0] + 0.5, ys[0] + 0.5, 0.5)
+            self.camera = Interpolated((eye, (eye[0] + 1.0, eye[1], eye[2])))
+            self.camera_goal = self.camera.current
+
+    def pvs_loaded(self, level_view, future):
+        """ cull level_view's chunks with the PVS future made """
+        try:
+            level_view.pvs = future.result()
+        except Exception:
+            logging.exception("making the PVS") # draw without it
+
+    def in_view(self, eye):
+        """ the chunk keys and lights visible from the eye's tile, or
+        (None, all the lights) if it is in rock or off the level """
+        level = self.fov.level
+        x, y = int(np.floor(eye[0])), int(np.floor(eye[1]))
+        key = (x, y, level.revision)
+        if self.seen is None or self.seen[0] != key:
+            lights = self.lights
+            if level[x, y] == ROCK:
+                self.seen = (key, None, lights)
+                return self.seen[1:]
+            visible = self.fov.visible(x, y)
+            if lights is not None:
+                # torches are just inside the tile they light
+                tiles = np.floor(lights.positions[:, :2]).astype(np.int64)
+                np.clip(tiles, 0, (level.width - 1, level.height - 1), out=tiles)
+                lit = visible[tiles[:, 1], tiles[:, 0]]
+                lights = Lights(lights.positions[lit], lights.radii[lit],
+                                lights.colours[lit])
+            self.seen = (key, self.fov.chunks(x, y), lights)
+        return self.seen[1:]
+
+    def update(self, dt):
+        """ advance the game by one tick of dt seconds """
+        self.camera.set(self.camera_goal)
+
+    def render(self, alpha=1.0):
+        """ draw the frame, profiled if there is a profiler """
+        profiler = self.profiler
+        if profiler is None:
+            self.loader.pump()
+            self.draw_scene(alpha)
+            glresources.collect() # what was released this frame
+            return
+        profiler.frame_begin()
+        self.loader.pump()
+        with profiler.gpu_pass("scene"):
+            self.draw_scene(alpha)
+        if self.overlay is not None:
+            with profiler.gpu_pass("overlay"):
+                self.draw_overlay()
+        glresources.collect()
+        profiler.frame_end()
+
+    def draw_scene(self, alpha):
+        """ draw whatever has been put in the render queue this frame,
+        and the parts of the level in view, alpha of the way from the
+        last tick to the next """
+        glstate.enable(GL_CULL_FACE)
+        glstate.enable(GL_DEPTH_TEST)
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        if self.loading:
+            if self.loader.progress(self.loading) < 1.0:
+                self.draw_progress(self.loader.progress(self.loading))
+                glstate.restore()
+                return
+            self.loading = []
+        lighting = None
+        if self.level_view is not None:
+            eye, centre = self.camera.at(alpha)
+            glMatrixMode(GL_PROJECTION)
+            glLoadIdentity()
+            gluPerspective(60.0, self.win.width / float(self.win.height), 0.05, 100.0)
+            glMatrixMode(GL_MODELVIEW)
+            glLoadIdentity()
+            gluLookAt(*(tuple(eye) + tuple(centre) + (0.0, 0.0, 1.0)))
+            self.level_view.only, lights = self.in_view(eye)
+            if lights is not None:
+                lighting = self.lit()
+                lighting.frame(lights, *current_matrices())
+                lighting.begin()
+            self.level_view.queue(self.queue, lighting and lighting.program, eye=eye)
+        self.queue.submit()
+        if lighting is not None:
+            lighting.end()
+        glstate.restore()
+
+    def lit(self):
+        """ the lighting, made to fit the window """
+        if self.lighting is None:
+            import lighting
+            self.lighting = lighting.make_lighting(self.win.width, self.win.height,
+                                                   forward=self.forward_lighting)
+        self.lighting.resize(self.win.width, self.win.height)
+        return self.lighting
+
+    def draw_progress(self, fraction):
+        """ a loading bar fraction full across the middle of the window """
+        glstate.disable(GL_DEPTH_TEST)
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, 1, 0, 1, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        glColor3f(0.3, 0.3, 0.3)
+        glRectf(0.2, 0.48, 0.8, 0.52)
+        glColor3f(1.0, 0.8, 0.2)
+        glRectf(0.2, 0.48, 0.2 + 0.6 * fraction, 0.52)
+        glColor3f(1.0, 1.0, 1.0)
+
+    def draw_overlay(self):
+        """ the profiler's figures over the top of the frame """
+        if self.profiler.frame % 15 == 1: # labels are slow to change
+            self.overlay.text = self.profiler.text()
+        glstate.disable(GL_DEPTH_TEST)
+        glstate.disable(GL_CULL_FACE)
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, self.win.width, 0, self.win.height, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        self.overlay.draw()
+        glstate.reset() # pyglet's drawing doesn't go through glstate
+
+    def log_timing(self, dt):
+        loop = self.loop
+        logging.info("update %(update).2fms render %(render).2fms idle %(idle).2fms",
+                     loop.averages())
+        logging.info("%d frames, %d ticks, %d frames dropped", loop.frames,
+                     loop.ticks, loop.stats["dropped"])
+        logging.info("GL objects:\n%s", glresources.report())